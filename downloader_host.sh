@@ -10,6 +10,10 @@ hashid=$(cat /dev/urandom | tr -dc 'a-zA-Z0-9' | fold -w 32 | head -n 1)
 
 # build the docker container
 cd services/downloader_host
+cp ../web/pspacy.py .
+cp ../downloader_warc/fingerprint.py .
+cp ../downloader_warc/urlkeys.py .
+cp ../downloader_warc/ingest.py .
 docker build -t novichenko/downloader_host .
 
 # launch the docker container
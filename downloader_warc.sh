@@ -10,6 +10,7 @@ hashid=$(cat /dev/urandom | tr -dc 'a-zA-Z0-9' | fold -w 32 | head -n 1)
 
 # build the docker container
 cd services/downloader_warc
+cp ../web/pspacy.py .
 docker build -t novichenko/downloader_warc .
 
 warc=$1
@@ -0,0 +1,24 @@
+#!/bin/sh
+
+# load environment variables
+while read var; do
+    export $var
+done < .env.prod
+
+# build the docker container
+cd services/downloader_warc
+cp ../web/pspacy.py .
+docker build -t novichenko/downloader_warc .
+
+# add the warc files listed in the cc_url to the warc_queue table
+cc_url=$1
+workers=${2:-4}
+echo "cc_url=$cc_url"
+docker run --rm --network=novichenko novichenko/downloader_warc --db=postgresql://$POSTGRES_USER:$POSTGRES_PASSWORD@db:5432/$POSTGRES_DB "--cc_url=$cc_url" --enqueue
+
+# launch the docker containers that process the queue;
+# more workers can be added at any time, including from other hosts
+for i in $(seq 1 $workers); do
+    hashid=$(cat /dev/urandom | tr -dc 'a-zA-Z0-9' | fold -w 32 | head -n 1)
+    docker run -d --name=metahtml_warc_queue_$hashid --network=novichenko novichenko/downloader_warc --db=postgresql://$POSTGRES_USER:$POSTGRES_PASSWORD@db:5432/$POSTGRES_DB --queue_worker --stream
+done
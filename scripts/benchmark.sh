@@ -0,0 +1,79 @@
+#!/bin/sh
+
+# Runs the benchmark suite against a throwaway postgres container
+# and writes the combined json results to the file given as the first argument
+# (by default, benchmarks/<commit>.json).
+# The size of the synthetic warc file and the loader settings are set with environment variables:
+#
+#     $ RECORDS=50000 LANGUAGES=en=0.7,es=0.2,ru=0.1 LOADER=copy WORKERS=4 sh scripts/benchmark.sh
+#
+# Compare the results of two commits with scripts/compare_benchmarks.py.
+
+set -e
+
+commit=$(git rev-parse --short HEAD)
+output=${1:-benchmarks/$commit.json}
+records=${RECORDS:-10000}
+languages=${LANGUAGES:-en=0.8,es=0.1,de=0.1}
+loader=${LOADER:-insert}
+batch_size=${BATCH_SIZE:-100}
+workers=${WORKERS:-0}
+dedup=${DEDUP:-off}
+
+name=novichenko_bench_$$
+password=benchmark
+db=postgresql://novichenko:$password@$name/novichenko
+tmp=$(mktemp -d)
+
+cleanup() {
+    docker rm -f $name > /dev/null 2>&1 || true
+    docker network rm $name > /dev/null 2>&1 || true
+    rm -rf $tmp
+}
+trap cleanup EXIT
+
+# build the containers from the current working tree
+docker build -t novichenko/pg services/pg
+cp services/web/pspacy.py services/downloader_warc/
+docker build -t novichenko/downloader_warc services/downloader_warc
+docker build -t novichenko/web services/web
+
+# the data directory is a tmpfs, so the database disappears with the container
+docker network create $name > /dev/null
+docker run -d --name=$name --network=$name --tmpfs /var/lib/postgresql/data \
+    -e POSTGRES_USER=novichenko -e POSTGRES_PASSWORD=$password -e POSTGRES_DB=novichenko \
+    novichenko/pg postgres -c config_file=/etc/postgresql.conf > /dev/null
+
+# the server only accepts tcp connections after the schema has been loaded
+echo "Waiting for postgres..."
+until docker exec $name psql --host=localhost --user=novichenko -c 'SELECT 1' > /dev/null 2>&1; do
+    sleep 1
+done
+
+echo "Running bench_ingest.py..."
+docker run --rm --network=$name --entrypoint=python3 novichenko/downloader_warc \
+    benchmarks/bench_ingest.py --db=$db --records=$records --languages=$languages \
+    --loader=$loader --batch_size=$batch_size --workers=$workers --dedup=$dedup \
+    > $tmp/ingest.json
+
+echo "Running bench_ngrams.py..."
+docker run --rm --network=$name -e DB_URI=$db -e APP_FOLDER=/home/app/web novichenko/web \
+    python3 benchmarks/bench_ngrams.py \
+    > $tmp/ngrams.json
+
+mkdir -p $(dirname $output)
+python3 - $tmp $commit > $output <<'PYTHON'
+import datetime
+import json
+import sys
+tmp, commit = sys.argv[1:]
+results = {
+    'commit': commit,
+    'created_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+    }
+for name in ['ingest', 'ngrams']:
+    with open(f'{tmp}/{name}.json') as f:
+        results[name] = json.load(f)
+print(json.dumps(results, indent=4))
+PYTHON
+echo "Wrote $output"
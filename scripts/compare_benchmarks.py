@@ -0,0 +1,54 @@
+#!/usr/bin/python3
+'''
+Compares two json files written by scripts/benchmark.sh.
+
+Every number that appears in both files is printed with its relative change;
+the numbers are matched by their path in the json,
+for example ingest.ingest.stages.parse.records_per_second.
+
+    $ python3 scripts/compare_benchmarks.py benchmarks/abc1234.json benchmarks/def5678.json
+'''
+import json
+
+
+def flatten(value, prefix=''):
+    '''
+    Returns a dict mapping the dotted path of every number in value to the number.
+
+    >>> flatten({'a': {'b': 1, 'c': [2.5, 'x']}, 'd': True})
+    {'a.b': 1, 'a.c.0': 2.5}
+    '''
+    if isinstance(value, bool):
+        return {}
+    if isinstance(value, (int, float)):
+        return {prefix: value}
+    if isinstance(value, dict):
+        items = value.items()
+    elif isinstance(value, list):
+        items = enumerate(value)
+    else:
+        return {}
+    flat = {}
+    for key, item in items:
+        flat.update(flatten(item, f'{prefix}.{key}' if prefix else str(key)))
+    return flat
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('old')
+    parser.add_argument('new')
+    parser.add_argument('--filter', default='', help='only compare the paths that contain this string')
+    args = parser.parse_args()
+
+    with open(args.old) as f:
+        old = flatten(json.load(f))
+    with open(args.new) as f:
+        new = flatten(json.load(f))
+
+    for path in old:
+        if path not in new or args.filter not in path or path.startswith('parameters') or '.parameters.' in path:
+            continue
+        change = '' if old[path] == 0 else f'{(new[path]-old[path])/abs(old[path]):+8.1%}'
+        print(f'{path:70} {old[path]:14.3f} {new[path]:14.3f} {change}')
@@ -3,29 +3,40 @@
 # the sys import is needed so that we can import from the current project
 import sys
 sys.path.append('.')
-import metahtml
 
 # load imports
 import cdx_toolkit
-import json
+import collections
+import concurrent.futures
+import io
 import os
 import re
+import requests
 import sqlalchemy
-import traceback
-import pspacy
+import threading
+import urllib.parse
+from warcio.archiveiterator import ArchiveIterator
+import ingest
 
 # initialize logging
 import logging
 log = logging.getLogger(__name__)
 
 
-def process_cdx_url(connection, url, batch_size=100, source='cc', **kwargs):
+def process_cdx_url(connection, url, batch_size=100, source='cc', loader='insert', dedup='off', workers=16, per_host=8, warc_download_prefix=None, **kwargs):
     '''
+    Inserts every capture matching the url pattern in the cdx index of source.
+    The source is either an archive known to cdx_toolkit ('cc' or 'ia') or the url of a cdx server,
+    and warc_download_prefix overrides the location that the warc files are downloaded from.
+    The warc records are fetched by fetch_warc_records using up to workers threads,
+    with at most per_host concurrent requests to a single host.
+    The kwargs are passed to cdx_toolkit's iter function.
+
     NOTE:
     ideally, this function would be wrapped in a transaction;
     but this causes deadlocks when it is run concurrently with other instances of itself
     '''
-    cdx = cdx_toolkit.CDXFetcher(source)
+    cdx = cdx_toolkit.CDXFetcher(source, warc_download_prefix=warc_download_prefix)
 
     # create a new entry in the source table for this bulk insertion
     name = 'process_cdx_url(url="'+str(url)+'", source="'+str(source)+'", **kwargs='+str(kwargs)+')'
@@ -55,72 +66,114 @@ def process_cdx_url(connection, url, batch_size=100, source='cc', **kwargs):
         kwargs['filter'] = 'status:200'
 
     # estimate the total number of matching urls
-    estimated_urls = cdx.get_size_estimate(url, kwargs)
+    estimated_urls = cdx.get_size_estimate(url, **kwargs)
     log.info("estimated_urls="+str(estimated_urls))
 
-    # loop through each matching url
-    # and add it to the batch
-    batch = []
-    for i,result in enumerate(cdx.iter(url,**kwargs)):
-
-        # process only urls with 200 status code (i.e. successful)
-        if result['status']=='200':
-            log.info('fetching result; progress='+str(i)+'/'+str(estimated_urls)+'={:10.4f}'.format(i/estimated_urls)+' url='+result['url'])
-
-            # FIXME: extract a warc record from the result variable
-
-            # FIXME: extract the information from the warc record
-            url = None
-            accessed_at = None
-            html = None
-            log.debug("url="+url)
-
-            # FIXME: extract the metainfo using the metahtml library
-            meta = None
-            pspacy_title = None
-            pspacy_content = None
-
-            # append to the batch
-            batch.append({
-                'accessed_at' : accessed_at,
-                'id_source' : id_source,
-                'url' : url,
-                'jsonb' : json.dumps(meta, default=str),
-                'pspacy_title' : pspacy_title,
-                'pspacy_content' : pspacy_content
-                })
-
-        if len(batch)>=batch_size:
-            bulk_insert(connection,batch)
-            batch = []
+    # the warc records are fetched concurrently in background threads,
+    # so the fetching overlaps with the parsing and inserting below;
+    # fetched records are returned in the same order as the cdx results
+    def results_200():
+        for i,result in enumerate(cdx.iter(url,**kwargs)):
+
+            # process only urls with 200 status code (i.e. successful)
+            if result['status']=='200':
+                log.info('fetching result; progress='+str(i)+'/'+str(estimated_urls)+'={:10.4f}'.format(i/max(estimated_urls,1))+' url='+result['url'])
+                yield result
+    raw_records = fetch_warc_records(
+        results_200(),
+        warc_download_prefix=getattr(cdx, 'warc_download_prefix', None),
+        workers=workers,
+        per_host=per_host,
+        )
+
+    # loop through each fetched record
+    # and add it to the batch;
+    # the rows are built and inserted by the same code as the warc loader (see ingest.py)
+    raw_batch = []
+    for raw_record in raw_records:
+        if raw_record is None:
+            continue
+        log.debug("url="+raw_record[0])
+        raw_batch.append(raw_record)
+
+        if len(raw_batch)>=batch_size:
+            ingest.bulk_insert(connection, ingest.process_raw_batch(raw_batch, id_source), loader=loader, dedup=dedup)
+            raw_batch = []
 
     # finished loading urls,
     # so insert the last batch and update the source table
-    if len(batch)>0:
-        bulk_insert(connection,batch)
-        batch = []
+    if len(raw_batch)>0:
+        ingest.bulk_insert(connection, ingest.process_raw_batch(raw_batch, id_source), loader=loader, dedup=dedup)
+        raw_batch = []
     sql = sqlalchemy.sql.text('''
     UPDATE source SET finished_at=now() where id=:id;
     ''')
     res = connection.execute(sql,{'id':id_source})
 
 
-def bulk_insert(connection,batch):
-    try:
-        logging.info('bulk_insert '+str(len(batch))+' rows')
-        keys = ['accessed_at', 'id_source', 'url', 'jsonb']
-        sql = sqlalchemy.sql.text(
-            'INSERT INTO metahtml ('+','.join(keys)+',title,content) VALUES'+
-            ','.join(['(' + ','.join([f':{key}{i}' for key in keys]) + f",to_tsvector('simple',:pspacy_title{i}),to_tsvector('simple',:pspacy_content{i})" + ')' for i in range(len(batch))])
-            )
-        res = connection.execute(sql,{
-            key+str(i) : d[key]
-            for key in keys + ['pspacy_title','pspacy_content']
-            for i,d in enumerate(batch)
-            })
-    except Exception as e:
-        logging.error('failed to insert:'+str(e))
-        pass
+def fetch_warc_records(results, warc_download_prefix=None, workers=16, per_host=8, max_pending=None):
+    '''
+    Fetches the warc record of every cdx result in a pool of threads,
+    and yields the (url, accessed_at, html) tuple of each record in the same order as results.
+    If a record cannot be fetched, then the error is logged and None is yielded in its place.
+
+    When a result has filename, offset, and length fields (as in the common crawl),
+    the record is downloaded with an HTTP range request against warc_download_prefix;
+    each thread reuses a single requests.Session, so the connections are kept alive between records.
+    A response that is not a 206 partial response, or a record that is not a response record, counts as an error.
+    Otherwise, the record is downloaded with cdx_toolkit's fetch_warc_record method.
+
+    At most max_pending records are fetched or waiting to be yielded at once,
+    so memory stays bounded when the results are consumed slower than they are fetched.
+    '''
+    if max_pending is None:
+        max_pending = 4*workers
+
+    local = threading.local()
+    host_semaphores = collections.defaultdict(lambda: threading.BoundedSemaphore(per_host))
+    host_semaphores_lock = threading.Lock()
+
+    def fetch(result):
+        try:
+            if warc_download_prefix and 'filename' in result:
+                warc_url = warc_download_prefix.rstrip('/') + '/' + result['filename']
+                with host_semaphores_lock:
+                    semaphore = host_semaphores[urllib.parse.urlsplit(warc_url).netloc]
+                if not hasattr(local, 'session'):
+                    local.session = requests.Session()
+                offset = int(result['offset'])
+                length = int(result['length'])
+                with semaphore:
+                    with local.session.get(warc_url, headers={'Range': 'bytes='+str(offset)+'-'+str(offset+length-1)}, timeout=60, stream=True) as r:
+                        r.raise_for_status()
+
+                        # a server that ignores the Range header responds with the whole warc file,
+                        # so only the requested bytes of a partial response are read
+                        if r.status_code != 206:
+                            raise ValueError('expected a partial response, got status_code='+str(r.status_code))
+                        data = r.raw.read(length)
+                record = next(iter(ArchiveIterator(io.BytesIO(data))))
+            else:
+                record = result.fetch_warc_record()
+            if record.rec_type != 'response':
+                raise ValueError('expected a response record, got rec_type='+str(record.rec_type))
+            return (
+                record.rec_headers.get_header('WARC-Target-URI'),
+                record.rec_headers.get_header('WARC-Date'),
+                record.content_stream().read(),
+                )
+        except Exception as e:
+            log.warning('failed to fetch url='+str(result.get('url'))+' exception='+str(e))
+            return None
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = collections.deque()
+        for result in results:
+            pending.append(pool.submit(fetch, result))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while len(pending) > 0:
+            yield pending.popleft().result()
 
 
 if __name__=='__main__':
@@ -131,6 +184,11 @@ if __name__=='__main__':
     ''')
     parser.add_argument('--url_pattern', default='cnn.com/*')
     parser.add_argument('--db', default='postgresql:///')
+    parser.add_argument('--batch_size', type=int, default=100)
+    parser.add_argument('--workers', type=int, default=16, help='number of threads fetching warc records')
+    parser.add_argument('--per_host', type=int, default=8, help='maximum number of concurrent requests to a single host')
+    parser.add_argument('--loader', choices=['insert', 'copy'], default='insert', help='the copy loader is faster and supports batch sizes in the thousands')
+    parser.add_argument('--dedup', choices=['off', 'link', 'skip'], default='off', help='skip near-duplicate documents, or link them to their canonical row')
     args = parser.parse_args()
 
     # set logging
@@ -149,4 +207,4 @@ if __name__=='__main__':
         sys.exit(1)
 
     # process the query
-    process_cdx_url(connection, args.url_pattern)
+    process_cdx_url(connection, args.url_pattern, batch_size=args.batch_size, loader=args.loader, dedup=args.dedup, workers=args.workers, per_host=args.per_host)
@@ -0,0 +1,215 @@
+import pytest
+import contextlib
+import functools
+import http.server
+import io
+import json
+import re
+import threading
+import time
+import urllib.parse
+import cdx_toolkit
+from warcio.archiveiterator import ArchiveIterator
+from warcio.statusandheaders import StatusAndHeaders
+from warcio.warcwriter import WARCWriter
+
+# the sys import is needed so that we can import from the current project
+import sys
+sys.path.append('.')
+import downloader_host
+
+
+class RangeRequestHandler(http.server.SimpleHTTPRequestHandler):
+    '''
+    A stand-in for the common crawl's s3 bucket and cdx server;
+    it serves byte ranges of files and records the Range headers and the maximum number of concurrent requests.
+    Requests to /cdx are answered from cdx_results like a pywb cdx server with a single page of results.
+    '''
+    lock = threading.Lock()
+    active = 0
+    max_active = 0
+    ranges = []
+    cdx_results = []
+    ignore_range = False
+
+    def do_GET(self):
+        cls = type(self)
+        if self.path.startswith('/cdx'):
+            self.do_cdx()
+            return
+        with cls.lock:
+            cls.active += 1
+            cls.max_active = max(cls.max_active, cls.active)
+            cls.ranges.append((self.path, self.headers['Range']))
+        try:
+            time.sleep(0.01)
+            try:
+                with open(self.translate_path(self.path), 'rb') as f:
+                    data = f.read()
+            except FileNotFoundError:
+                self.send_error(404)
+                return
+            if cls.ignore_range:
+                self.send_response(200)
+            else:
+                start, end = self.headers['Range'].split('=')[1].split('-')
+                data = data[int(start):int(end)+1]
+                self.send_response(206)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        finally:
+            with cls.lock:
+                cls.active -= 1
+
+    def do_cdx(self):
+        params = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+        if 'showNumPages' in params:
+            body = json.dumps({'blocks': 1})
+        elif params.get('page', ['0']) != ['0']:
+            self.send_error(400)
+            return
+        else:
+            fields = ['url', 'status', 'filename', 'offset', 'length']
+            body = ''.join(json.dumps({ field: result[field] for field in fields })+'\n' for result in type(self).cdx_results)
+        data = body.encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeConnection:
+    '''
+    A stand-in for a connection to the database that only understands the statements of process_cdx_url;
+    it keeps the urls of the inserted rows and whether the source was marked finished.
+    '''
+    def __init__(self):
+        self.urls = []
+        self.finished = False
+
+    @contextlib.contextmanager
+    def begin(self):
+        yield
+
+    def execute(self, sql, params):
+        sql = str(sql)
+        if 'INSERT INTO source' in sql:
+            return FakeResult({'id': 1})
+        elif 'INSERT INTO metahtml' in sql:
+            self.urls.extend(value for key, value in params.items() if re.fullmatch(r'url\d+', key))
+        elif 'SET finished_at' in sql:
+            self.finished = True
+
+
+class FakeResult:
+    def __init__(self, row):
+        self.row = row
+
+    def first(self):
+        return self.row
+
+
+@pytest.fixture
+def warc_cdx(tmp_path):
+    '''
+    Writes a small gzipped warc file and returns the cdx results that index it.
+    '''
+    path = tmp_path / 'crawl-data' / 'sample.warc.gz'
+    path.parent.mkdir()
+    with open(path, 'wb') as f:
+        writer = WARCWriter(f, gzip=True)
+        for i in range(60):
+            url = f'https://example.com/{i}'
+            html = f'<html><head><title>page {i}</title></head></html>'.encode()
+            http_headers = StatusAndHeaders('200 OK', [('Content-Type', 'text/html')], protocol='HTTP/1.1')
+            record = writer.create_warc_record(url, 'response', payload=io.BytesIO(html), http_headers=http_headers)
+            writer.write_record(record)
+
+    results = []
+    with open(path, 'rb') as f:
+        archive_iterator = ArchiveIterator(f)
+        for record in archive_iterator:
+            url = record.rec_headers.get_header('WARC-Target-URI')
+            html = record.content_stream().read()
+            results.append({
+                'url': url,
+                'status': '200',
+                'filename': 'crawl-data/sample.warc.gz',
+                'offset': str(archive_iterator.get_record_offset()),
+                'length': str(archive_iterator.get_record_length()),
+                'expected': (url, record.rec_headers.get_header('WARC-Date'), html),
+                })
+    return tmp_path, results
+
+
+@pytest.fixture
+def server(warc_cdx):
+    root, results = warc_cdx
+    RangeRequestHandler.max_active = 0
+    RangeRequestHandler.ranges = []
+    RangeRequestHandler.ignore_range = False
+    RangeRequestHandler.cdx_results = results
+    handler = functools.partial(RangeRequestHandler, directory=str(root))
+    server = http.server.ThreadingHTTPServer(('localhost', 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://localhost:{server.server_port}/'
+    server.shutdown()
+    server.server_close()
+
+
+def test_fetch_warc_records(warc_cdx, server):
+    root, results = warc_cdx
+    raw_records = list(downloader_host.fetch_warc_records(results, warc_download_prefix=server, workers=8, per_host=3))
+    assert raw_records == [result['expected'] for result in results]
+    assert 1 < RangeRequestHandler.max_active <= 3
+
+
+def test_fetch_warc_records_errors(warc_cdx, server):
+    root, results = warc_cdx
+    results = results[:3]
+    results[1] = dict(results[1], filename='crawl-data/missing.warc.gz')
+    raw_records = list(downloader_host.fetch_warc_records(results, warc_download_prefix=server, workers=2))
+    assert raw_records == [results[0]['expected'], None, results[2]['expected']]
+
+
+def test_fetch_warc_records_ignored_range(warc_cdx, server):
+    root, results = warc_cdx
+    RangeRequestHandler.ignore_range = True
+    raw_records = list(downloader_host.fetch_warc_records(results[:3], warc_download_prefix=server, workers=2))
+    assert raw_records == [None, None, None]
+
+
+def test_fetch_warc_records_not_response(warc_cdx, server):
+    root, results = warc_cdx
+    path = root / 'crawl-data' / 'info.warc.gz'
+    with open(path, 'wb') as f:
+        writer = WARCWriter(f, gzip=True)
+        writer.write_record(writer.create_warcinfo_record('info.warc.gz', {'software': 'test'}))
+    result = {'url': 'https://example.com/info', 'filename': 'crawl-data/info.warc.gz', 'offset': '0', 'length': str(path.stat().st_size)}
+    assert list(downloader_host.fetch_warc_records([result], warc_download_prefix=server)) == [None]
+
+
+def test_process_cdx_url(warc_cdx, server, monkeypatch):
+    root, results = warc_cdx
+    results[5]['status'] = '404'
+
+    # cdx_toolkit waits a few seconds between requests to a host it does not know
+    monkeypatch.setitem(cdx_toolkit.myrequests.retry_info, 'localhost', {'next_fetch': 0, 'minimum_interval': 0})
+
+    connection = FakeConnection()
+    downloader_host.process_cdx_url(connection, 'example.com/*', batch_size=25, source=server+'cdx', warc_download_prefix=server, workers=8, per_host=3)
+
+    # every capture with a 200 status is fetched with a single range request and inserted
+    results_200 = [ result for result in results if result['status'] == '200' ]
+    assert sorted(RangeRequestHandler.ranges) == sorted(
+        ('/'+result['filename'], 'bytes={}-{}'.format(result['offset'], int(result['offset'])+int(result['length'])-1))
+        for result in results_200
+        )
+    assert sorted(connection.urls) == sorted(result['url'] for result in results_200)
+    assert connection.finished
+    assert 1 < RangeRequestHandler.max_active <= 3
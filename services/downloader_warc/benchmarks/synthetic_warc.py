@@ -0,0 +1,243 @@
+#!/usr/bin/python3
+'''
+Generates synthetic WARC files for the benchmarks.
+
+Every response record is an html news article with a title, description, publication date and language,
+so that metahtml extracts the same fields that it extracts from real articles
+and every stage of the loader (parsing, lemmatization, fingerprinting, inserting, the rollups) does real work.
+The words of each document are drawn from a small per-language vocabulary with a Zipf distribution,
+and a fraction of the documents are near-duplicates of earlier documents.
+The output only depends on the arguments, so the same command always produces the same file.
+
+Run from the services/downloader_warc directory:
+
+    $ python3 benchmarks/synthetic_warc.py --records 10000 --languages en=0.7,es=0.2,de=0.1 --output /tmp/bench.warc.gz
+'''
+import datetime
+import html
+import io
+import random
+import uuid
+from warcio.statusandheaders import StatusAndHeaders
+from warcio.warcwriter import WARCWriter
+
+
+vocabularies = {
+    'en': '''
+        the of and to in a is that for it as was with be by on not he i this are or his from at which but have an
+        they you were her she there one all we their been has would when who will more no if out so said what up
+        its about into than them can only other new some could time these two may then do first any my now such
+        like our over man me even most made after also did many before must through back years where much your way
+        well down should because each just those people how too little state good very make world still own see men
+        work long get here between both life being under never day same another know while last might us great old
+        year off come since against go came right used take three president government war election city country
+        market company school court police report water health family music film team game history science
+        ''',
+    'es': '''
+        de la que el en y a los se del las un por con no una su para es al lo como más pero sus le ya o este
+        sí porque esta entre cuando muy sin sobre también me hasta hay donde quien desde todo nos durante todos uno
+        les ni contra otros ese eso ante ellos e esto mí antes algunos qué unos yo otro otras otra él tanto esa
+        estos mucho quienes nada muchos cual poco ella estar estas algunas algo nosotros gobierno presidente país
+        ciudad guerra elección mercado empresa escuela tribunal policía informe agua salud familia música equipo
+        ''',
+    'fr': '''
+        de la le et les des en un du une que est pour qui dans a par plus pas au sur ne se ce il sont avec ou son
+        aux d'un cette d'une ont ses mais comme on tout nous sa été fait aussi leur bien peut ces y deux ans
+        encore même entre après elle très être sans autres sous avant notre fois dont gouvernement président pays
+        ville guerre élection marché entreprise école tribunal police rapport eau santé famille musique équipe
+        ''',
+    'de': '''
+        der die und in den von zu das mit sich des auf für ist im dem nicht ein eine als auch es an werden aus er
+        hat dass sie nach wird bei einer um am sind noch wie einem über einen so zum war haben nur oder aber vor
+        zur bis mehr durch man sein wurde sei in prozent hatte kann gegen vom können schon wenn habe seine
+        regierung präsident land stadt krieg wahl markt unternehmen schule gericht polizei bericht wasser gesundheit
+        ''',
+    'ru': '''
+        и в не на я быть он с что а по это она этот к но они мы как из у который то за свой что весь год от так
+        о для ты же все тот мочь вы человек такой его сказать только или еще бы себя один как уже до время если
+        сам когда другой вот говорить наш мой знать стать при чтобы дело жизнь кто первый очень два день
+        правительство президент страна город война выборы рынок компания школа суд полиция доклад вода здоровье
+        ''',
+    }
+
+
+def parse_languages(languages):
+    '''
+    Parses a comma separated list of lang=weight pairs into a dict of normalized weights.
+
+    >>> parse_languages('en=3,es=1')
+    {'en': 0.75, 'es': 0.25}
+    >>> parse_languages('en,de')
+    {'en': 0.5, 'de': 0.5}
+    >>> parse_languages('en=1,xx=1')
+    Traceback (most recent call last):
+        ...
+    ValueError: no vocabulary for language xx; the valid languages are de, en, es, fr, ru
+    '''
+    weights = {}
+    for item in languages.split(','):
+        lang, _, weight = item.strip().partition('=')
+        if lang not in vocabularies:
+            raise ValueError(f'no vocabulary for language {lang}; the valid languages are {", ".join(sorted(vocabularies))}')
+        weights[lang] = float(weight or 1)
+    total = sum(weights.values())
+    return { lang: weight/total for lang, weight in weights.items() }
+
+
+class DocumentGenerator:
+    '''
+    Generates the html of synthetic articles.
+
+    >>> generator = DocumentGenerator(seed=0)
+    >>> doc = generator.document('en')
+    >>> sorted(doc.keys())
+    ['description', 'html', 'language', 'published', 'text', 'title', 'url']
+    >>> doc == DocumentGenerator(seed=0).document('en')
+    True
+    '''
+
+    def __init__(self, seed=0, hosts=100, start=datetime.datetime(2015, 1, 1), end=datetime.datetime(2021, 1, 1), words_per_document=300):
+        self.random = random.Random(seed)
+        self.hosts = [ f'news{i}.example.com' for i in range(hosts) ]
+        self.start = start
+        self.seconds = int((end - start).total_seconds())
+        self.words_per_document = words_per_document
+        self.words = { lang: vocabulary.split() for lang, vocabulary in vocabularies.items() }
+
+        # the zipf weights give the text a realistic mix of very common and rare words
+        self.weights = { lang: [ 1/(rank+1) for rank in range(len(words)) ] for lang, words in self.words.items() }
+        self.count = 0
+
+    def sentence(self, lang, length):
+        words = self.random.choices(self.words[lang], self.weights[lang], k=length)
+        return ' '.join(words).capitalize() + '.'
+
+    def document(self, lang):
+        self.count += 1
+        title = self.sentence(lang, self.random.randint(4, 12))[:-1]
+        description = self.sentence(lang, self.random.randint(15, 30))
+        paragraphs = []
+        words = 0
+        while words < self.words_per_document:
+            length = self.random.randint(8, 25)
+            paragraphs.append(self.sentence(lang, length))
+            words += length
+        published = self.start + datetime.timedelta(seconds=self.random.randrange(self.seconds))
+        url = f'https://{self.random.choice(self.hosts)}/{published:%Y/%m}/article-{self.count}.html'
+        return {
+            'url': url,
+            'language': lang,
+            'title': title,
+            'description': description,
+            'text': ' '.join(paragraphs),
+            'published': published,
+            'html': render_html(lang, title, description, published, paragraphs),
+            }
+
+    def near_duplicate(self, doc):
+        '''
+        Returns a copy of doc at a different url with one word of the body changed.
+        '''
+        self.count += 1
+        host = self.random.choice(self.hosts)
+        body = doc['html'].replace('<p>', '<p>' + self.random.choice(self.words[doc['language']]) + ' ', 1)
+        return dict(doc, url=f'https://{host}/syndicated/article-{self.count}.html', html=body)
+
+
+def render_html(lang, title, description, published, paragraphs):
+    return f'''<!doctype html>
+<html lang="{lang}">
+<head>
+<meta charset="utf-8">
+<title>{html.escape(title)}</title>
+<meta name="description" content="{html.escape(description)}">
+<meta property="og:type" content="article">
+<meta property="og:title" content="{html.escape(title)}">
+<meta property="article:published_time" content="{published.isoformat()}Z">
+</head>
+<body>
+<article>
+<h1>{html.escape(title)}</h1>
+{''.join('<p>' + html.escape(paragraph) + '</p>' for paragraph in paragraphs)}
+</article>
+</body>
+</html>'''
+
+
+def write_warc(
+        f,
+        records=1000,
+        languages='en',
+        duplicates=0.05,
+        seed=0,
+        hosts=100,
+        words_per_document=300,
+        accessed_at=datetime.datetime(2021, 1, 15),
+        ):
+    '''
+    Writes a gzipped warc file with the given number of response records to the binary file f,
+    and returns a dict with the number of documents of each language.
+    Every response record is followed by a request record, like in the common crawl warc files.
+    The accessed_at dates are spread over the 90 days starting at accessed_at,
+    so that the inserts touch more than one partition of the metahtml table.
+    '''
+    weights = parse_languages(languages)
+    generator = DocumentGenerator(seed=seed, hosts=hosts, words_per_document=words_per_document)
+    writer = WARCWriter(f, gzip=True)
+    counts = { lang: 0 for lang in weights }
+    recent = []
+    for i in range(records):
+        if len(recent) > 0 and generator.random.random() < duplicates:
+            doc = generator.near_duplicate(generator.random.choice(recent))
+        else:
+            lang = generator.random.choices(list(weights.keys()), list(weights.values()))[0]
+            doc = generator.document(lang)
+            recent = (recent + [doc])[-100:]
+        counts[doc['language']] += 1
+
+        warc_date = accessed_at + datetime.timedelta(seconds=i * 90*24*60*60 // records)
+        warc_headers = {'WARC-Date': warc_date.strftime('%Y-%m-%dT%H:%M:%SZ')}
+        http_headers = StatusAndHeaders('200 OK', [('Content-Type', 'text/html; charset=utf-8')], protocol='HTTP/1.1')
+        for rec_type, payload, headers in [
+                ('response', doc['html'].encode('utf-8'), http_headers),
+                ('request', b'GET / HTTP/1.1\r\n\r\n', None),
+                ]:
+            # warcio generates random record ids by default
+            warc_headers['WARC-Record-ID'] = f'<urn:uuid:{uuid.UUID(int=generator.random.getrandbits(128))}>'
+            record = writer.create_warc_record(doc['url'], rec_type, payload=io.BytesIO(payload), http_headers=headers, warc_headers_dict=warc_headers)
+            writer.write_record(record)
+    return counts
+
+
+def documents(lang, count, seed=0, words_per_document=300):
+    '''
+    Returns a list of count synthetic documents in language lang.
+    '''
+    generator = DocumentGenerator(seed=seed, words_per_document=words_per_document)
+    return [ generator.document(lang) for i in range(count) ]
+
+
+if __name__ == '__main__':
+    import argparse
+    import json
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output', required=True, help='path of the .warc.gz file to write')
+    parser.add_argument('--records', type=int, default=1000)
+    parser.add_argument('--languages', default='en', help='comma separated lang=weight pairs, for example en=0.7,es=0.3')
+    parser.add_argument('--duplicates', type=float, default=0.05, help='fraction of the documents that are near-duplicates of an earlier document')
+    parser.add_argument('--hosts', type=int, default=100)
+    parser.add_argument('--words_per_document', type=int, default=300)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    with open(args.output, 'wb') as f:
+        counts = write_warc(
+            f,
+            records=args.records,
+            languages=args.languages,
+            duplicates=args.duplicates,
+            seed=args.seed,
+            hosts=args.hosts,
+            words_per_document=args.words_per_document,
+            )
+    print(json.dumps(counts))
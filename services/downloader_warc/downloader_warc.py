@@ -5,20 +5,103 @@
 # the sys import is needed so that we can import from the current project
 import sys
 sys.path.append('.')
-import metahtml
 
 # load imports
+import collections
+import concurrent.futures
 import gzip
-import json
+import logging
+import os
+import queue
+import socket
 import sqlalchemy
 import tempfile
-import traceback
+import threading
+import urllib.request
+from time import sleep
 from warcio.archiveiterator import ArchiveIterator
 import wget
-import pspacy
+import ingest
 
 
-def process_all_warcs_from_url(connection, cc_url):
+def process_all_warcs_from_url(connection, cc_url, **kwargs):
+    '''
+    Processes every warc file listed in cc_url one after another.
+    The kwargs are passed to process_warc_from_url.
+    '''
+    for warc_url in iter_warc_urls(cc_url):
+        process_warc_from_url(connection, warc_url, **kwargs)
+
+
+def enqueue_warcs_from_url(connection, cc_url, batch_size=1000):
+    '''
+    Adds every warc file listed in cc_url to the warc_queue table;
+    warc files that are already in the queue are not added a second time.
+    The queue is then processed by any number of calls to process_warcs_from_queue,
+    which can be running on different hosts.
+    '''
+    sql = sqlalchemy.sql.text('''
+    INSERT INTO warc_queue (warc_url) SELECT unnest(CAST(:warc_urls AS TEXT[])) ON CONFLICT DO NOTHING;
+    ''')
+    warc_urls = []
+    for warc_url in iter_warc_urls(cc_url):
+        warc_urls.append(warc_url)
+        if len(warc_urls)>=batch_size:
+            connection.execute(sql,{'warc_urls':warc_urls})
+            warc_urls = []
+    if len(warc_urls)>0:
+        connection.execute(sql,{'warc_urls':warc_urls})
+
+
+def process_warcs_from_queue(connection, claim_timeout=60*60, worker=None, **kwargs):
+    '''
+    Repeatedly claims a warc file from the warc_queue table and processes it,
+    returning once there are no more claimable warc files.
+    The kwargs are passed to process_warc_from_url.
+
+    Jobs are claimed with SELECT ... FOR UPDATE SKIP LOCKED,
+    so concurrent workers never block each other or claim the same job at the same time.
+    A claim that is older than claim_timeout seconds without finishing is considered stale,
+    and the job can be claimed again;
+    the advisory lock in process_warc_from_url ensures that a stale claim whose worker is still running
+    is skipped instead of processed twice,
+    and the checkpoints let the new worker resume where a crashed worker stopped.
+    '''
+    if worker is None:
+        worker = socket.gethostname()+':'+str(os.getpid())
+
+    claim_sql = sqlalchemy.sql.text('''
+    UPDATE warc_queue SET claimed_at=now(), claimed_by=:worker, attempts=attempts+1
+    WHERE id = (
+        SELECT id
+        FROM warc_queue
+        WHERE
+            finished_at IS NULL AND
+            (claimed_at IS NULL OR claimed_at < now() - :claim_timeout * interval '1 second')
+        ORDER BY id
+        LIMIT 1
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING id, warc_url;
+    ''')
+    finish_sql = sqlalchemy.sql.text('''
+    UPDATE warc_queue SET finished_at=now() WHERE id=:id;
+    ''')
+
+    while True:
+        job = connection.execute(claim_sql,{'worker':worker, 'claim_timeout':claim_timeout}).first()
+        if job is None:
+            logging.info('warc_queue has no claimable jobs; worker='+worker)
+            return
+        logging.info('claimed warc_url='+job['warc_url']+' worker='+worker)
+        if process_warc_from_url(connection, job['warc_url'], **kwargs):
+            connection.execute(finish_sql,{'id':job['id']})
+
+
+def iter_warc_urls(cc_url):
+    '''
+    Yields the url of every warc file listed in the gzipped file at cc_url.
+    '''
     with tempfile.TemporaryDirectory() as tempdir:
         logging.info('downloading url '+cc_url+' to '+tempdir)
 
@@ -39,11 +122,24 @@ def process_all_warcs_from_url(connection, cc_url):
                 prefix = 'https://commoncrawl.s3.amazonaws.com/'
                 warc_url = prefix+line.strip()
                 logging.info("warc_url="+warc_url)
-                process_warc_from_url(connection, warc_url)
+                yield warc_url
 
 
-def process_warc_from_url(connection, warc_url):
+def process_warc_from_url(connection, warc_url, stream=False, read_ahead=16, **kwargs):
     '''
+    The kwargs are passed to process_warc_from_stream.
+
+    When stream=True, the warc file is not saved to disk before processing;
+    instead, the download is fed directly into the ArchiveIterator,
+    and at most read_ahead chunks of the download are buffered in memory.
+
+    Every batch is committed together with a checkpoint in the source table.
+    If a previous run on warc_url did not finish,
+    then processing resumes from the checkpoint of its last committed batch.
+
+    Returns True if warc_url has been completely inserted,
+    and False if another loader is currently processing it.
+
     FIXME:
     ideally, this function would be wrapped in a transaction;
     but this causes deadlocks when it is run concurrently with other instances of itself
@@ -51,116 +147,313 @@ def process_warc_from_url(connection, warc_url):
     # create a new entry in the source table for this bulk insertion
     try:
         sql = sqlalchemy.sql.text('''
-        INSERT INTO source (name) VALUES (:name) RETURNING id;
+        INSERT INTO source (name) VALUES (:name) RETURNING id, finished_at, checkpoint_offset, checkpoint_records;
         ''')
         res = connection.execute(sql,{'name':warc_url})
-        id_source = res.first()['id']
-        logging.debug('id_source='+str(id_source))
+        source = res.first()
 
     # if an entry already exists in source,
-    # then we have already inserted this warc and can safely skip the file
+    # then we have already started inserting this warc;
+    # we can safely skip the file if it finished,
+    # and otherwise we resume from its checkpoint
     except sqlalchemy.exc.IntegrityError:
-        logging.info('skipping warc_url='+warc_url)
-        return
-
-    # process the warc file in a temporary directory;
-    # the downloaded warc file will be stored in this directory and automatically deleted 
-    with tempfile.TemporaryDirectory() as tempdir:
-        logging.info('downloading url '+warc_url+' to '+tempdir)
-        warc_path = wget.download(warc_url, out=tempdir)
-        process_warc_from_disk(connection, warc_path, id_source)
+        sql = sqlalchemy.sql.text('''
+        SELECT id, finished_at, checkpoint_offset, checkpoint_records FROM source WHERE name=:name;
+        ''')
+        res = connection.execute(sql,{'name':warc_url})
+        source = res.first()
+        if source['finished_at'] is not None:
+            logging.info('skipping warc_url='+warc_url)
+            return True
+    id_source = source['id']
+    offset = source['checkpoint_offset']
+    records = source['checkpoint_records']
+    logging.debug('id_source='+str(id_source))
 
-    # finished loading the file, so update the source table
+    # another loader may be processing this warc right now;
+    # the advisory lock ensures that only one loader works on each source at a time
     sql = sqlalchemy.sql.text('''
-    UPDATE source SET finished_at=now() where id=:id;
+    SELECT pg_try_advisory_lock(hashtext('source'), :id);
     ''')
-    res = connection.execute(sql,{'id':id_source})
+    if not connection.execute(sql,{'id':id_source}).scalar():
+        logging.info('skipping locked warc_url='+warc_url)
+        return False
+
+    try:
+        if offset > 0:
+            logging.info('resuming warc_url='+warc_url+' checkpoint_offset='+str(offset)+' checkpoint_records='+str(records))
+
+        # in streaming mode, the records are processed while the warc file is still downloading
+        if stream:
+            logging.info('streaming url '+warc_url)
+            with open_warc_stream(warc_url, offset=offset, read_ahead=read_ahead) as warc_stream:
+                process_warc_from_stream(connection, warc_stream, id_source, records=records, **kwargs)
 
+        # otherwise, process the warc file in a temporary directory;
+        # the downloaded warc file will be stored in this directory and automatically deleted 
+        else:
+            with tempfile.TemporaryDirectory() as tempdir:
+                logging.info('downloading url '+warc_url+' to '+tempdir)
+                warc_path = wget.download(warc_url, out=tempdir)
+                process_warc_from_disk(connection, warc_path, id_source, offset=offset, records=records, **kwargs)
 
-def process_warc_from_disk(connection, warc_path, id_source, batch_size=100):
+        # finished loading the file, so update the source table
+        sql = sqlalchemy.sql.text('''
+        UPDATE source SET finished_at=now() where id=:id;
+        ''')
+        res = connection.execute(sql,{'id':id_source})
+        return True
+
+    finally:
+        sql = sqlalchemy.sql.text('''
+        SELECT pg_advisory_unlock(hashtext('source'), :id);
+        ''')
+        connection.execute(sql,{'id':id_source})
+
+
+def process_warc_from_disk(connection, warc_path, id_source, offset=0, **kwargs):
     '''
+    Inserts every response record in the warc file into the metahtml table,
+    starting from the record at byte offset.
+    The kwargs are passed to process_warc_from_stream.
     '''
     with open(warc_path, 'rb') as stream:
+        stream.seek(offset)
+        process_warc_from_stream(connection, stream, id_source, **kwargs)
+
+
+def process_warc_from_stream(connection, stream, id_source, batch_size=100, workers=0, loader='insert', dedup='off', records=0):
+    '''
+    Inserts every response record in the binary warc stream into the metahtml table.
+    The stream must support the read and tell methods, and so it can be an open file or a ReadAheadStream.
+    The records argument is the number of response records that come before the stream's position,
+    and it is only used for the checkpoints.
+
+    When workers>0, the metahtml parsing and lemmatization happen in a pool of worker processes;
+    the current process only reads the raw records from the stream and inserts the finished rows.
+    The rows inserted are exactly the same as when workers=0.
+
+    The dedup argument is passed to fingerprint.dedup_batch.
+    '''
+
+    # for efficiency, we will not insert items into the db one at a time;
+    # instead, we process the records in batches,
+    # and bulk insert each batch once it has been processed
+    raw_batches = iter_raw_batches(stream, batch_size, records=records)
+
+    if workers > 0:
+        process_raw_batches_parallel(connection, raw_batches, id_source, workers, loader=loader, dedup=dedup)
+    else:
+        for raw_batch, checkpoint in raw_batches:
+            batch = ingest.process_raw_batch(raw_batch, id_source)
+            ingest.bulk_insert(connection, batch, loader=loader, dedup=dedup, checkpoint=dict(checkpoint, id=id_source))
+
+
+def open_warc_stream(warc_url, offset=0, chunk_size=1024*1024, read_ahead=16):
+    '''
+    Returns a ReadAheadStream for warc_url, which may be either a file path or a url.
+    The stream starts at byte offset in the file.
+    '''
+    if os.path.exists(warc_url):
+        source = open(warc_url, 'rb')
+        source.seek(offset)
+    else:
+        request = urllib.request.Request(warc_url)
+        if offset > 0:
+            request.add_header('Range', 'bytes='+str(offset)+'-')
+        source = urllib.request.urlopen(request)
+
+        # servers that do not support range requests return the entire file,
+        # and so we must discard the bytes before offset ourselves
+        if offset > 0 and source.status != 206:
+            remaining = offset
+            while remaining > 0:
+                data = source.read(min(remaining, chunk_size))
+                if not data:
+                    break
+                remaining -= len(data)
+    return ReadAheadStream(source, offset=offset, chunk_size=chunk_size, read_ahead=read_ahead)
+
+
+class ReadAheadStream:
+    '''
+    A read-only file-like object that reads chunks from a source stream in a background thread.
+    At most read_ahead chunks are buffered,
+    so the download overlaps with processing the records without unbounded memory usage.
+
+    The read method may return fewer bytes than requested (but never 0 bytes before the end of the stream),
+    which is the same behavior as a raw socket or unbuffered file.
+    The tell method returns the position in the file assuming that the source starts at byte offset.
+    '''
+    def __init__(self, source, offset=0, chunk_size=1024*1024, read_ahead=16):
+        self.source = source
+        self.offset = offset
+        self.chunk_size = chunk_size
+        self.chunks = queue.Queue(maxsize=read_ahead)
+        self.chunk = b''
+        self.position = 0
+        self.finished = False
+        self.closed = False
+        self.error = None
+        self.thread = threading.Thread(target=self._fill, daemon=True)
+        self.thread.start()
+
+    def _fill(self):
+        try:
+            while not self.closed:
+                chunk = self.source.read(self.chunk_size)
+                if not chunk:
+                    break
+                self.chunks.put(chunk)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.chunks.put(None)
+
+    def _next_chunk(self):
+        chunk = self.chunks.get()
+        if chunk is None:
+            self.finished = True
+            if self.error is not None:
+                raise self.error
+            chunk = b''
+        self.chunk = chunk
+        self.position = 0
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            parts = [self.chunk[self.position:]]
+            while not self.finished:
+                self._next_chunk()
+                parts.append(self.chunk)
+            self.chunk = b''
+            self.position = 0
+            data = b''.join(parts)
+            self.offset += len(data)
+            return data
+
+        while self.position >= len(self.chunk) and not self.finished:
+            self._next_chunk()
+        data = self.chunk[self.position:self.position+size]
+        self.position += len(data)
+        self.offset += len(data)
+        return data
+
+    def tell(self):
+        return self.offset
+
+    def close(self):
+        '''
+        Stops the background thread and closes the source stream.
+        '''
+        self.closed = True
+        while not self.finished:
+            if self.chunks.get() is None:
+                self.finished = True
+        self.source.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def process_raw_batches_parallel(connection, raw_batches, id_source, workers, max_pending=None, loader='insert', dedup='off'):
+    '''
+    Processes the raw batches in a pool of worker processes.
+
+    The batches are submitted to the pool in order,
+    and the processed batches are passed to a single writer thread in that same order,
+    so the rows and checkpoints are inserted in the same order as the serial code path.
+    At most max_pending batches are being processed at once,
+    and at most max_pending processed batches wait for the writer;
+    this keeps memory usage flat no matter how large the warc file is.
+
+    If an insert fails, then no later batch is inserted,
+    and the writer thread's exception is re-raised in the calling thread.
+    '''
+    if max_pending is None:
+        max_pending = 2*workers
+
+    # the writer thread is the only user of the connection while the pool is running;
+    # after an insert fails, the writer keeps emptying the queue without inserting,
+    # so that the main thread never blocks on a full queue
+    write_queue = queue.Queue(maxsize=max_pending)
+    writer_errors = []
+    def writer():
+        while True:
+            item = write_queue.get()
+            if item is None:
+                break
+            if len(writer_errors) > 0:
+                continue
+            batch, checkpoint = item
+            try:
+                ingest.bulk_insert(connection, batch, loader=loader, dedup=dedup, checkpoint=dict(checkpoint, id=id_source))
+            except Exception as e:
+                writer_errors.append(e)
+    writer_thread = threading.Thread(target=writer)
+    writer_thread.start()
+
+    def write(item):
+        if len(writer_errors) > 0:
+            raise writer_errors[0]
+        write_queue.put(item)
 
-        # for efficiency, we will not insert items into the db one at a time;
-        # instead, we add them to the batch list,
-        # and then bulk insert the batch list when it reaches len(batch)==batch_size
-        batch = []
-
-        for record in ArchiveIterator(stream):
-
-            # WARC files contain many entries;
-            # we only care about HTTP200 status code responses
-            if record.rec_type == 'response':
-
-                # extract the information from the warc archive
-                url = record.rec_headers.get_header('WARC-Target-URI')
-                accessed_at = record.rec_headers.get_header('WARC-Date')
-                html = record.content_stream().read()
-                logging.debug("url="+url)
-
-                # extract the meta
-                try:
-                    meta = metahtml.parse(html, url)
-                    try:
-                        pspacy_title = pspacy.lemmatize(meta['language']['best']['value'], meta['title']['best']['value'])
-                        pspacy_content = pspacy.lemmatize(meta['language']['best']['value'], meta['title']['best']['value'])
-                    except TypeError:
-                        pspacy_title = None
-                        pspacy_content = None
-
-                # if there was an error in metahtml, log it
-                except Exception as e:
-                    logging.warning('url='+url+' exception='+str(e))
-                    meta = { 
-                        'exception' : {
-                            'str(e)' : str(e),
-                            'type' : type(e).__name__,
-                            'location' : 'metahtml',
-                            'traceback' : traceback.format_exc()
-                            }
-                        }
-                    pspacy_title = None
-                    pspacy_content = None
-
-                # add the results to the batch
-                meta_json = json.dumps(meta, default=str)
-                batch.append({
-                    'accessed_at' : accessed_at,
-                    'id_source' : id_source,
-                    'url' : url,
-                    'jsonb' : meta_json,
-                    'pspacy_title' : pspacy_title,
-                    'pspacy_content' : pspacy_content
-                    })
-
-            # bulk insert the batch
-            if len(batch)>=batch_size:
-                bulk_insert(batch)
-                batch = []
-
-        # we have finished looping over the archive;
-        # we should bulk insert everything in the batch list that hasn't been inserted
-        if len(batch)>0:
-            bulk_insert(batch)
-
-
-def bulk_insert(batch):
     try:
-        logging.info('bulk_insert '+str(len(batch))+' rows')
-        keys = ['accessed_at', 'id_source', 'url', 'jsonb']
-        sql = sqlalchemy.sql.text(
-            'INSERT INTO metahtml ('+','.join(keys)+',title,content) VALUES'+
-            ','.join(['(' + ','.join([f':{key}{i}' for key in keys]) + f",to_tsvector('simple',:pspacy_title{i}),to_tsvector('simple',:pspacy_content{i})" + ')' for i in range(len(batch))])
-            )
-        res = connection.execute(sql,{
-            key+str(i) : d[key]
-            for key in keys + ['pspacy_title','pspacy_content']
-            for i,d in enumerate(batch)
-            })
-    except Exception as e:
-        logging.error('failed to insert:'+str(e))
-        pass
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            pending = collections.deque()
+            for raw_batch, checkpoint in raw_batches:
+                pending.append((pool.submit(ingest.process_raw_batch, raw_batch, id_source), checkpoint))
+                if len(pending) >= max_pending:
+                    future, checkpoint = pending.popleft()
+                    write((future.result(), checkpoint))
+            while len(pending) > 0:
+                future, checkpoint = pending.popleft()
+                write((future.result(), checkpoint))
+    finally:
+        write_queue.put(None)
+        writer_thread.join()
+    if len(writer_errors) > 0:
+        raise writer_errors[0]
+
+
+def iter_raw_batches(stream, batch_size, records=0):
+    '''
+    Yields (raw_batch, checkpoint) pairs from the warc stream.
+
+    Each raw_batch is a list of at most batch_size (url, accessed_at, html) tuples;
+    the tuples contain only plain python values so that they can be sent to worker processes.
+    Each checkpoint is a dict containing the byte offset in the warc file of the first record after raw_batch
+    and the total number of response records up to and including raw_batch;
+    reading can be restarted from the checkpoint's offset without repeating any records.
+    '''
+    raw_batch = []
+    archive_iterator = ArchiveIterator(stream)
+    for record in archive_iterator:
+
+        # WARC files contain many entries;
+        # we only care about HTTP200 status code responses
+        if record.rec_type == 'response':
+
+            # extract the information from the warc archive
+            url = record.rec_headers.get_header('WARC-Target-URI')
+            accessed_at = record.rec_headers.get_header('WARC-Date')
+            html = record.content_stream().read()
+            logging.debug("url="+url)
+            raw_batch.append((url, accessed_at, html))
+            records += 1
+
+        if len(raw_batch)>=batch_size:
+            archive_iterator.read_to_end(record)
+            yield raw_batch, {'offset': archive_iterator.offset, 'records': records}
+            raw_batch = []
+
+    # we have finished looping over the archive;
+    # we should yield everything in the batch that hasn't been yielded
+    if len(raw_batch)>0:
+        yield raw_batch, {'offset': archive_iterator.offset, 'records': records}
 
 
 if __name__ == '__main__':
@@ -170,8 +463,17 @@ if __name__ == '__main__':
     Insert the warc file into the database.
     ''')
     parser.add_argument('--warc', help='warc file to insert into the db; may be either a file path or a url')
-    parser.add_argument('--cc_url') 
+    parser.add_argument('--cc_url', help='gzipped list of warc files to insert into the db')
+    parser.add_argument('--enqueue', action='store_true', help='add the warc files in --cc_url to the warc_queue table instead of processing them')
+    parser.add_argument('--queue_worker', action='store_true', help='process warc files from the warc_queue table until it is empty')
+    parser.add_argument('--claim_timeout', type=int, default=60*60, help='seconds before an unfinished claim on a warc_queue job expires')
     parser.add_argument('--db', default='postgresql:///')
+    parser.add_argument('--batch_size', type=int, default=100)
+    parser.add_argument('--loader', choices=['insert', 'copy'], default='insert', help='the copy loader is faster and supports batch sizes in the thousands')
+    parser.add_argument('--dedup', choices=['off', 'link', 'skip'], default='off', help='skip near-duplicate documents, or link them to their canonical row')
+    parser.add_argument('--stream', action='store_true', help='process the warc file while it downloads instead of saving it to disk first')
+    parser.add_argument('--read_ahead', type=int, default=16, help='number of 1MB chunks to buffer in --stream mode')
+    parser.add_argument('--workers', type=int, default=0, help='number of worker processes for parsing and lemmatization; 0 processes everything in the current process')
     args = parser.parse_args()
 
     import logging
@@ -184,5 +486,20 @@ if __name__ == '__main__':
         })  
     connection = engine.connect()
 
+    kwargs = {
+        'batch_size' : args.batch_size,
+        'workers' : args.workers,
+        'loader' : args.loader,
+        'dedup' : args.dedup,
+        'stream' : args.stream,
+        'read_ahead' : args.read_ahead,
+        }
     if args.warc:
-        process_warc_from_url(connection,args.warc)
+        process_warc_from_url(connection, args.warc, **kwargs)
+    if args.cc_url:
+        if args.enqueue:
+            enqueue_warcs_from_url(connection, args.cc_url)
+        else:
+            process_all_warcs_from_url(connection, args.cc_url, **kwargs)
+    if args.queue_worker:
+        process_warcs_from_queue(connection, claim_timeout=args.claim_timeout, **kwargs)
@@ -0,0 +1,196 @@
+'''
+Near-duplicate detection for the loaders.
+
+Every document gets a 64 bit SimHash computed from its content lemmas;
+documents whose SimHashes differ in at most max_distance bits are considered near-duplicates.
+The SimHash is split into 5 blocks of 12 or 13 bits,
+and every pair of blocks is combined into a key of 25 or 26 bits,
+so each SimHash has 10 keys (see simhash_keys in schema.sql, which has a GIN index).
+Two SimHashes within 3 bits of each other differ in at most 3 blocks,
+so they agree on at least 2 blocks and share at least one key,
+and looking up the rows that share a key finds every near-duplicate.
+The keys are wide enough that a key matches only about N/2**26 of the N rows in the table,
+which keeps the number of candidate rows small as the table grows.
+'''
+import collections
+import hashlib
+import itertools
+import logging
+import sqlalchemy
+
+# the (offset, width) of each block of the SimHash, and the pairs of blocks that form the keys
+BLOCKS = [(0, 13), (13, 13), (26, 13), (39, 13), (52, 12)]
+KEY_PAIRS = list(itertools.combinations(range(len(BLOCKS)), 2))
+KEY_BITS = 26
+
+
+def simhash(lemmas):
+    '''
+    Returns the 64 bit SimHash of the lemmas string produced by pspacy.lemmatize,
+    as a signed integer so that it fits in a postgres BIGINT;
+    returns None if there are no lemmas.
+    The positions that pspacy appends to each lemma are ignored.
+
+    >>> simhash('abraham:1 lincoln:2 president:4') == simhash('abraham:3 lincoln:4 president:9')
+    True
+    >>> simhash('') is None and simhash(None) is None
+    True
+    >>> hamming_distance(simhash(' '.join(f'word{i}:{i}' for i in range(100))), simhash(' '.join(f'word{i}:{i}' for i in range(101)))) <= 3
+    True
+    >>> hamming_distance(simhash(' '.join(f'word{i}:{i}' for i in range(100))), simhash(' '.join(f'other{i}:{i}' for i in range(100)))) > 3
+    True
+    '''
+    if lemmas is None:
+        return None
+    features = collections.Counter(token.rsplit(':', 1)[0] for token in lemmas.split())
+    if len(features) == 0:
+        return None
+
+    weights = [0] * 64
+    for feature, count in features.items():
+        h = int.from_bytes(hashlib.blake2b(feature.encode('utf-8'), digest_size=8).digest(), 'little')
+        for bit in range(64):
+            if h >> bit & 1:
+                weights[bit] += count
+            else:
+                weights[bit] -= count
+
+    value = 0
+    for bit in range(64):
+        if weights[bit] > 0:
+            value |= 1 << bit
+    if value >= 1 << 63:
+        value -= 1 << 64
+    return value
+
+
+def hamming_distance(a, b):
+    '''
+    >>> hamming_distance(0, -1)
+    64
+    >>> hamming_distance(5, 6)
+    2
+    '''
+    return bin((a ^ b) & 0xFFFFFFFFFFFFFFFF).count('1')
+
+
+def keys(value):
+    '''
+    Returns the lookup keys of a SimHash;
+    these match the simhash_keys function in schema.sql.
+    The index of the pair of blocks is stored above the blocks,
+    so keys from different pairs never collide.
+
+    >>> keys(-1)
+    [67108863, 134217727, 201326591, 234881023, 335544319, 402653183, 436207615, 536870911, 570425343, 637534207]
+    >>> keys(0x0001000200030004)
+    [196612, 68157444, 138412036, 201326596, 269484056, 339738648, 402653208, 473956480, 536871040, 603980288]
+
+    Every near-duplicate shares a key.
+
+    >>> all(set(keys(12345)) & set(keys(12345 ^ (1 << a) ^ (1 << b) ^ (1 << c))) for a in range(0, 64, 5) for b in range(1, 64, 7) for c in range(2, 64, 11))
+    True
+    '''
+    results = []
+    for pair, (a, b) in enumerate(KEY_PAIRS):
+        offset_a, width_a = BLOCKS[a]
+        offset_b, width_b = BLOCKS[b]
+        block_a = (value >> offset_a) & ((1 << width_a) - 1)
+        block_b = (value >> offset_b) & ((1 << width_b) - 1)
+        results.append((pair << KEY_BITS) | block_a | (block_b << width_a))
+    return results
+
+
+def add_simhashes(batch):
+    '''
+    Adds the simhash entry to every row of the batch from its pspacy_content entry.
+    '''
+    for row in batch:
+        row['simhash'] = simhash(row.get('pspacy_content'))
+
+
+def dedup_batch(connection, batch, mode='off', max_distance=3):
+    '''
+    Finds the near-duplicates of each row in the batch,
+    both in the metahtml table and earlier in the same batch,
+    and returns the rows that should be inserted.
+    The keys guarantee that every near-duplicate is found only when max_distance<=3.
+
+    When mode='skip', the near-duplicates are removed from the batch.
+    When mode='link', every row is inserted,
+    and the id_canonical of a near-duplicate is set to the canonical id of the row that it duplicates.
+    A row that duplicates an earlier row of the same batch needs that row's id before the batch is inserted,
+    so in that case the ids of the whole batch are taken from metahtml's sequence and stored in the id entry of every row.
+    When mode='off', no lookups happen, and every row is inserted with id_canonical=None.
+    '''
+    for row in batch:
+        if 'simhash' not in row:
+            row['simhash'] = simhash(row.get('pspacy_content'))
+        row['id_canonical'] = None
+    if mode == 'off':
+        return batch
+
+    # find all rows in the table that share a key with some row in the batch;
+    # the canonical of a candidate is either the id of a row in the table or an earlier row of the batch
+    hashes = [ row['simhash'] for row in batch if row['simhash'] is not None ]
+    if len(hashes) == 0:
+        return batch
+    sql = sqlalchemy.sql.text('''
+    SELECT id, simhash, id_canonical FROM metahtml WHERE simhash_keys(simhash) && CAST(:keys AS INTEGER[])
+    ''')
+    candidates = collections.defaultdict(list)
+    batch_keys = list(set(key for h in hashes for key in keys(h)))
+    for id, candidate, id_canonical in connection.execute(sql, {'keys': batch_keys}):
+        for key in keys(candidate):
+            candidates[key].append((candidate, id_canonical if id_canonical is not None else id))
+
+    results = []
+    batch_links = []
+    skipped = 0
+    linked = 0
+    for row in batch:
+        h = row['simhash']
+        if h is None:
+            results.append(row)
+            continue
+
+        match = None
+        for key in keys(h):
+            for candidate, canonical in candidates[key]:
+                if hamming_distance(h, candidate) <= max_distance:
+                    match = canonical
+                    break
+            if match is not None:
+                break
+
+        if match is not None and mode == 'skip':
+            skipped += 1
+            continue
+        if match is None:
+            canonical = row
+        elif isinstance(match, dict):
+            batch_links.append((row, match))
+            canonical = match
+            linked += 1
+        else:
+            row['id_canonical'] = match
+            canonical = match
+            linked += 1
+        results.append(row)
+
+        # later rows in the batch are compared against this row as well
+        for key in keys(h):
+            candidates[key].append((h, canonical))
+
+    if len(batch_links) > 0:
+        sql = sqlalchemy.sql.text('''
+        SELECT nextval(pg_get_serial_sequence('metahtml', 'id')) FROM generate_series(1, :n)
+        ''')
+        ids = [ id for id, in connection.execute(sql, {'n': len(results)}) ]
+        for row, id in zip(results, ids):
+            row['id'] = id
+        for row, canonical in batch_links:
+            row['id_canonical'] = canonical['id']
+
+    logging.info('dedup_batch mode='+mode+' rows='+str(len(batch))+' skipped='+str(skipped)+' linked='+str(linked))
+    return results
@@ -0,0 +1,332 @@
+'''
+Converts the raw records of a crawl into rows of the metahtml table and inserts them.
+The warc loader (downloader_warc.py) and the cdx loader (downloader_host.py) share this module,
+so that both insert exactly the same rows;
+downloader_host.sh stages it into the downloader_host build context.
+'''
+import datetime
+import io
+import json
+import logging
+import re
+import time
+import traceback
+from html import unescape
+import sqlalchemy
+import metahtml
+import pspacy
+import fingerprint
+import urlkeys
+
+
+def process_raw_batch(raw_batch, id_source):
+    '''
+    Converts a list of (url, accessed_at, html) tuples into rows for bulk_insert.
+    '''
+    batch = [ process_raw_record(url, accessed_at, html, id_source) for url, accessed_at, html in raw_batch ]
+    lemmatize_batch(batch)
+    fingerprint.add_simhashes(batch)
+    urlkeys.add_url_keys(batch)
+    return batch
+
+
+def process_raw_record(url, accessed_at, html, id_source):
+    '''
+    Extracts the meta information from a single record;
+    the lemmatization happens later in lemmatize_batch for the whole batch at once.
+    '''
+    try:
+        meta = metahtml.parse(html, url)
+
+    # if there was an error in metahtml, log it
+    except Exception as e:
+        logging.warning('url='+url+' exception='+str(e))
+        meta = { 
+            'exception' : {
+                'str(e)' : str(e),
+                'type' : type(e).__name__,
+                'location' : 'metahtml',
+                'traceback' : traceback.format_exc()
+                }
+            }
+
+    meta_json = json.dumps(meta, default=str)
+    return {
+        'accessed_at' : accessed_at,
+        'id_source' : id_source,
+        'url' : url,
+        'jsonb' : meta_json,
+        **extract_columns(meta),
+        'content_text' : extract_content_text(meta),
+        'snippet_words' : extract_snippet(meta),
+        }
+
+
+def extract_columns(meta):
+    '''
+    Returns the fields of meta that are stored in their own columns of the metahtml table,
+    so that queries do not need to read the jsonb column;
+    missing fields are None.
+
+    >>> extract_columns({'language': {'best': {'value': 'en'}}, 'title': None, 'timestamp.published': {'best': {'value': {'lo': '2020-12-09T10:30:00Z'}}}})
+    {'language': 'en', 'timestamp_published': datetime.datetime(2020, 12, 9, 10, 30, tzinfo=datetime.timezone.utc), 'title_text': None, 'description': None, 'type': None}
+    >>> extract_columns({'exception': {}})['timestamp_published'] is None
+    True
+    '''
+    def best_value(key):
+        try:
+            return meta[key]['best']['value']
+        except (TypeError, KeyError):
+            return None
+
+    try:
+        timestamp_published = best_value('timestamp.published')['lo']
+    except (TypeError, KeyError):
+        timestamp_published = None
+
+    return {
+        'language' : best_value('language'),
+        'timestamp_published' : parse_timestamp(timestamp_published),
+        'title_text' : best_value('title'),
+        'description' : best_value('description'),
+        'type' : best_value('type'),
+        }
+
+
+def extract_snippet(meta, max_words=50):
+    '''
+    Returns a list of the first max_words words of the description followed by the text of the content;
+    the search results display these words as a snippet of the document.
+    Storing a bounded snippet in its own column means that the search results never read the jsonb column.
+
+    >>> extract_snippet({'description': {'best': {'value': 'A short summary.'}}, 'content': {'best': {'value': {'html': '<p>The first&nbsp;paragraph.</p><p>The <b>second</b> one.</p>'}}}}, max_words=7)
+    ['A', 'short', 'summary.', 'The', 'first', 'paragraph.', 'The']
+    >>> extract_snippet({'exception': {}})
+    []
+    '''
+    words = []
+    try:
+        words.extend(meta['description']['best']['value'].split())
+    except (TypeError, KeyError, AttributeError):
+        pass
+    content_text = extract_content_text(meta)
+    if content_text is not None:
+        words.extend(content_text.split())
+    return words[:max_words]
+
+
+def extract_content_text(meta):
+    '''
+    Returns the text of the content's html with the tags removed, or None if metahtml found no content.
+
+    >>> extract_content_text({'content': {'best': {'value': {'html': '<p>Fish&amp;chips</p>'}}}})
+    ' Fish&chips '
+    >>> extract_content_text({'exception': {}}) is None
+    True
+    '''
+    try:
+        content = meta['content']['best']['value']['html']
+        return unescape(re.sub(r'<[^>]*>', ' ', content))
+    except (TypeError, KeyError):
+        return None
+
+
+def parse_timestamp(value):
+    '''
+    Converts a timestamp from metahtml into a datetime;
+    unparseable timestamps become None instead of failing the insert of the whole batch.
+
+    >>> parse_timestamp('2020-12-09 10:30:00+00:00')
+    datetime.datetime(2020, 12, 9, 10, 30, tzinfo=datetime.timezone.utc)
+    >>> parse_timestamp('yesterday') is None
+    True
+    '''
+    if isinstance(value, datetime.datetime):
+        return value
+    if isinstance(value, str):
+        if value.endswith('Z'):
+            value = value[:-1] + '+00:00'
+        try:
+            return datetime.datetime.fromisoformat(value)
+        except ValueError:
+            return None
+    return None
+
+
+def lemmatize_batch(batch):
+    '''
+    Adds the pspacy_title and pspacy_content entries to every row in the batch;
+    pspacy_content is computed from the content_text entry, which is removed from the row.
+    All of the texts in the batch get passed to pspacy.lemmatize_many together,
+    which is much faster than lemmatizing each row individually.
+
+    Also replaces the snippet_words entry with the snippet and snippet_lemmas entries;
+    snippet is the words joined by spaces, and snippet_lemmas contains the lemmas of each word
+    (see pspacy.lemmatize_words_many) joined by spaces,
+    so that the web app can highlight the words of the snippet that match a query's lemmas.
+    '''
+    pairs = []
+    for row in batch:
+        pairs.append((row['language'], row['title_text']))
+        pairs.append((row['language'], row.pop('content_text')))
+    lemmas = pspacy.lemmatize_many(pairs, batch_size=len(pairs))
+    for row in batch:
+        row['pspacy_title'] = next(lemmas)
+        row['pspacy_content'] = next(lemmas)
+
+    snippet_lemmas = pspacy.lemmatize_words_many([ (row['language'], row['snippet_words']) for row in batch ], batch_size=len(batch))
+    for row, word_lemmas in zip(batch, snippet_lemmas):
+        words = row.pop('snippet_words')
+        row['snippet'] = ' '.join(words) if len(words) > 0 else None
+        row['snippet_lemmas'] = ' '.join(word_lemmas) if row['snippet'] is not None and word_lemmas is not None else None
+
+
+def bulk_insert(connection, batch, loader='insert', dedup='off', checkpoint=None):
+    '''
+    Inserts the rows in batch into the metahtml table.
+
+    There are two loaders:
+    the 'insert' loader builds a single multi-VALUES INSERT statement for the whole batch,
+    and the 'copy' loader streams the batch into a staging table with COPY.
+    The 'copy' loader avoids parsing and planning a large statement for every batch,
+    and so it supports much larger batch sizes.
+    The rows/sec of each batch are logged so that the loaders can be compared.
+
+    If checkpoint is not None, then the source table's checkpoint is updated
+    in the same transaction as the insert,
+    so that a restarted loader never loses or duplicates rows.
+
+    The near-duplicate lookup happens in the same transaction as the insert;
+    see fingerprint.dedup_batch for the meaning of dedup.
+
+    If the insert fails, then the error is logged and re-raised;
+    the transaction rolls back, so the checkpoint stays at the last committed batch,
+    and the loader stops instead of checkpointing later batches past the lost rows.
+    '''
+    try:
+        start = time.time()
+
+        # the partitions are created in their own transaction,
+        # so that other loaders do not wait on the new partition's locks while this batch inserts
+        with connection.begin():
+            sql = sqlalchemy.sql.text('''
+            SELECT metahtml_create_partitions(CAST(:accessed_ats AS TIMESTAMPTZ[]));
+            ''')
+            connection.execute(sql, {'accessed_ats': [ row['accessed_at'] for row in batch ]})
+
+        with connection.begin():
+            batch = fingerprint.dedup_batch(connection, batch, mode=dedup)
+            if len(batch) == 0:
+                pass
+            elif loader == 'copy':
+                bulk_insert_copy(connection, batch)
+            else:
+                bulk_insert_values(connection, batch)
+            if checkpoint is not None:
+                sql = sqlalchemy.sql.text('''
+                UPDATE source SET checkpoint_offset=:offset, checkpoint_records=:records WHERE id=:id;
+                ''')
+                connection.execute(sql, checkpoint)
+        elapsed = time.time() - start
+        logging.info('bulk_insert '+str(len(batch))+' rows; loader='+loader+' seconds={:0.3f} rows/sec={:0.1f}'.format(elapsed, len(batch)/max(elapsed,1e-9)))
+    except Exception as e:
+        logging.error('failed to insert:'+str(e))
+        raise
+
+
+def bulk_insert_values(connection, batch):
+    # dedup_batch sets the ids of the rows when it links rows to earlier rows of the same batch
+    id_keys = ['id'] if 'id' in batch[0] else []
+    keys = id_keys + ['accessed_at', 'id_source', 'url', 'host_key', 'hostpath_key', 'hostpathquery_key', 'jsonb', 'language', 'timestamp_published', 'title_text', 'description', 'snippet', 'snippet_lemmas', 'type', 'simhash', 'id_canonical']
+    sql = sqlalchemy.sql.text(
+        'INSERT INTO metahtml ('+','.join(keys)+',title,content) VALUES'+
+        ','.join(['(' + ','.join([f':{key}{i}' for key in keys]) + f",to_tsvector('simple',:pspacy_title{i}),to_tsvector('simple',:pspacy_content{i})" + ')' for i in range(len(batch))])
+        )
+    res = connection.execute(sql,{
+        key+str(i) : d[key]
+        for key in keys + ['pspacy_title','pspacy_content']
+        for i,d in enumerate(batch)
+        })
+
+
+def copy_text(value):
+    r'''
+    Formats value as a field of COPY's text format.
+    None is written as \N, which COPY reads as NULL;
+    the csv format cannot be used because csv.QUOTE_NONNUMERIC writes None as a quoted empty field,
+    which COPY reads as an empty string.
+
+    >>> print(copy_text(None), copy_text(''), copy_text(12), copy_text('a\tb\\c\nd'))
+    \N  12 a\tb\\c\nd
+    '''
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def bulk_insert_copy(connection, batch):
+    '''
+    Must be called inside of a transaction.
+    The staging table is created with ON COMMIT DROP inside the same transaction as the insert,
+    so this works even when pgbouncer is in transaction pooling mode.
+    '''
+    # dedup_batch sets the ids of the rows when it links rows to earlier rows of the same batch
+    id_keys = ['id'] if 'id' in batch[0] else []
+    id_column = 'id,' if 'id' in batch[0] else ''
+    keys = id_keys + ['accessed_at', 'id_source', 'url', 'host_key', 'hostpath_key', 'hostpathquery_key', 'jsonb', 'language', 'timestamp_published', 'title_text', 'description', 'snippet', 'snippet_lemmas', 'type', 'simhash', 'id_canonical', 'pspacy_title', 'pspacy_content']
+
+    buf = io.StringIO()
+    for d in batch:
+        buf.write('\t'.join(copy_text(d[key]) for key in keys) + '\n')
+    buf.seek(0)
+
+    cursor = connection.connection.cursor()
+    cursor.execute('''
+    CREATE TEMPORARY TABLE metahtml_staging (
+        id BIGINT,
+        accessed_at TIMESTAMPTZ,
+        id_source INTEGER,
+        url TEXT,
+        host_key TEXT,
+        hostpath_key TEXT,
+        hostpathquery_key TEXT,
+        jsonb JSONB,
+        language TEXT,
+        timestamp_published TIMESTAMPTZ,
+        title_text TEXT,
+        description TEXT,
+        snippet TEXT,
+        snippet_lemmas TEXT,
+        type TEXT,
+        simhash BIGINT,
+        id_canonical BIGINT,
+        pspacy_title TEXT,
+        pspacy_content TEXT
+    ) ON COMMIT DROP;
+    ''')
+    cursor.copy_expert('COPY metahtml_staging ('+','.join(keys)+') FROM STDIN', buf)
+    cursor.execute(f'''
+    INSERT INTO metahtml ({id_column}accessed_at,id_source,url,host_key,hostpath_key,hostpathquery_key,jsonb,language,timestamp_published,title_text,description,snippet,snippet_lemmas,type,simhash,id_canonical,title,content)
+    SELECT
+        {id_column}
+        accessed_at,
+        id_source,
+        url,
+        host_key,
+        hostpath_key,
+        hostpathquery_key,
+        jsonb,
+        language,
+        timestamp_published,
+        title_text,
+        description,
+        snippet,
+        snippet_lemmas,
+        type,
+        simhash,
+        id_canonical,
+        to_tsvector('simple',pspacy_title),
+        to_tsvector('simple',pspacy_content)
+    FROM metahtml_staging;
+    ''')
+    cursor.close()
@@ -0,0 +1,79 @@
+import pytest
+import contextlib
+import io
+import re
+from warcio.statusandheaders import StatusAndHeaders
+from warcio.warcwriter import WARCWriter
+
+# the sys import is needed so that we can import from the current project
+import sys
+sys.path.append('.')
+import downloader_warc
+
+
+class FakeConnection:
+    '''
+    A stand-in for a connection to the database that only understands the statements of ingest.bulk_insert.
+    It keeps the urls of the inserted rows and the source's checkpoint,
+    and both are committed or rolled back with the transaction.
+    The insert number fail_insert raises an error, like a failed statement would.
+    '''
+    def __init__(self, fail_insert=None):
+        self.fail_insert = fail_insert
+        self.inserts = 0
+        self.urls = []
+        self.checkpoint = {'offset': 0, 'records': 0}
+        self.transaction = None
+
+    @contextlib.contextmanager
+    def begin(self):
+        self.transaction = {'urls': [], 'checkpoint': None}
+        try:
+            yield
+            self.urls.extend(self.transaction['urls'])
+            if self.transaction['checkpoint'] is not None:
+                self.checkpoint = self.transaction['checkpoint']
+        finally:
+            self.transaction = None
+
+    def execute(self, sql, params):
+        sql = str(sql)
+        if 'INSERT INTO metahtml' in sql:
+            self.inserts += 1
+            if self.inserts == self.fail_insert:
+                raise RuntimeError('insert failed')
+            self.transaction['urls'].extend(value for key, value in params.items() if re.fullmatch(r'url\d+', key))
+        elif 'UPDATE source SET checkpoint_offset' in sql:
+            self.transaction['checkpoint'] = {'offset': params['offset'], 'records': params['records']}
+
+
+@pytest.fixture
+def warc_path(tmp_path):
+    path = tmp_path / 'sample.warc.gz'
+    with open(path, 'wb') as f:
+        writer = WARCWriter(f, gzip=True)
+        for i in range(35):
+            html = f'<html><head><title>page {i}</title></head></html>'.encode()
+            http_headers = StatusAndHeaders('200 OK', [('Content-Type', 'text/html')], protocol='HTTP/1.1')
+            record = writer.create_warc_record(f'https://example.com/{i}', 'response', payload=io.BytesIO(html), http_headers=http_headers)
+            writer.write_record(record)
+    return path
+
+
+@pytest.mark.parametrize('workers', [0, 2])
+def test_resume_after_failed_insert(warc_path, workers):
+    urls = [ f'https://example.com/{i}' for i in range(35) ]
+
+    # the second batch fails, so the loader stops with only the first batch committed
+    connection = FakeConnection(fail_insert=2)
+    with pytest.raises(RuntimeError):
+        downloader_warc.process_warc_from_disk(connection, str(warc_path), 1, batch_size=10, workers=workers)
+    assert sorted(connection.urls) == sorted(urls[:10])
+    assert connection.checkpoint['records'] == 10
+
+    # resuming from the checkpoint inserts exactly the missing rows
+    connection.fail_insert = None
+    checkpoint = connection.checkpoint
+    downloader_warc.process_warc_from_disk(connection, str(warc_path), 1, offset=checkpoint['offset'], records=checkpoint['records'], batch_size=10, workers=workers)
+    assert sorted(connection.urls) == sorted(urls)
+    assert connection.checkpoint == {'offset': warc_path.stat().st_size, 'records': 35}
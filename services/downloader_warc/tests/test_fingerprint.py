@@ -0,0 +1,100 @@
+import pytest
+
+# the sys import is needed so that we can import from the current project
+import sys
+sys.path.append('.')
+import fingerprint
+import ingest
+
+
+class TableConnection:
+    '''
+    Answers the key lookup in fingerprint.dedup_batch from a list of (id, simhash, id_canonical) rows,
+    the same way that the simhash_keys index in schema.sql does;
+    the ids taken from the sequence start at 100.
+    '''
+    def __init__(self, rows):
+        self.rows = rows
+        self.queries = 0
+        self.next_id = 100
+
+    def execute(self, sql, params):
+        self.queries += 1
+        if 'nextval' in str(sql):
+            ids = [ (self.next_id + i,) for i in range(params['n']) ]
+            self.next_id += params['n']
+            return ids
+        return [
+            row for row in self.rows
+            if set(fingerprint.keys(row[1])) & set(params['keys'])
+            ]
+
+
+def make_row(words):
+    return {'pspacy_content': ' '.join(f'{word}:{i}' for i, word in enumerate(words))}
+
+
+words = [ f'word{i}' for i in range(200) ]
+other_words = [ f'other{i}' for i in range(200) ]
+
+
+@pytest.mark.parametrize('mode', ['off', 'link', 'skip'])
+def test_dedup_batch(mode):
+    existing = fingerprint.simhash(make_row(words)['pspacy_content'])
+    connection = TableConnection([(1, existing, None), (2, existing, 1)])
+    batch = [
+        make_row(words[:-1]),           # near-duplicate of the table
+        make_row(other_words),          # new
+        make_row(other_words[1:]),      # near-duplicate of the previous row in the batch
+        {'pspacy_content': None},       # no fingerprint
+        ]
+    results = fingerprint.dedup_batch(connection, batch, mode=mode)
+
+    if mode == 'off':
+        assert connection.queries == 0
+        assert len(results) == 4
+        assert all(row['id_canonical'] is None for row in results)
+    if mode == 'link':
+        assert len(results) == 4
+        assert [ row['id'] for row in results ] == [100, 101, 102, 103]
+        assert [ row['id_canonical'] for row in results ] == [1, None, 101, None]
+    if mode == 'skip':
+        assert results == [batch[1], batch[3]]
+    assert all('simhash' in row for row in results)
+    assert batch[3]['simhash'] is None
+
+
+def test_dedup_batch_empty():
+    connection = TableConnection([])
+    assert fingerprint.dedup_batch(connection, [{'pspacy_content': ''}], mode='skip') == [{'pspacy_content': '', 'simhash': None, 'id_canonical': None}]
+    assert connection.queries == 0
+
+
+def test_dedup_same_title():
+    def html(words):
+        return f'<html><head><title>Breaking news</title></head><body><p>{" ".join(words)}</p></body></html>'.encode()
+    raw_batch = [
+        ('https://example.com/1', '2021-01-01', html(words)),
+        ('https://example.com/2', '2021-01-01', html(other_words)),    # same title, different content
+        ('https://example.com/3', '2021-01-01', html(words[:-1])),     # near-duplicate of the first row
+        ]
+    batch = ingest.process_raw_batch(raw_batch, 1)
+    results = fingerprint.dedup_batch(TableConnection([]), batch, mode='skip')
+    assert [ row['url'] for row in results ] == ['https://example.com/1', 'https://example.com/2']
+
+
+def test_dedup_batch_link_chain():
+    # the third row duplicates the second, which duplicates the first, so both link to the first
+    connection = TableConnection([])
+    batch = [ make_row(words), make_row(words[1:]), make_row(words[2:]) ]
+    results = fingerprint.dedup_batch(connection, batch, mode='link')
+    assert [ row['id_canonical'] for row in results ] == [None, 100, 100]
+
+
+def test_dedup_batch_no_batch_links():
+    # without links inside of the batch, the ids are left to the table's default
+    existing = fingerprint.simhash(make_row(words)['pspacy_content'])
+    connection = TableConnection([(1, existing, None)])
+    results = fingerprint.dedup_batch(connection, [make_row(words[:-1]), make_row(other_words)], mode='link')
+    assert [ row['id_canonical'] for row in results ] == [1, None]
+    assert all('id' not in row for row in results)
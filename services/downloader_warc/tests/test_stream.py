@@ -0,0 +1,104 @@
+import pytest
+import functools
+import http.server
+import io
+import threading
+from warcio.statusandheaders import StatusAndHeaders
+from warcio.warcwriter import WARCWriter
+
+# the sys import is needed so that we can import from the current project
+import sys
+sys.path.append('.')
+import downloader_warc
+
+
+@pytest.fixture
+def warc_path(tmp_path):
+    '''
+    Writes a small gzipped warc file with a mix of response and request records.
+    '''
+    path = tmp_path / 'sample.warc.gz'
+    with open(path, 'wb') as f:
+        writer = WARCWriter(f, gzip=True)
+        for i in range(250):
+            url = f'https://example.com/{i}'
+            html = f'<html><head><title>page {i}</title></head><body>{"text "*i}</body></html>'.encode()
+            http_headers = StatusAndHeaders('200 OK', [('Content-Type', 'text/html')], protocol='HTTP/1.1')
+            record = writer.create_warc_record(url, 'response', payload=io.BytesIO(html), http_headers=http_headers)
+            writer.write_record(record)
+            record = writer.create_warc_record(url, 'request', payload=io.BytesIO(b'GET / HTTP/1.1\r\n\r\n'))
+            writer.write_record(record)
+    return path
+
+
+@pytest.fixture
+def warc_url(warc_path):
+    '''
+    Serves the directory containing warc_path with a local http server.
+    '''
+    handler = functools.partial(http.server.SimpleHTTPRequestHandler, directory=str(warc_path.parent))
+    server = http.server.ThreadingHTTPServer(('localhost', 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://localhost:{server.server_port}/{warc_path.name}'
+    server.shutdown()
+    server.server_close()
+
+
+def read_raw_batches(stream, records=0):
+    return list(downloader_warc.iter_raw_batches(stream, batch_size=100, records=records))
+
+
+def test_stream_url_matches_disk(warc_path, warc_url):
+    with open(warc_path, 'rb') as f:
+        expected = read_raw_batches(f)
+    with downloader_warc.open_warc_stream(warc_url, chunk_size=4096, read_ahead=2) as stream:
+        actual = read_raw_batches(stream)
+    assert [len(batch) for batch, checkpoint in expected] == [100, 100, 50]
+    assert [checkpoint['records'] for batch, checkpoint in expected] == [100, 200, 250]
+    assert expected[-1][1]['offset'] == warc_path.stat().st_size
+    assert actual == expected
+
+
+@pytest.mark.parametrize('use_url', [False, True])
+def test_resume_from_checkpoint(warc_path, warc_url, use_url):
+    with open(warc_path, 'rb') as f:
+        expected = read_raw_batches(f)
+
+    # restarting from each checkpoint yields exactly the batches after that checkpoint
+    for i, (batch, checkpoint) in enumerate(expected):
+        source = warc_url if use_url else str(warc_path)
+        with downloader_warc.open_warc_stream(source, offset=checkpoint['offset'], chunk_size=4096) as stream:
+            actual = read_raw_batches(stream, records=checkpoint['records'])
+        assert actual == expected[i+1:]
+
+
+def test_stream_path_matches_disk(warc_path):
+    with open(warc_path, 'rb') as f:
+        expected = read_raw_batches(f)
+    with downloader_warc.open_warc_stream(str(warc_path), chunk_size=1000, read_ahead=1) as stream:
+        actual = read_raw_batches(stream)
+    assert actual == expected
+
+
+@pytest.mark.parametrize('size', [-1, 1, 7, 4096, 100000])
+def test_read_ahead_stream_read(size):
+    data = bytes(range(256)) * 1000
+    with downloader_warc.ReadAheadStream(io.BytesIO(data), chunk_size=1000, read_ahead=3) as stream:
+        parts = []
+        while True:
+            part = stream.read(size)
+            if not part:
+                break
+            assert size < 0 or len(part) <= size
+            parts.append(part)
+    assert b''.join(parts) == data
+
+
+def test_read_ahead_stream_close_early():
+    data = b'x' * 100000
+    stream = downloader_warc.ReadAheadStream(io.BytesIO(data), chunk_size=10, read_ahead=2)
+    assert stream.read(5) == b'xxxxx'
+    stream.close()
+    stream.thread.join(timeout=10)
+    assert not stream.thread.is_alive()
@@ -0,0 +1,36 @@
+import io
+
+# the sys import is needed so that we can import from the current project
+import sys
+sys.path.append('.')
+sys.path.append('benchmarks')
+import downloader_warc
+import synthetic_warc
+
+
+def write_warc(**kwargs):
+    f = io.BytesIO()
+    counts = synthetic_warc.write_warc(f, **kwargs)
+    return f.getvalue(), counts
+
+
+def test_records_and_languages():
+    data, counts = write_warc(records=250, languages='en=0.5,es=0.3,ru=0.2', seed=1)
+    batches = list(downloader_warc.iter_raw_batches(io.BytesIO(data), batch_size=100))
+    assert [len(batch) for batch, checkpoint in batches] == [100, 100, 50]
+    assert sum(counts.values()) == 250
+    assert set(counts.keys()) == {'en', 'es', 'ru'}
+    langs = [ html.decode('utf-8').split('lang="')[1][:2] for batch, checkpoint in batches for url, accessed_at, html in batch ]
+    assert { lang: langs.count(lang) for lang in counts } == counts
+
+
+def test_deterministic():
+    assert write_warc(records=50, seed=3) == write_warc(records=50, seed=3)
+    assert write_warc(records=50, seed=3) != write_warc(records=50, seed=4)
+
+
+def test_accessed_at_spans_several_months():
+    data, counts = write_warc(records=100)
+    batches = list(downloader_warc.iter_raw_batches(io.BytesIO(data), batch_size=100))
+    months = { accessed_at[:7] for batch, checkpoint in batches for url, accessed_at, html in batch }
+    assert months == {'2021-01', '2021-02', '2021-03', '2021-04'}
@@ -0,0 +1,82 @@
+import os
+import re
+import pytest
+
+# the sys import is needed so that we can import from the current project
+import sys
+sys.path.append('.')
+import urlkeys
+
+
+schema_path = os.path.join(os.path.dirname(__file__), '../../pg/sql/schema.sql')
+
+
+def parse_sql_expression(expr):
+    '''
+    Converts a SQL expression built from string literals and function calls into a python value,
+    calling the urlkeys function with the same name for each function call.
+    '''
+    expr = expr.strip()
+    if expr.startswith("'"):
+        assert expr.endswith("'")
+        return expr[1:-1].replace("''", "'")
+    name, arg = re.fullmatch(r'(\w+)\((.*)\)', expr, re.DOTALL).groups()
+    return getattr(urlkeys, name)(parse_sql_expression(arg))
+
+
+def schema_asserts():
+    '''
+    Returns every (expression, expected) pair in the asserts of schema.sql
+    whose outermost function has a python version in urlkeys.
+    '''
+    with open(schema_path) as f:
+        schema = f.read()
+    cases = []
+    for expr, expected in re.findall(r"assert\( *(\w+\(.*\)) *= *('.*') *\);", schema):
+        if hasattr(urlkeys, expr.split('(')[0]):
+            cases.append((expr, expected))
+    return cases
+
+
+def test_schema_asserts_found():
+    functions = { expr.split('(')[0] for expr, expected in schema_asserts() }
+    assert functions == {
+        'url_remove_scheme', 'url_host', 'url_path', 'url_query',
+        'host_simplify', 'host_key', 'host_unkey', 'path_simplify', 'query_simplify',
+        'url_host_key', 'url_hostpath_key', 'url_hostpathquery_key',
+        }
+
+
+@pytest.mark.parametrize('expr,expected', schema_asserts())
+def test_schema_assert(expr, expected):
+    assert parse_sql_expression(expr) == parse_sql_expression(expected)
+
+
+urls = sorted({ expr[expr.index('(')+1:-1] for expr, expected in schema_asserts() if expr.startswith('url_') }) + [
+    "'http://www2.M.Example.co.uk:8080/a/b/index.htm;x?utm_campaign=1&Z=1&b=2#frag'",
+    "'https://m.example.com/?utmost=1&a=1'",
+    "'example.com?x=/y'",
+    "'ftp://example.com//double//slash/'",
+    "'no-scheme'",
+    "''",
+    "'https://example.com/" + 'a'*3000 + "'",
+    ]
+
+
+@pytest.mark.parametrize('url', urls)
+def test_url_keys_many(url):
+    url = parse_sql_expression(url)
+    assert urlkeys.url_keys_many([url]) == [(
+        urlkeys.url_host_key(url),
+        urlkeys.url_hostpath_key(url),
+        urlkeys.url_hostpathquery_key(url),
+        )]
+
+
+def test_add_url_keys():
+    batch = [{'url': 'https://www.example.com/path/?b=1&a=2'}, {'url': 'http://cnn.com'}]
+    urlkeys.add_url_keys(batch)
+    assert [ (row['host_key'], row['hostpath_key'], row['hostpathquery_key']) for row in batch ] == [
+        ('com,example)', 'com,example)/path', 'com,example)/path?a=2&b=1'),
+        ('com,cnn)', 'com,cnn)', 'com,cnn)'),
+        ]
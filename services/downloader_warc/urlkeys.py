@@ -0,0 +1,176 @@
+'''
+Python versions of the url_* functions in schema.sql.
+
+The loaders compute url_host_key, url_hostpath_key, and url_hostpathquery_key for every row at insert time
+and store them in the host_key, hostpath_key, and hostpathquery_key columns of metahtml,
+so that the rollups read precomputed text instead of calling the nested PL/pgSQL functions
+several times per row.
+Each function below uses the same regular expression as the SQL function with the same name,
+and tests/test_urlkeys.py checks them against every assert in schema.sql.
+
+NOTE:
+postgres' regular expressions are POSIX and python's are not,
+but these patterns only use features with the same meaning in both;
+the only difference is that '.' matches newlines in postgres,
+which is why every pattern is compiled with re.DOTALL.
+'''
+import re
+
+BTREE_SANITIZE_LENGTH = 2048
+
+_remove_scheme_re = re.compile(r'[^:/]*//(.*)', re.DOTALL)
+_host_re = re.compile(r'([^/?:]*):?[^/?]*[/?]?', re.DOTALL)
+_path_re = re.compile(r'[^/?]+([/][^;#?]*)', re.DOTALL)
+_query_re = re.compile(r'\?([^?#]*)', re.DOTALL)
+_host_www_re = re.compile(r'^www\d*\.(.*)', re.DOTALL)
+_host_m_re = re.compile(r'^m\.(.*)', re.DOTALL)
+_path_index_re = re.compile(r'(.*/)index.\w{3,4}$', re.DOTALL)
+_path_slash_re = re.compile(r'(.*)/$', re.DOTALL)
+
+
+def btree_sanitize(t):
+    return t[:BTREE_SANITIZE_LENGTH]
+
+
+def url_remove_scheme(url):
+    match = _remove_scheme_re.search(url)
+    return url if match is None else match.group(1)
+
+
+def url_host(url):
+    return _host_re.search(url_remove_scheme(url)).group(1)
+
+
+def url_path(url):
+    match = _path_re.search(url_remove_scheme(url))
+    return '/' if match is None else match.group(1)
+
+
+def url_query(url):
+    match = _query_re.search(url)
+    return '' if match is None else match.group(1)
+
+
+def host_simplify(host):
+    match = _host_www_re.search(host) or _host_m_re.search(host)
+    return host if match is None else match.group(1)
+
+
+def host_key(host):
+    return ','.join(reversed(host.split('.'))) + ')'
+
+
+def host_unkey(host):
+    return '.'.join(reversed(host[:-1].split(',')))
+
+
+def path_simplify(path):
+    match = _path_index_re.search(path)
+    path_without_index = path if match is None else match.group(1)
+    match = _path_slash_re.search(path_without_index)
+    return path_without_index if match is None else match.group(1)
+
+
+def query_simplify(query):
+    '''
+    NOTE:
+    in SQL, the pattern 'utm_%' matches any term starting with 'utm' followed by at least one character,
+    because '_' is a LIKE wildcard;
+    the terms are sorted with the "C" collation, which matches python's sort order
+    '''
+    return '&'.join(sorted(term for term in query.split('&') if not (term.startswith('utm') and len(term) > 3)))
+
+
+def url_host_key(url):
+    url_lower = url.lower()
+    return btree_sanitize(host_key(host_simplify(url_host(url_lower))))
+
+
+def url_hostpath_key(url):
+    url_lower = url.lower()
+    return btree_sanitize(host_key(host_simplify(url_host(url_lower))) + path_simplify(url_path(url_lower)))
+
+
+def url_hostpathquery_key(url):
+    url_lower = url.lower()
+    query = query_simplify(url_query(url_lower))
+    return btree_sanitize(
+        host_key(host_simplify(url_host(url_lower))) +
+        path_simplify(url_path(url_lower)) +
+        ('?' + query if len(query) > 0 else '')
+        )
+
+
+def url_keys_many(urls):
+    '''
+    Returns a list of (url_host_key, url_hostpath_key, url_hostpathquery_key) tuples, one for each url.
+    This computes the same values as calling the three functions above on each url,
+    but every intermediate value is computed only once per url,
+    and the loop body avoids the python function calls.
+
+    >>> url_keys_many(['https://www.Example.com/Path/To/index.html?utm_source=x&b=2&a=1#top', None])
+    [('com,example)', 'com,example)/path/to', 'com,example)/path/to?a=1&b=2'), (None, None, None)]
+    '''
+    remove_scheme_search = _remove_scheme_re.search
+    host_search = _host_re.search
+    path_search = _path_re.search
+    query_search = _query_re.search
+    host_www_search = _host_www_re.search
+    host_m_search = _host_m_re.search
+    path_index_search = _path_index_re.search
+    path_slash_search = _path_slash_re.search
+    n = BTREE_SANITIZE_LENGTH
+
+    results = []
+    for url in urls:
+
+        # the SQL functions are STRICT
+        if url is None:
+            results.append((None, None, None))
+            continue
+
+        url_lower = url.lower()
+        match = remove_scheme_search(url_lower)
+        url_without_scheme = url_lower if match is None else match.group(1)
+
+        # host
+        host = host_search(url_without_scheme).group(1)
+        match = host_www_search(host) or host_m_search(host)
+        if match is not None:
+            host = match.group(1)
+        hostkey = ','.join(reversed(host.split('.'))) + ')'
+
+        # path
+        match = path_search(url_without_scheme)
+        path = '/' if match is None else match.group(1)
+        match = path_index_search(path)
+        if match is not None:
+            path = match.group(1)
+        match = path_slash_search(path)
+        if match is not None:
+            path = match.group(1)
+
+        # query
+        match = query_search(url_lower)
+        if match is None:
+            query = ''
+        else:
+            query = '&'.join(sorted(term for term in match.group(1).split('&') if not (term.startswith('utm') and len(term) > 3)))
+
+        hostpath = hostkey + path
+        results.append((
+            hostkey[:n],
+            hostpath[:n],
+            (hostpath + '?' + query)[:n] if len(query) > 0 else hostpath[:n],
+            ))
+    return results
+
+
+def add_url_keys(batch):
+    '''
+    Adds the host_key, hostpath_key, and hostpathquery_key entries to every row of the batch from its url entry.
+    '''
+    for row, (host, hostpath, hostpathquery) in zip(batch, url_keys_many([ row['url'] for row in batch ])):
+        row['host_key'] = host
+        row['hostpath_key'] = hostpath
+        row['hostpathquery_key'] = hostpathquery
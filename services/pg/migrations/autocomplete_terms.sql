@@ -0,0 +1,97 @@
+/*
+ * Adds the metahtml_rollup_textlang table of schema.sql to an existing database.
+ * Run this file with psql after incremental_rollups.sql:
+ *
+ *     psql -f services/pg/migrations/autocomplete_terms.sql
+ */
+\set ON_ERROR_STOP on
+
+BEGIN;
+
+/*
+ * the total hostpath count of each lemma over all months;
+ * the web app loads this table into memory for autocompleting and validating search terms,
+ * and max_id is the rollup_refresh.max_id of the refresh that last changed the row,
+ * so that the web app only reloads the rows that changed since its last load
+ */
+CREATE TABLE metahtml_rollup_textlang (
+    language TEXT NOT NULL,
+    alltext TEXT NOT NULL,
+    hostpath DOUBLE PRECISION NOT NULL,
+    max_id BIGINT NOT NULL,
+    PRIMARY KEY (language, alltext)
+);
+CREATE INDEX metahtml_rollup_textlang_max_id_idx ON metahtml_rollup_textlang (language, max_id);
+
+/*
+ * recomputes the rows of metahtml_rollup_textlang for the lemmas in the rows of metahtml with start_id < id <= end_id;
+ * must be called after rollups_merge has merged these rows into metahtml_rollup_textlangmonth
+ */
+CREATE OR REPLACE PROCEDURE rollups_merge_terms(start_id BIGINT, end_id BIGINT)
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    INSERT INTO metahtml_rollup_textlang AS r (language, alltext, hostpath, max_id)
+    SELECT
+        language,
+        alltext,
+        sum(hostpath),
+        end_id
+    FROM metahtml_rollup_textlangmonth
+    WHERE (language, alltext) IN (
+        SELECT
+            COALESCE(language, ''),
+            unnest(tsvector_to_array(title || content))
+        FROM metahtml
+        WHERE id > start_id AND id <= end_id
+    )
+    GROUP BY language, alltext
+    ON CONFLICT (language, alltext) DO UPDATE SET
+        hostpath = excluded.hostpath,
+        max_id = excluded.max_id;
+END
+$$;
+
+/*
+ * merges the rows inserted since the last refresh into the rollups,
+ * so the cost of a refresh depends only on the number of new rows;
+ * it must be called outside of a transaction block, because it commits
+ *
+ * metahtml.id comes from a sequence, and a transaction may commit a row after a transaction with a larger id;
+ * so the high-water mark is read from the sequence while holding a lock that waits for all in-progress inserts to finish,
+ * and every row with a smaller id has been committed once the lock is released
+ */
+CREATE OR REPLACE PROCEDURE refresh_rollups(batch_size BIGINT DEFAULT 1000000)
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    start_id BIGINT;
+    end_id BIGINT;
+BEGIN
+    LOCK TABLE metahtml IN EXCLUSIVE MODE;
+    end_id := COALESCE(pg_sequence_last_value(pg_get_serial_sequence('metahtml', 'id')), 0);
+    COMMIT;
+
+    -- the new rows are merged in batches that each commit,
+    -- so that a large backlog of rows does not hold its locks for hours
+    SELECT COALESCE(max(max_id), 0) INTO start_id FROM rollup_refresh;
+    WHILE start_id < end_id LOOP
+        CALL rollups_merge(start_id, LEAST(start_id + batch_size, end_id));
+        CALL rollups_merge_terms(start_id, LEAST(start_id + batch_size, end_id));
+        start_id := LEAST(start_id + batch_size, end_id);
+        INSERT INTO rollup_refresh (max_id) VALUES (start_id);
+        COMMIT;
+    END LOOP;
+END
+$$;
+
+INSERT INTO metahtml_rollup_textlang (language, alltext, hostpath, max_id)
+SELECT
+    language,
+    alltext,
+    sum(hostpath),
+    (SELECT COALESCE(max(max_id), 0) FROM rollup_refresh)
+FROM metahtml_rollup_textlangmonth
+GROUP BY language, alltext;
+
+COMMIT;
@@ -0,0 +1,192 @@
+/*
+ * Brings the metahtml table of an existing database up to date with schema.sql:
+ * adds the url key columns, the columns extracted from the jsonb, and the SimHash columns,
+ * backfills the url key and extracted columns of the existing rows,
+ * and rebuilds the rollups on top of the new columns.
+ *
+ * See README.md for the rollout order:
+ * the loaders are stopped before the first migration and the new loaders are deployed after the last one,
+ * because they write columns that this file adds and create partitions with the function from partition_metahtml.sql.
+ * Run source_checkpoints.sql, warc_queue.sql, rollup_refresh.sql, and search_tsvector.sql first,
+ * then run this file with psql outside of a transaction:
+ *
+ *     psql -f services/pg/migrations/extracted_columns.sql
+ *
+ * The backfill commits after every batch of rows,
+ * so it holds row locks only briefly and can be interrupted and restarted;
+ * the indexes are built CONCURRENTLY so that the web app can keep reading while they are built.
+ */
+\set ON_ERROR_STOP on
+
+ALTER TABLE metahtml
+    ADD COLUMN IF NOT EXISTS host_key TEXT,
+    ADD COLUMN IF NOT EXISTS hostpath_key TEXT,
+    ADD COLUMN IF NOT EXISTS hostpathquery_key TEXT,
+    ADD COLUMN IF NOT EXISTS language TEXT,
+    ADD COLUMN IF NOT EXISTS timestamp_published TIMESTAMPTZ,
+    ADD COLUMN IF NOT EXISTS title_text TEXT,
+    ADD COLUMN IF NOT EXISTS description TEXT,
+    ADD COLUMN IF NOT EXISTS type TEXT,
+    ADD COLUMN IF NOT EXISTS simhash BIGINT,
+    ADD COLUMN IF NOT EXISTS id_canonical BIGINT REFERENCES metahtml(id);
+
+/*
+ * these functions were added or changed in schema.sql along with the columns
+ */
+CREATE OR REPLACE FUNCTION query_simplify(query TEXT)
+RETURNS TEXT LANGUAGE plpgsql IMMUTABLE STRICT PARALLEL SAFE
+AS $$
+BEGIN
+    RETURN array_to_string(array(
+        SELECT * FROM unnest(string_to_array(query,'&')) AS unnest
+        WHERE unnest.unnest NOT LIKE 'utm_%'
+        ORDER BY unnest.unnest COLLATE "C" ASC
+    ),'&');
+END 
+$$;
+
+CREATE OR REPLACE FUNCTION simhash_keys(simhash BIGINT)
+RETURNS INTEGER[] LANGUAGE sql IMMUTABLE STRICT PARALLEL SAFE
+AS $$
+    SELECT array_agg((
+        (pair::BIGINT << 26) |
+        ((simhash >> offset_a) & ((1::BIGINT << width_a) - 1)) |
+        (((simhash >> offset_b) & ((1::BIGINT << width_b) - 1)) << width_a)
+        )::INTEGER ORDER BY pair)
+    FROM (VALUES
+        (0, 0, 13, 13, 13),
+        (1, 0, 13, 26, 13),
+        (2, 0, 13, 39, 13),
+        (3, 0, 13, 52, 12),
+        (4, 13, 13, 26, 13),
+        (5, 13, 13, 39, 13),
+        (6, 13, 13, 52, 12),
+        (7, 26, 13, 39, 13),
+        (8, 26, 13, 52, 12),
+        (9, 39, 13, 52, 12)
+    ) AS pairs(pair, offset_a, width_a, offset_b, width_b);
+$$;
+
+/*
+ * the loaders store NULL for timestamps that they cannot parse;
+ * this function does the same for the backfill instead of failing the whole batch
+ */
+CREATE OR REPLACE FUNCTION migration_try_timestamptz(t TEXT)
+RETURNS TIMESTAMPTZ LANGUAGE plpgsql IMMUTABLE STRICT PARALLEL SAFE
+AS $$
+BEGIN
+    RETURN t::timestamptz;
+EXCEPTION WHEN others THEN
+    RETURN NULL;
+END
+$$;
+
+CREATE OR REPLACE PROCEDURE migration_backfill_metahtml(batch_size INTEGER DEFAULT 10000)
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    last_id BIGINT;
+    max_id BIGINT;
+BEGIN
+    -- rows whose host_key is already set were either inserted by the new loaders or backfilled by a previous run
+    SELECT min(id) - 1 INTO last_id FROM metahtml WHERE host_key IS NULL;
+    SELECT max(id) INTO max_id FROM metahtml;
+    WHILE last_id < max_id LOOP
+        UPDATE metahtml SET
+            host_key = url_host_key(url),
+            hostpath_key = url_hostpath_key(url),
+            hostpathquery_key = url_hostpathquery_key(url),
+            language = jsonb->'language'->'best'->>'value',
+            timestamp_published = migration_try_timestamptz(jsonb->'timestamp.published'->'best'->'value'->>'lo'),
+            title_text = jsonb->'title'->'best'->>'value',
+            description = jsonb->'description'->'best'->>'value',
+            type = jsonb->'type'->'best'->>'value'
+        WHERE
+            id > last_id AND
+            id <= last_id + batch_size AND
+            host_key IS NULL;
+        last_id := last_id + batch_size;
+        RAISE NOTICE 'backfilled id <= % of %', last_id, max_id;
+        COMMIT;
+    END LOOP;
+END
+$$;
+
+CALL migration_backfill_metahtml();
+
+ALTER TABLE metahtml
+    ALTER COLUMN host_key SET NOT NULL,
+    ALTER COLUMN hostpath_key SET NOT NULL,
+    ALTER COLUMN hostpathquery_key SET NOT NULL;
+
+DROP PROCEDURE migration_backfill_metahtml;
+DROP FUNCTION migration_try_timestamptz;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS metahtml_host_key_idx ON metahtml (host_key text_pattern_ops);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS metahtml_language_published_idx ON metahtml (language, timestamp_published);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS metahtml_published_brinidx ON metahtml USING brin (timestamp_published);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS metahtml_simhash_keys_idx ON metahtml USING gin (simhash_keys(simhash));
+CREATE INDEX CONCURRENTLY IF NOT EXISTS metahtml_id_canonical_idx ON metahtml (id_canonical) WHERE id_canonical IS NOT NULL;
+
+/*
+ * the rollups are rebuilt on top of the new columns;
+ * the definitions are the same as in schema.sql
+ */
+BEGIN;
+
+DROP MATERIALIZED VIEW IF EXISTS metahtml_rollup_host2;
+DROP MATERIALIZED VIEW IF EXISTS metahtml_rollup_textlangmonth;
+DROP MATERIALIZED VIEW IF EXISTS metahtml_rollup_langmonth;
+DROP MATERIALIZED VIEW IF EXISTS metahtml_rollup_insert;
+
+CREATE MATERIALIZED VIEW metahtml_rollup_host2 AS (
+    SELECT
+        hll_count(url) AS url,
+        hll_count(hostpathquery_key) AS hostpathquery,
+        hll_count(hostpath_key) AS hostpath,
+        host_key AS host
+    FROM metahtml
+    GROUP BY host
+);
+
+CREATE MATERIALIZED VIEW metahtml_rollup_textlangmonth AS (
+    SELECT
+        unnest(tsvector_to_array(title || content)) AS alltext,
+        language,
+        date_trunc('month',timestamp_published) AS timestamp_published,
+        hll_count(url) AS url,
+        hll_count(hostpathquery_key) AS hostpathquery,
+        hll_count(hostpath_key) AS hostpath
+    FROM metahtml
+    GROUP BY alltext,language,date_trunc('month',timestamp_published)
+);
+
+CREATE MATERIALIZED VIEW metahtml_rollup_langmonth AS (
+    SELECT
+        language,
+        date_trunc('month',timestamp_published) AS timestamp_published,
+        hll_count(url) AS url,
+        hll_count(hostpathquery_key) AS hostpathquery,
+        hll_count(hostpath_key) AS hostpath
+    FROM metahtml
+    GROUP BY language,date_trunc('month',timestamp_published)
+);
+
+CREATE INDEX metahtml_rollup_textlangmonth_idx ON metahtml_rollup_textlangmonth (language, alltext, timestamp_published) INCLUDE (hostpath);
+CREATE INDEX metahtml_rollup_langmonth_idx ON metahtml_rollup_langmonth (language, timestamp_published) INCLUDE (hostpath);
+
+CREATE MATERIALIZED VIEW metahtml_rollup_insert AS (
+    SELECT
+        date_trunc('hour', inserted_at) AS insert_hour,
+        hll_count(id_source),
+        hll_count(url) AS url,
+        hll_count(hostpathquery_key) AS hostpathquery,
+        hll_count(hostpath_key) AS hostpath,
+        hll_count(host_key) AS host
+    FROM metahtml
+    GROUP BY insert_hour
+);
+
+INSERT INTO rollup_refresh DEFAULT VALUES;
+
+COMMIT;
@@ -0,0 +1,276 @@
+/*
+ * Replaces the rollup materialized views of an existing database with the incrementally maintained rollup tables of schema.sql.
+ * Run this file with psql after partition_metahtml.sql:
+ *
+ *     psql -f services/pg/migrations/incremental_rollups.sql
+ *
+ * The first call to refresh_rollups merges every existing row into the new tables,
+ * which takes about as long as a full refresh of the old materialized views;
+ * later calls only merge the rows inserted since the previous call.
+ */
+\set ON_ERROR_STOP on
+
+BEGIN;
+
+DROP MATERIALIZED VIEW IF EXISTS metahtml_rollup_host2;
+DROP MATERIALIZED VIEW IF EXISTS metahtml_rollup_textlangmonth;
+DROP MATERIALIZED VIEW IF EXISTS metahtml_rollup_langmonth;
+DROP MATERIALIZED VIEW IF EXISTS metahtml_rollup_insert;
+DROP PROCEDURE IF EXISTS refresh_rollups();
+
+ALTER TABLE rollup_refresh ADD COLUMN IF NOT EXISTS max_id BIGINT NOT NULL DEFAULT 0;
+
+/*
+ * The rollups are tables that are maintained incrementally by the refresh_rollups procedure below.
+ * Every count is stored both as an hll sketch (the *_hll columns),
+ * which can be merged with the sketches of new rows using hll_union,
+ * and as the cardinality of that sketch, which is what the queries read.
+ *
+ * NOTE:
+ * the group by columns cannot be NULL because they are part of the primary key;
+ * rows with a NULL language are stored with language='',
+ * and rows with a NULL timestamp_published are stored with timestamp_published='-infinity'
+ */
+CREATE TABLE metahtml_rollup_host2 (
+    host TEXT NOT NULL,
+    url_hll hll NOT NULL,
+    hostpathquery_hll hll NOT NULL,
+    hostpath_hll hll NOT NULL,
+    url DOUBLE PRECISION NOT NULL,
+    hostpathquery DOUBLE PRECISION NOT NULL,
+    hostpath DOUBLE PRECISION NOT NULL,
+    PRIMARY KEY (host)
+);
+
+/*
+ * the primary keys of the month rollups are also covering indexes for the /ngrams time series query;
+ * all of the terms in a query are found with a single index-only scan
+ */
+CREATE TABLE metahtml_rollup_textlangmonth (
+    alltext TEXT NOT NULL,
+    language TEXT NOT NULL,
+    timestamp_published TIMESTAMPTZ NOT NULL,
+    url_hll hll NOT NULL,
+    hostpathquery_hll hll NOT NULL,
+    hostpath_hll hll NOT NULL,
+    url DOUBLE PRECISION NOT NULL,
+    hostpathquery DOUBLE PRECISION NOT NULL,
+    hostpath DOUBLE PRECISION NOT NULL,
+    PRIMARY KEY (language, alltext, timestamp_published) INCLUDE (hostpath)
+);
+
+CREATE TABLE metahtml_rollup_langmonth (
+    language TEXT NOT NULL,
+    timestamp_published TIMESTAMPTZ NOT NULL,
+    url_hll hll NOT NULL,
+    hostpathquery_hll hll NOT NULL,
+    hostpath_hll hll NOT NULL,
+    url DOUBLE PRECISION NOT NULL,
+    hostpathquery DOUBLE PRECISION NOT NULL,
+    hostpath DOUBLE PRECISION NOT NULL,
+    PRIMARY KEY (language, timestamp_published) INCLUDE (hostpath)
+);
+
+CREATE TABLE metahtml_rollup_insert (
+    insert_hour TIMESTAMPTZ NOT NULL,
+    id_source_hll hll NOT NULL,
+    url_hll hll NOT NULL,
+    hostpathquery_hll hll NOT NULL,
+    hostpath_hll hll NOT NULL,
+    host_hll hll NOT NULL,
+    id_source DOUBLE PRECISION NOT NULL,
+    url DOUBLE PRECISION NOT NULL,
+    hostpathquery DOUBLE PRECISION NOT NULL,
+    hostpath DOUBLE PRECISION NOT NULL,
+    host DOUBLE PRECISION NOT NULL,
+    PRIMARY KEY (insert_hour)
+);
+
+/*
+ * merges the rows of metahtml with start_id < id <= end_id into the rollups;
+ * merging the same rows twice leaves the sketches unchanged, because hll_union is idempotent
+ */
+CREATE OR REPLACE PROCEDURE rollups_merge(start_id BIGINT, end_id BIGINT)
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    INSERT INTO metahtml_rollup_host2 AS r
+    SELECT
+        host,
+        url_hll,
+        hostpathquery_hll,
+        hostpath_hll,
+        hll_cardinality(url_hll),
+        hll_cardinality(hostpathquery_hll),
+        hll_cardinality(hostpath_hll)
+    FROM (
+        SELECT
+            host_key AS host,
+            hll_add_agg(hll_hash_text(url)) AS url_hll,
+            hll_add_agg(hll_hash_text(hostpathquery_key)) AS hostpathquery_hll,
+            hll_add_agg(hll_hash_text(hostpath_key)) AS hostpath_hll
+        FROM metahtml
+        WHERE id > start_id AND id <= end_id
+        GROUP BY host_key
+    ) AS new
+    ON CONFLICT (host) DO UPDATE SET
+        url_hll = hll_union(r.url_hll, excluded.url_hll),
+        hostpathquery_hll = hll_union(r.hostpathquery_hll, excluded.hostpathquery_hll),
+        hostpath_hll = hll_union(r.hostpath_hll, excluded.hostpath_hll),
+        url = hll_cardinality(hll_union(r.url_hll, excluded.url_hll)),
+        hostpathquery = hll_cardinality(hll_union(r.hostpathquery_hll, excluded.hostpathquery_hll)),
+        hostpath = hll_cardinality(hll_union(r.hostpath_hll, excluded.hostpath_hll));
+
+    INSERT INTO metahtml_rollup_textlangmonth AS r
+    SELECT
+        alltext,
+        language,
+        timestamp_published,
+        url_hll,
+        hostpathquery_hll,
+        hostpath_hll,
+        hll_cardinality(url_hll),
+        hll_cardinality(hostpathquery_hll),
+        hll_cardinality(hostpath_hll)
+    FROM (
+        SELECT
+            alltext,
+            language,
+            timestamp_published,
+            hll_add_agg(hll_hash_text(url)) AS url_hll,
+            hll_add_agg(hll_hash_text(hostpathquery_key)) AS hostpathquery_hll,
+            hll_add_agg(hll_hash_text(hostpath_key)) AS hostpath_hll
+        FROM (
+            SELECT
+                unnest(tsvector_to_array(title || content)) AS alltext,
+                COALESCE(language, '') AS language,
+                COALESCE(date_trunc('month', timestamp_published), '-infinity') AS timestamp_published,
+                url,
+                hostpathquery_key,
+                hostpath_key
+            FROM metahtml
+            WHERE id > start_id AND id <= end_id
+        ) AS t
+        GROUP BY alltext, language, timestamp_published
+    ) AS new
+    ON CONFLICT (language, alltext, timestamp_published) DO UPDATE SET
+        url_hll = hll_union(r.url_hll, excluded.url_hll),
+        hostpathquery_hll = hll_union(r.hostpathquery_hll, excluded.hostpathquery_hll),
+        hostpath_hll = hll_union(r.hostpath_hll, excluded.hostpath_hll),
+        url = hll_cardinality(hll_union(r.url_hll, excluded.url_hll)),
+        hostpathquery = hll_cardinality(hll_union(r.hostpathquery_hll, excluded.hostpathquery_hll)),
+        hostpath = hll_cardinality(hll_union(r.hostpath_hll, excluded.hostpath_hll));
+
+    INSERT INTO metahtml_rollup_langmonth AS r
+    SELECT
+        language,
+        timestamp_published,
+        url_hll,
+        hostpathquery_hll,
+        hostpath_hll,
+        hll_cardinality(url_hll),
+        hll_cardinality(hostpathquery_hll),
+        hll_cardinality(hostpath_hll)
+    FROM (
+        SELECT
+            language,
+            timestamp_published,
+            hll_add_agg(hll_hash_text(url)) AS url_hll,
+            hll_add_agg(hll_hash_text(hostpathquery_key)) AS hostpathquery_hll,
+            hll_add_agg(hll_hash_text(hostpath_key)) AS hostpath_hll
+        FROM (
+            SELECT
+                COALESCE(language, '') AS language,
+                COALESCE(date_trunc('month', timestamp_published), '-infinity') AS timestamp_published,
+                url,
+                hostpathquery_key,
+                hostpath_key
+            FROM metahtml
+            WHERE id > start_id AND id <= end_id
+        ) AS t
+        GROUP BY language, timestamp_published
+    ) AS new
+    ON CONFLICT (language, timestamp_published) DO UPDATE SET
+        url_hll = hll_union(r.url_hll, excluded.url_hll),
+        hostpathquery_hll = hll_union(r.hostpathquery_hll, excluded.hostpathquery_hll),
+        hostpath_hll = hll_union(r.hostpath_hll, excluded.hostpath_hll),
+        url = hll_cardinality(hll_union(r.url_hll, excluded.url_hll)),
+        hostpathquery = hll_cardinality(hll_union(r.hostpathquery_hll, excluded.hostpathquery_hll)),
+        hostpath = hll_cardinality(hll_union(r.hostpath_hll, excluded.hostpath_hll));
+
+    INSERT INTO metahtml_rollup_insert AS r
+    SELECT
+        insert_hour,
+        id_source_hll,
+        url_hll,
+        hostpathquery_hll,
+        hostpath_hll,
+        host_hll,
+        hll_cardinality(id_source_hll),
+        hll_cardinality(url_hll),
+        hll_cardinality(hostpathquery_hll),
+        hll_cardinality(hostpath_hll),
+        hll_cardinality(host_hll)
+    FROM (
+        SELECT
+            date_trunc('hour', inserted_at) AS insert_hour,
+            hll_add_agg(hll_hash_integer(id_source)) AS id_source_hll,
+            hll_add_agg(hll_hash_text(url)) AS url_hll,
+            hll_add_agg(hll_hash_text(hostpathquery_key)) AS hostpathquery_hll,
+            hll_add_agg(hll_hash_text(hostpath_key)) AS hostpath_hll,
+            hll_add_agg(hll_hash_text(host_key)) AS host_hll
+        FROM metahtml
+        WHERE id > start_id AND id <= end_id
+        GROUP BY date_trunc('hour', inserted_at)
+    ) AS new
+    ON CONFLICT (insert_hour) DO UPDATE SET
+        id_source_hll = hll_union(r.id_source_hll, excluded.id_source_hll),
+        url_hll = hll_union(r.url_hll, excluded.url_hll),
+        hostpathquery_hll = hll_union(r.hostpathquery_hll, excluded.hostpathquery_hll),
+        hostpath_hll = hll_union(r.hostpath_hll, excluded.hostpath_hll),
+        host_hll = hll_union(r.host_hll, excluded.host_hll),
+        id_source = hll_cardinality(hll_union(r.id_source_hll, excluded.id_source_hll)),
+        url = hll_cardinality(hll_union(r.url_hll, excluded.url_hll)),
+        hostpathquery = hll_cardinality(hll_union(r.hostpathquery_hll, excluded.hostpathquery_hll)),
+        hostpath = hll_cardinality(hll_union(r.hostpath_hll, excluded.hostpath_hll)),
+        host = hll_cardinality(hll_union(r.host_hll, excluded.host_hll));
+END
+$$;
+
+/*
+ * merges the rows inserted since the last refresh into the rollups,
+ * so the cost of a refresh depends only on the number of new rows;
+ * it must be called outside of a transaction block, because it commits
+ *
+ * metahtml.id comes from a sequence, and a transaction may commit a row after a transaction with a larger id;
+ * so the high-water mark is read from the sequence while holding a lock that waits for all in-progress inserts to finish,
+ * and every row with a smaller id has been committed once the lock is released
+ */
+CREATE OR REPLACE PROCEDURE refresh_rollups(batch_size BIGINT DEFAULT 1000000)
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    start_id BIGINT;
+    end_id BIGINT;
+BEGIN
+    LOCK TABLE metahtml IN EXCLUSIVE MODE;
+    end_id := COALESCE(pg_sequence_last_value(pg_get_serial_sequence('metahtml', 'id')), 0);
+    COMMIT;
+
+    -- the new rows are merged in batches that each commit,
+    -- so that a large backlog of rows does not hold its locks for hours
+    SELECT COALESCE(max(max_id), 0) INTO start_id FROM rollup_refresh;
+    WHILE start_id < end_id LOOP
+        CALL rollups_merge(start_id, LEAST(start_id + batch_size, end_id));
+        start_id := LEAST(start_id + batch_size, end_id);
+        INSERT INTO rollup_refresh (max_id) VALUES (start_id);
+        COMMIT;
+    END LOOP;
+END
+$$;
+
+SELECT cron.schedule('*/10 * * * *', 'CALL refresh_rollups()');
+
+COMMIT;
+
+CALL refresh_rollups();
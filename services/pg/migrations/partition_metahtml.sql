@@ -0,0 +1,228 @@
+/*
+ * Converts the metahtml table of an existing database into the partitioned table of schema.sql.
+ * See README.md for the order of the migrations;
+ * run extracted_columns.sql first, then run this file with psql outside of a transaction:
+ *
+ *     psql -f services/pg/migrations/partition_metahtml.sql
+ *
+ * The rows are copied into the new table in batches that commit separately,
+ * so an interrupted migration can be restarted and continues where it stopped.
+ * The web app can keep reading the old table until the final transaction swaps the tables,
+ * but the loaders must be stopped for the whole migration,
+ * otherwise the rows they insert during the copy will be missed.
+ * The old table is kept as metahtml_unpartitioned;
+ * drop it once the new table has been checked.
+ */
+\set ON_ERROR_STOP on
+
+/*
+ * the snippet columns are copied into the new table,
+ * so they are added to the old table first if snippets.sql has not run yet
+ */
+ALTER TABLE metahtml
+    ADD COLUMN IF NOT EXISTS snippet TEXT,
+    ADD COLUMN IF NOT EXISTS snippet_lemmas TEXT;
+
+CREATE TABLE IF NOT EXISTS metahtml_partitioned (
+    id BIGSERIAL,
+    id_source INTEGER NOT NULL REFERENCES source(id),
+    accessed_at TIMESTAMPTZ NOT NULL,
+    inserted_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    url TEXT NOT NULL,
+    host_key TEXT NOT NULL,
+    hostpath_key TEXT NOT NULL,
+    hostpathquery_key TEXT NOT NULL,
+    jsonb JSONB NOT NULL,
+    language TEXT,
+    timestamp_published TIMESTAMPTZ,
+    title_text TEXT,
+    description TEXT,
+    snippet TEXT,
+    snippet_lemmas TEXT,
+    type TEXT,
+    title tsvector,
+    content tsvector,
+    simhash BIGINT,
+    id_canonical BIGINT,
+    PRIMARY KEY (id, accessed_at)
+) PARTITION BY RANGE (accessed_at);
+
+/*
+ * the partitions use the same names and boundaries as metahtml_create_partitions,
+ * so that function keeps working after the swap
+ */
+do $$
+DECLARE
+    month TIMESTAMP;
+    name TEXT;
+BEGIN
+    FOR month IN
+        SELECT DISTINCT date_trunc('month', accessed_at AT TIME ZONE 'UTC')
+        FROM metahtml
+    LOOP
+        name := 'metahtml_' || to_char(month, 'YYYY_MM');
+        EXECUTE format(
+            'CREATE TABLE IF NOT EXISTS %I PARTITION OF metahtml_partitioned FOR VALUES FROM (%L) TO (%L)',
+            name,
+            month AT TIME ZONE 'UTC',
+            (month + interval '1 month') AT TIME ZONE 'UTC'
+            );
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE PROCEDURE migration_copy_metahtml(batch_size INTEGER DEFAULT 100000)
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    last_id BIGINT;
+    max_id BIGINT;
+BEGIN
+    SELECT COALESCE(max(id), 0) INTO last_id FROM metahtml_partitioned;
+    SELECT COALESCE(max(id), 0) INTO max_id FROM metahtml;
+    WHILE last_id < max_id LOOP
+        INSERT INTO metahtml_partitioned (id, id_source, accessed_at, inserted_at, url, host_key, hostpath_key, hostpathquery_key, jsonb, language, timestamp_published, title_text, description, snippet, snippet_lemmas, type, title, content, simhash, id_canonical)
+        SELECT id, id_source, accessed_at, inserted_at, url, host_key, hostpath_key, hostpathquery_key, jsonb, language, timestamp_published, title_text, description, snippet, snippet_lemmas, type, title, content, simhash, id_canonical
+        FROM metahtml
+        WHERE id > last_id AND id <= last_id + batch_size;
+        last_id := last_id + batch_size;
+        RAISE NOTICE 'copied id <= % of %', last_id, max_id;
+        COMMIT;
+    END LOOP;
+END
+$$;
+
+CALL migration_copy_metahtml();
+DROP PROCEDURE migration_copy_metahtml;
+
+SELECT setval(pg_get_serial_sequence('metahtml_partitioned', 'id'), (SELECT max(id) FROM metahtml_partitioned));
+
+/*
+ * the indexes are built after the copy, which is much faster than maintaining them during it;
+ * each statement builds the index separately on every partition
+ */
+CREATE INDEX IF NOT EXISTS metahtml_partitioned_host_key_idx ON metahtml_partitioned (host_key text_pattern_ops);
+CREATE INDEX IF NOT EXISTS metahtml_partitioned_language_published_idx ON metahtml_partitioned (language, timestamp_published);
+CREATE INDEX IF NOT EXISTS metahtml_partitioned_published_brinidx ON metahtml_partitioned USING brin (timestamp_published);
+CREATE INDEX IF NOT EXISTS metahtml_partitioned_title_rumidx ON metahtml_partitioned USING rum (title);
+CREATE INDEX IF NOT EXISTS metahtml_partitioned_content_rumidx ON metahtml_partitioned USING rum (content);
+CREATE INDEX IF NOT EXISTS metahtml_partitioned_search_rumidx ON metahtml_partitioned USING rum (metahtml_search_tsvector(title, content));
+CREATE INDEX IF NOT EXISTS metahtml_partitioned_simhash_keys_idx ON metahtml_partitioned USING gin (simhash_keys(simhash));
+CREATE INDEX IF NOT EXISTS metahtml_partitioned_id_canonical_idx ON metahtml_partitioned (id_canonical) WHERE id_canonical IS NOT NULL;
+
+/*
+ * swap the tables;
+ * the rollups refer to the old table, so they are rebuilt on the new one,
+ * and their definitions are the same as in schema.sql
+ */
+BEGIN;
+
+DROP MATERIALIZED VIEW IF EXISTS metahtml_rollup_host2;
+DROP MATERIALIZED VIEW IF EXISTS metahtml_rollup_textlangmonth;
+DROP MATERIALIZED VIEW IF EXISTS metahtml_rollup_langmonth;
+DROP MATERIALIZED VIEW IF EXISTS metahtml_rollup_insert;
+
+ALTER TABLE metahtml RENAME TO metahtml_unpartitioned;
+ALTER SEQUENCE IF EXISTS metahtml_id_seq RENAME TO metahtml_unpartitioned_id_seq;
+do $$
+DECLARE
+    index_name TEXT;
+BEGIN
+    FOR index_name IN
+        SELECT indexname FROM pg_indexes WHERE tablename = 'metahtml_unpartitioned' AND indexname LIKE 'metahtml\_%'
+    LOOP
+        EXECUTE format('ALTER INDEX %I RENAME TO %I', index_name, replace(index_name, 'metahtml_', 'metahtml_unpartitioned_'));
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+ALTER TABLE metahtml_partitioned RENAME TO metahtml;
+ALTER SEQUENCE metahtml_partitioned_id_seq RENAME TO metahtml_id_seq;
+ALTER INDEX metahtml_partitioned_pkey RENAME TO metahtml_pkey;
+ALTER INDEX metahtml_partitioned_host_key_idx RENAME TO metahtml_host_key_idx;
+ALTER INDEX metahtml_partitioned_language_published_idx RENAME TO metahtml_language_published_idx;
+ALTER INDEX metahtml_partitioned_published_brinidx RENAME TO metahtml_published_brinidx;
+ALTER INDEX metahtml_partitioned_title_rumidx RENAME TO metahtml_title_rumidx;
+ALTER INDEX metahtml_partitioned_content_rumidx RENAME TO metahtml_content_rumidx;
+ALTER INDEX metahtml_partitioned_search_rumidx RENAME TO metahtml_search_rumidx;
+ALTER INDEX metahtml_partitioned_simhash_keys_idx RENAME TO metahtml_simhash_keys_idx;
+ALTER INDEX metahtml_partitioned_id_canonical_idx RENAME TO metahtml_id_canonical_idx;
+
+CREATE OR REPLACE FUNCTION metahtml_create_partitions(accessed_ats TIMESTAMPTZ[])
+RETURNS VOID LANGUAGE plpgsql
+AS $$
+DECLARE
+    month TIMESTAMP;
+    name TEXT;
+BEGIN
+    FOR month IN
+        SELECT DISTINCT date_trunc('month', accessed_at AT TIME ZONE 'UTC')
+        FROM unnest(accessed_ats) AS accessed_at
+        WHERE accessed_at IS NOT NULL
+    LOOP
+        name := 'metahtml_' || to_char(month, 'YYYY_MM');
+        IF to_regclass(name) IS NULL THEN
+            -- concurrent loaders may try to create the same partition
+            PERFORM pg_advisory_xact_lock(hashtext('metahtml_create_partitions'));
+            EXECUTE format(
+                'CREATE TABLE IF NOT EXISTS %I PARTITION OF metahtml FOR VALUES FROM (%L) TO (%L)',
+                name,
+                month AT TIME ZONE 'UTC',
+                (month + interval '1 month') AT TIME ZONE 'UTC'
+                );
+        END IF;
+    END LOOP;
+END
+$$;
+
+CREATE MATERIALIZED VIEW metahtml_rollup_host2 AS (
+    SELECT
+        hll_count(url) AS url,
+        hll_count(hostpathquery_key) AS hostpathquery,
+        hll_count(hostpath_key) AS hostpath,
+        host_key AS host
+    FROM metahtml
+    GROUP BY host
+);
+
+CREATE MATERIALIZED VIEW metahtml_rollup_textlangmonth AS (
+    SELECT
+        unnest(tsvector_to_array(title || content)) AS alltext,
+        language,
+        date_trunc('month',timestamp_published) AS timestamp_published,
+        hll_count(url) AS url,
+        hll_count(hostpathquery_key) AS hostpathquery,
+        hll_count(hostpath_key) AS hostpath
+    FROM metahtml
+    GROUP BY alltext,language,date_trunc('month',timestamp_published)
+);
+
+CREATE MATERIALIZED VIEW metahtml_rollup_langmonth AS (
+    SELECT
+        language,
+        date_trunc('month',timestamp_published) AS timestamp_published,
+        hll_count(url) AS url,
+        hll_count(hostpathquery_key) AS hostpathquery,
+        hll_count(hostpath_key) AS hostpath
+    FROM metahtml
+    GROUP BY language,date_trunc('month',timestamp_published)
+);
+
+CREATE INDEX metahtml_rollup_textlangmonth_idx ON metahtml_rollup_textlangmonth (language, alltext, timestamp_published) INCLUDE (hostpath);
+CREATE INDEX metahtml_rollup_langmonth_idx ON metahtml_rollup_langmonth (language, timestamp_published) INCLUDE (hostpath);
+
+CREATE MATERIALIZED VIEW metahtml_rollup_insert AS (
+    SELECT
+        date_trunc('hour', inserted_at) AS insert_hour,
+        hll_count(id_source),
+        hll_count(url) AS url,
+        hll_count(hostpathquery_key) AS hostpathquery,
+        hll_count(hostpath_key) AS hostpath,
+        hll_count(host_key) AS host
+    FROM metahtml
+    GROUP BY insert_hour
+);
+
+INSERT INTO rollup_refresh DEFAULT VALUES;
+
+COMMIT;
@@ -0,0 +1,27 @@
+/*
+ * Adds the rollup_refresh table and the refresh_rollups procedure that the web app's query cache depends on.
+ * Run this file with psql before extracted_columns.sql:
+ *
+ *     psql -f services/pg/migrations/rollup_refresh.sql
+ *
+ * This creates the version of refresh_rollups that refreshes the materialized views;
+ * incremental_rollups.sql later replaces it with the procedure in schema.sql.
+ */
+\set ON_ERROR_STOP on
+
+CREATE TABLE IF NOT EXISTS rollup_refresh (
+    id INTEGER GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+    refreshed_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+CREATE OR REPLACE PROCEDURE refresh_rollups()
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    REFRESH MATERIALIZED VIEW metahtml_rollup_host2;
+    REFRESH MATERIALIZED VIEW metahtml_rollup_textlangmonth;
+    REFRESH MATERIALIZED VIEW metahtml_rollup_langmonth;
+    REFRESH MATERIALIZED VIEW metahtml_rollup_insert;
+    INSERT INTO rollup_refresh DEFAULT VALUES;
+END
+$$;
@@ -0,0 +1,19 @@
+/*
+ * Adds the metahtml_search_tsvector function and the RUM index that the /search page ranks with.
+ * Run this file with psql outside of a transaction, before extracted_columns.sql:
+ *
+ *     psql -f services/pg/migrations/search_tsvector.sql
+ *
+ * The index is built CONCURRENTLY so that the loaders can keep inserting;
+ * on a large table the build takes a long time, and /search falls back to slower plans until it finishes.
+ * If the build fails, drop the invalid index and run this file again.
+ */
+\set ON_ERROR_STOP on
+
+CREATE OR REPLACE FUNCTION metahtml_search_tsvector(title tsvector, content tsvector)
+RETURNS tsvector LANGUAGE sql IMMUTABLE PARALLEL SAFE
+AS $$
+    SELECT setweight(COALESCE(title, ''::tsvector), 'A') || setweight(COALESCE(content, ''::tsvector), 'D');
+$$;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS metahtml_search_rumidx ON metahtml USING rum (metahtml_search_tsvector(title, content));
@@ -0,0 +1,19 @@
+/*
+ * Adds the snippet columns of schema.sql to an existing database.
+ * Run this file with psql after partition_metahtml.sql (see README.md for the order of the migrations):
+ *
+ *     psql -f services/pg/migrations/snippets.sql
+ *
+ * The loaders compute the snippets of new rows when they lemmatize them;
+ * the snippets of the existing rows are left NULL,
+ * and the web app displays the description of those rows instead.
+ * Adding nullable columns without defaults only changes the catalog,
+ * so this migration does not rewrite the table.
+ * partition_metahtml.sql adds and copies the same columns,
+ * so after it this file only matters for a database that was partitioned by an older version of it.
+ */
+\set ON_ERROR_STOP on
+
+ALTER TABLE metahtml
+    ADD COLUMN IF NOT EXISTS snippet TEXT,
+    ADD COLUMN IF NOT EXISTS snippet_lemmas TEXT;
@@ -0,0 +1,16 @@
+/*
+ * Adds the checkpoint columns of the source table in schema.sql to an existing database.
+ * Run this file with psql before extracted_columns.sql:
+ *
+ *     psql -f services/pg/migrations/source_checkpoints.sql
+ *
+ * The existing sources get a checkpoint of 0,
+ * so a loader that resumes an unfinished source starts again from the beginning of its warc file.
+ * Adding columns with constant defaults only changes the catalog,
+ * so this migration does not rewrite the table.
+ */
+\set ON_ERROR_STOP on
+
+ALTER TABLE source
+    ADD COLUMN IF NOT EXISTS checkpoint_offset BIGINT NOT NULL DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS checkpoint_records BIGINT NOT NULL DEFAULT 0;
@@ -0,0 +1,20 @@
+/*
+ * Adds the warc_queue table of schema.sql to an existing database.
+ * Run this file with psql before extracted_columns.sql:
+ *
+ *     psql -f services/pg/migrations/warc_queue.sql
+ *
+ * The queue starts empty; fill it with downloader_warc.py --cc_url --enqueue.
+ */
+\set ON_ERROR_STOP on
+
+CREATE TABLE IF NOT EXISTS warc_queue (
+    id INTEGER GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+    warc_url TEXT UNIQUE NOT NULL,
+    inserted_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    claimed_at TIMESTAMPTZ,
+    claimed_by TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    finished_at TIMESTAMPTZ
+);
+CREATE INDEX IF NOT EXISTS warc_queue_unfinished_idx ON warc_queue (id) WHERE finished_at IS NULL;
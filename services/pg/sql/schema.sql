@@ -294,6 +294,8 @@ $$ LANGUAGE plpgsql;
  * see: https://en.wikipedia.org/wiki/UTM_parameters
  * see: https://github.com/mpchadwick/tracking-query-params-registry/blob/master/data.csv
  * for the sorting step, see: https://stackoverflow.com/questions/2913368/sorting-array-elements
+ * the "C" collation makes the order independent of the database's locale,
+ * so that it matches the python version in urlkeys.py
  */
 CREATE OR REPLACE FUNCTION query_simplify(query TEXT)
 RETURNS TEXT LANGUAGE plpgsql IMMUTABLE STRICT PARALLEL SAFE
@@ -302,7 +304,7 @@ BEGIN
     RETURN array_to_string(array(
         SELECT * FROM unnest(string_to_array(query,'&')) AS unnest
         WHERE unnest.unnest NOT LIKE 'utm_%'
-        ORDER BY unnest.unnest ASC
+        ORDER BY unnest.unnest COLLATE "C" ASC
     ),'&');
 END 
 $$;
@@ -589,76 +591,422 @@ CREATE VIEW qualitifyingnewsmediabias_summary AS (
  ******************************************************************************/
 
 /*
- * stores information about the source of the data
+ * stores information about the source of the data;
+ * the checkpoint columns are updated in the same transaction as each batch inserted from the source,
+ * and they record the byte offset and number of records in the source that have been committed
  */
 CREATE TABLE source (
     id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
     inserted_at TIMESTAMPTZ NOT NULL DEFAULT now(),
     finished_at TIMESTAMPTZ,
-    name TEXT UNIQUE NOT NULL
+    name TEXT UNIQUE NOT NULL,
+    checkpoint_offset BIGINT NOT NULL DEFAULT 0,
+    checkpoint_records BIGINT NOT NULL DEFAULT 0
 );
 INSERT INTO source (id,name) VALUES (-1,'metahtml');
 
 /*
- * The primary table for storing extracted content
+ * a queue of warc files waiting to be inserted;
+ * loaders claim jobs with SELECT ... FOR UPDATE SKIP LOCKED,
+ * and claims older than the loader's timeout can be claimed again by another loader
+ */
+CREATE TABLE warc_queue (
+    id INTEGER GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+    warc_url TEXT UNIQUE NOT NULL,
+    inserted_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    claimed_at TIMESTAMPTZ,
+    claimed_by TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    finished_at TIMESTAMPTZ
+);
+CREATE INDEX warc_queue_unfinished_idx ON warc_queue (id) WHERE finished_at IS NULL;
+
+/*
+ * The primary table for storing extracted content;
+ * the host_key, hostpath_key, and hostpathquery_key columns are computed by the loaders (see urlkeys.py),
+ * and they equal url_host_key(url), url_hostpath_key(url), and url_hostpathquery_key(url);
+ * the language, timestamp_published, title_text, description, and type columns
+ * are copied by the loaders from the best values in the jsonb column,
+ * so that queries on these fields do not need to detoast the jsonb;
+ * snippet is the first words of the description and content that the search results display,
+ * and snippet_lemmas has the lemmas of each of these words, so that the matching words can be highlighted
+ *
+ * the table is partitioned by the month of accessed_at,
+ * and the loaders create the partitions with metahtml_create_partitions before inserting into them;
+ * every index defined on metahtml below is created separately on each partition,
+ * so vacuums, index builds, and inserts only touch the indexes of the partitions they use
+ *
+ * NOTE:
+ * postgres 13 does not support identity columns on partitioned tables,
+ * and every unique constraint must contain the partition key;
+ * so id comes from a sequence, the primary key is (id, accessed_at),
+ * and id_canonical cannot be a foreign key
  */
 
 CREATE TABLE metahtml (
-    id BIGINT GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+    id BIGSERIAL,
     id_source INTEGER NOT NULL REFERENCES source(id),
     accessed_at TIMESTAMPTZ NOT NULL,
     inserted_at TIMESTAMPTZ NOT NULL DEFAULT now(),
     url TEXT NOT NULL,
+    host_key TEXT NOT NULL,
+    hostpath_key TEXT NOT NULL,
+    hostpathquery_key TEXT NOT NULL,
     jsonb JSONB NOT NULL,
+    language TEXT,
+    timestamp_published TIMESTAMPTZ,
+    title_text TEXT,
+    description TEXT,
+    snippet TEXT,
+    snippet_lemmas TEXT,
+    type TEXT,
     title tsvector,
-    content tsvector
+    content tsvector,
+    simhash BIGINT,
+    id_canonical BIGINT,
+    PRIMARY KEY (id, accessed_at)
+) PARTITION BY RANGE (accessed_at);
+
+/*
+ * creates the monthly partitions of metahtml needed to store rows with the input accessed_at values;
+ * the partition boundaries are months in UTC no matter what the session's timezone is;
+ * partitions that already exist are skipped without taking any locks,
+ * so it is cheap for the loaders to call this function before every batch
+ */
+CREATE OR REPLACE FUNCTION metahtml_create_partitions(accessed_ats TIMESTAMPTZ[])
+RETURNS VOID LANGUAGE plpgsql
+AS $$
+DECLARE
+    month TIMESTAMP;
+    name TEXT;
+BEGIN
+    FOR month IN
+        SELECT DISTINCT date_trunc('month', accessed_at AT TIME ZONE 'UTC')
+        FROM unnest(accessed_ats) AS accessed_at
+        WHERE accessed_at IS NOT NULL
+    LOOP
+        name := 'metahtml_' || to_char(month, 'YYYY_MM');
+        IF to_regclass(name) IS NULL THEN
+            -- concurrent loaders may try to create the same partition
+            PERFORM pg_advisory_xact_lock(hashtext('metahtml_create_partitions'));
+            EXECUTE format(
+                'CREATE TABLE IF NOT EXISTS %I PARTITION OF metahtml FOR VALUES FROM (%L) TO (%L)',
+                name,
+                month AT TIME ZONE 'UTC',
+                (month + interval '1 month') AT TIME ZONE 'UTC'
+                );
+        END IF;
+    END LOOP;
+END
+$$;
+
+/*
+ * The rollups are tables that are maintained incrementally by the refresh_rollups procedure below.
+ * Every count is stored both as an hll sketch (the *_hll columns),
+ * which can be merged with the sketches of new rows using hll_union,
+ * and as the cardinality of that sketch, which is what the queries read.
+ *
+ * NOTE:
+ * the group by columns cannot be NULL because they are part of the primary key;
+ * rows with a NULL language are stored with language='',
+ * and rows with a NULL timestamp_published are stored with timestamp_published='-infinity'
+ */
+CREATE TABLE metahtml_rollup_host2 (
+    host TEXT NOT NULL,
+    url_hll hll NOT NULL,
+    hostpathquery_hll hll NOT NULL,
+    hostpath_hll hll NOT NULL,
+    url DOUBLE PRECISION NOT NULL,
+    hostpathquery DOUBLE PRECISION NOT NULL,
+    hostpath DOUBLE PRECISION NOT NULL,
+    PRIMARY KEY (host)
 );
 
-CREATE MATERIALIZED VIEW metahtml_rollup_host2 AS (
-    SELECT
-        hll_count(url) AS url,
-        hll_count(url_hostpathquery_key(url)) AS hostpathquery,
-        hll_count(url_hostpath_key(url)) AS hostpath,
-        url_host_key(url) AS host
-    FROM metahtml
-    GROUP BY host
+/*
+ * the primary keys of the month rollups are also covering indexes for the /ngrams time series query;
+ * all of the terms in a query are found with a single index-only scan
+ */
+CREATE TABLE metahtml_rollup_textlangmonth (
+    alltext TEXT NOT NULL,
+    language TEXT NOT NULL,
+    timestamp_published TIMESTAMPTZ NOT NULL,
+    url_hll hll NOT NULL,
+    hostpathquery_hll hll NOT NULL,
+    hostpath_hll hll NOT NULL,
+    url DOUBLE PRECISION NOT NULL,
+    hostpathquery DOUBLE PRECISION NOT NULL,
+    hostpath DOUBLE PRECISION NOT NULL,
+    PRIMARY KEY (language, alltext, timestamp_published) INCLUDE (hostpath)
 );
 
-CREATE MATERIALIZED VIEW metahtml_rollup_textlangmonth AS (
-    SELECT
-        unnest(tsvector_to_array(title || content)) AS alltext,
-        jsonb->'language'->'best'->>'value' AS language, 
-        date_trunc('month',(jsonb->'timestamp.published'->'best'->'value'->>'lo')::timestamptz) AS timestamp_published,
-        hll_count(url) AS url,
-        hll_count(url_hostpathquery_key(url)) AS hostpathquery,
-        hll_count(url_hostpath_key(url)) AS hostpath
-    FROM metahtml
-    GROUP BY alltext,language,timestamp_published
+CREATE TABLE metahtml_rollup_langmonth (
+    language TEXT NOT NULL,
+    timestamp_published TIMESTAMPTZ NOT NULL,
+    url_hll hll NOT NULL,
+    hostpathquery_hll hll NOT NULL,
+    hostpath_hll hll NOT NULL,
+    url DOUBLE PRECISION NOT NULL,
+    hostpathquery DOUBLE PRECISION NOT NULL,
+    hostpath DOUBLE PRECISION NOT NULL,
+    PRIMARY KEY (language, timestamp_published) INCLUDE (hostpath)
 );
 
-CREATE MATERIALIZED VIEW metahtml_rollup_langmonth AS (
-    SELECT
-        jsonb->'language'->'best'->>'value' AS language, 
-        date_trunc('month',(jsonb->'timestamp.published'->'best'->'value'->>'lo')::timestamptz) AS timestamp_published,
-        hll_count(url) AS url,
-        hll_count(url_hostpathquery_key(url)) AS hostpathquery,
-        hll_count(url_hostpath_key(url)) AS hostpath
-    FROM metahtml
-    GROUP BY language,timestamp_published
+/*
+ * the total hostpath count of each lemma over all months;
+ * the web app loads this table into memory for autocompleting and validating search terms,
+ * and max_id is the rollup_refresh.max_id of the refresh that last changed the row,
+ * so that the web app only reloads the rows that changed since its last load
+ */
+CREATE TABLE metahtml_rollup_textlang (
+    language TEXT NOT NULL,
+    alltext TEXT NOT NULL,
+    hostpath DOUBLE PRECISION NOT NULL,
+    max_id BIGINT NOT NULL,
+    PRIMARY KEY (language, alltext)
+);
+CREATE INDEX metahtml_rollup_textlang_max_id_idx ON metahtml_rollup_textlang (language, max_id);
+
+CREATE TABLE metahtml_rollup_insert (
+    insert_hour TIMESTAMPTZ NOT NULL,
+    id_source_hll hll NOT NULL,
+    url_hll hll NOT NULL,
+    hostpathquery_hll hll NOT NULL,
+    hostpath_hll hll NOT NULL,
+    host_hll hll NOT NULL,
+    id_source DOUBLE PRECISION NOT NULL,
+    url DOUBLE PRECISION NOT NULL,
+    hostpathquery DOUBLE PRECISION NOT NULL,
+    hostpath DOUBLE PRECISION NOT NULL,
+    host DOUBLE PRECISION NOT NULL,
+    PRIMARY KEY (insert_hour)
 );
 
-CREATE MATERIALIZED VIEW metahtml_rollup_insert AS (
-    SELECT
-        date_trunc('hour', inserted_at) AS insert_hour,
-        hll_count(id_source),
-        hll_count(url) AS url,
-        hll_count(url_hostpathquery_key(url)) AS hostpathquery,
-        hll_count(url_hostpath_key(url)) AS hostpath,
-        hll_count(url_host_key(url)) AS host
-    FROM metahtml
-    GROUP BY insert_hour
+/*
+ * every refresh of the rollups that finds new rows adds a row to rollup_refresh;
+ * max_id is the largest metahtml.id that has been merged into the rollups,
+ * and the web app's query cache watches this table to know when its entries are stale
+ */
+CREATE TABLE rollup_refresh (
+    id INTEGER GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+    refreshed_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    max_id BIGINT NOT NULL DEFAULT 0
 );
 
+/*
+ * merges the rows of metahtml with start_id < id <= end_id into the rollups;
+ * merging the same rows twice leaves the sketches unchanged, because hll_union is idempotent
+ */
+CREATE OR REPLACE PROCEDURE rollups_merge(start_id BIGINT, end_id BIGINT)
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    INSERT INTO metahtml_rollup_host2 AS r
+    SELECT
+        host,
+        url_hll,
+        hostpathquery_hll,
+        hostpath_hll,
+        hll_cardinality(url_hll),
+        hll_cardinality(hostpathquery_hll),
+        hll_cardinality(hostpath_hll)
+    FROM (
+        SELECT
+            host_key AS host,
+            hll_add_agg(hll_hash_text(url)) AS url_hll,
+            hll_add_agg(hll_hash_text(hostpathquery_key)) AS hostpathquery_hll,
+            hll_add_agg(hll_hash_text(hostpath_key)) AS hostpath_hll
+        FROM metahtml
+        WHERE id > start_id AND id <= end_id
+        GROUP BY host_key
+    ) AS new
+    ON CONFLICT (host) DO UPDATE SET
+        url_hll = hll_union(r.url_hll, excluded.url_hll),
+        hostpathquery_hll = hll_union(r.hostpathquery_hll, excluded.hostpathquery_hll),
+        hostpath_hll = hll_union(r.hostpath_hll, excluded.hostpath_hll),
+        url = hll_cardinality(hll_union(r.url_hll, excluded.url_hll)),
+        hostpathquery = hll_cardinality(hll_union(r.hostpathquery_hll, excluded.hostpathquery_hll)),
+        hostpath = hll_cardinality(hll_union(r.hostpath_hll, excluded.hostpath_hll));
+
+    INSERT INTO metahtml_rollup_textlangmonth AS r
+    SELECT
+        alltext,
+        language,
+        timestamp_published,
+        url_hll,
+        hostpathquery_hll,
+        hostpath_hll,
+        hll_cardinality(url_hll),
+        hll_cardinality(hostpathquery_hll),
+        hll_cardinality(hostpath_hll)
+    FROM (
+        SELECT
+            alltext,
+            language,
+            timestamp_published,
+            hll_add_agg(hll_hash_text(url)) AS url_hll,
+            hll_add_agg(hll_hash_text(hostpathquery_key)) AS hostpathquery_hll,
+            hll_add_agg(hll_hash_text(hostpath_key)) AS hostpath_hll
+        FROM (
+            SELECT
+                unnest(tsvector_to_array(title || content)) AS alltext,
+                COALESCE(language, '') AS language,
+                COALESCE(date_trunc('month', timestamp_published), '-infinity') AS timestamp_published,
+                url,
+                hostpathquery_key,
+                hostpath_key
+            FROM metahtml
+            WHERE id > start_id AND id <= end_id
+        ) AS t
+        GROUP BY alltext, language, timestamp_published
+    ) AS new
+    ON CONFLICT (language, alltext, timestamp_published) DO UPDATE SET
+        url_hll = hll_union(r.url_hll, excluded.url_hll),
+        hostpathquery_hll = hll_union(r.hostpathquery_hll, excluded.hostpathquery_hll),
+        hostpath_hll = hll_union(r.hostpath_hll, excluded.hostpath_hll),
+        url = hll_cardinality(hll_union(r.url_hll, excluded.url_hll)),
+        hostpathquery = hll_cardinality(hll_union(r.hostpathquery_hll, excluded.hostpathquery_hll)),
+        hostpath = hll_cardinality(hll_union(r.hostpath_hll, excluded.hostpath_hll));
+
+    INSERT INTO metahtml_rollup_langmonth AS r
+    SELECT
+        language,
+        timestamp_published,
+        url_hll,
+        hostpathquery_hll,
+        hostpath_hll,
+        hll_cardinality(url_hll),
+        hll_cardinality(hostpathquery_hll),
+        hll_cardinality(hostpath_hll)
+    FROM (
+        SELECT
+            language,
+            timestamp_published,
+            hll_add_agg(hll_hash_text(url)) AS url_hll,
+            hll_add_agg(hll_hash_text(hostpathquery_key)) AS hostpathquery_hll,
+            hll_add_agg(hll_hash_text(hostpath_key)) AS hostpath_hll
+        FROM (
+            SELECT
+                COALESCE(language, '') AS language,
+                COALESCE(date_trunc('month', timestamp_published), '-infinity') AS timestamp_published,
+                url,
+                hostpathquery_key,
+                hostpath_key
+            FROM metahtml
+            WHERE id > start_id AND id <= end_id
+        ) AS t
+        GROUP BY language, timestamp_published
+    ) AS new
+    ON CONFLICT (language, timestamp_published) DO UPDATE SET
+        url_hll = hll_union(r.url_hll, excluded.url_hll),
+        hostpathquery_hll = hll_union(r.hostpathquery_hll, excluded.hostpathquery_hll),
+        hostpath_hll = hll_union(r.hostpath_hll, excluded.hostpath_hll),
+        url = hll_cardinality(hll_union(r.url_hll, excluded.url_hll)),
+        hostpathquery = hll_cardinality(hll_union(r.hostpathquery_hll, excluded.hostpathquery_hll)),
+        hostpath = hll_cardinality(hll_union(r.hostpath_hll, excluded.hostpath_hll));
+
+    INSERT INTO metahtml_rollup_insert AS r
+    SELECT
+        insert_hour,
+        id_source_hll,
+        url_hll,
+        hostpathquery_hll,
+        hostpath_hll,
+        host_hll,
+        hll_cardinality(id_source_hll),
+        hll_cardinality(url_hll),
+        hll_cardinality(hostpathquery_hll),
+        hll_cardinality(hostpath_hll),
+        hll_cardinality(host_hll)
+    FROM (
+        SELECT
+            date_trunc('hour', inserted_at) AS insert_hour,
+            hll_add_agg(hll_hash_integer(id_source)) AS id_source_hll,
+            hll_add_agg(hll_hash_text(url)) AS url_hll,
+            hll_add_agg(hll_hash_text(hostpathquery_key)) AS hostpathquery_hll,
+            hll_add_agg(hll_hash_text(hostpath_key)) AS hostpath_hll,
+            hll_add_agg(hll_hash_text(host_key)) AS host_hll
+        FROM metahtml
+        WHERE id > start_id AND id <= end_id
+        GROUP BY date_trunc('hour', inserted_at)
+    ) AS new
+    ON CONFLICT (insert_hour) DO UPDATE SET
+        id_source_hll = hll_union(r.id_source_hll, excluded.id_source_hll),
+        url_hll = hll_union(r.url_hll, excluded.url_hll),
+        hostpathquery_hll = hll_union(r.hostpathquery_hll, excluded.hostpathquery_hll),
+        hostpath_hll = hll_union(r.hostpath_hll, excluded.hostpath_hll),
+        host_hll = hll_union(r.host_hll, excluded.host_hll),
+        id_source = hll_cardinality(hll_union(r.id_source_hll, excluded.id_source_hll)),
+        url = hll_cardinality(hll_union(r.url_hll, excluded.url_hll)),
+        hostpathquery = hll_cardinality(hll_union(r.hostpathquery_hll, excluded.hostpathquery_hll)),
+        hostpath = hll_cardinality(hll_union(r.hostpath_hll, excluded.hostpath_hll)),
+        host = hll_cardinality(hll_union(r.host_hll, excluded.host_hll));
+END
+$$;
+
+/*
+ * recomputes the rows of metahtml_rollup_textlang for the lemmas in the rows of metahtml with start_id < id <= end_id;
+ * must be called after rollups_merge has merged these rows into metahtml_rollup_textlangmonth
+ */
+CREATE OR REPLACE PROCEDURE rollups_merge_terms(start_id BIGINT, end_id BIGINT)
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    INSERT INTO metahtml_rollup_textlang AS r (language, alltext, hostpath, max_id)
+    SELECT
+        language,
+        alltext,
+        sum(hostpath),
+        end_id
+    FROM metahtml_rollup_textlangmonth
+    WHERE (language, alltext) IN (
+        SELECT
+            COALESCE(language, ''),
+            unnest(tsvector_to_array(title || content))
+        FROM metahtml
+        WHERE id > start_id AND id <= end_id
+    )
+    GROUP BY language, alltext
+    ON CONFLICT (language, alltext) DO UPDATE SET
+        hostpath = excluded.hostpath,
+        max_id = excluded.max_id;
+END
+$$;
+
+/*
+ * merges the rows inserted since the last refresh into the rollups,
+ * so the cost of a refresh depends only on the number of new rows;
+ * it must be called outside of a transaction block, because it commits
+ *
+ * metahtml.id comes from a sequence, and a transaction may commit a row after a transaction with a larger id;
+ * so the high-water mark is read from the sequence while holding a lock that waits for all in-progress inserts to finish,
+ * and every row with a smaller id has been committed once the lock is released
+ */
+CREATE OR REPLACE PROCEDURE refresh_rollups(batch_size BIGINT DEFAULT 1000000)
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    start_id BIGINT;
+    end_id BIGINT;
+BEGIN
+    LOCK TABLE metahtml IN EXCLUSIVE MODE;
+    end_id := COALESCE(pg_sequence_last_value(pg_get_serial_sequence('metahtml', 'id')), 0);
+    COMMIT;
+
+    -- the new rows are merged in batches that each commit,
+    -- so that a large backlog of rows does not hold its locks for hours
+    SELECT COALESCE(max(max_id), 0) INTO start_id FROM rollup_refresh;
+    WHILE start_id < end_id LOOP
+        CALL rollups_merge(start_id, LEAST(start_id + batch_size, end_id));
+        CALL rollups_merge_terms(start_id, LEAST(start_id + batch_size, end_id));
+        start_id := LEAST(start_id + batch_size, end_id);
+        INSERT INTO rollup_refresh (max_id) VALUES (start_id);
+        COMMIT;
+    END LOOP;
+END
+$$;
+
+SELECT cron.schedule('*/10 * * * *', 'CALL refresh_rollups()');
+
 /* indexes for text search of the form
 
 SELECT
@@ -672,9 +1020,65 @@ WHERE
     spacy_tsquery('en', 'covid');
 */
 
+CREATE INDEX metahtml_host_key_idx ON metahtml (host_key text_pattern_ops);
+CREATE INDEX metahtml_language_published_idx ON metahtml (language, timestamp_published);
+CREATE INDEX metahtml_published_brinidx ON metahtml USING brin (timestamp_published);
+
 CREATE INDEX metahtml_title_rumidx ON metahtml USING rum (title) ;
 CREATE INDEX metahtml_content_rumidx ON metahtml USING rum (content) ;
 
+/*
+ * the /search page ranks results by the RUM distance between this tsvector and the query;
+ * the title lexemes get weight A and the content lexemes get weight D,
+ * so matches in the title count more than matches in the content
+ */
+CREATE OR REPLACE FUNCTION metahtml_search_tsvector(title tsvector, content tsvector)
+RETURNS tsvector LANGUAGE sql IMMUTABLE PARALLEL SAFE
+AS $$
+    SELECT setweight(COALESCE(title, ''::tsvector), 'A') || setweight(COALESCE(content, ''::tsvector), 'D');
+$$;
+
+CREATE INDEX metahtml_search_rumidx ON metahtml USING rum (metahtml_search_tsvector(title, content));
+
+/*
+ * the loaders store a 64 bit SimHash of each document's content lemmas (see fingerprint.py);
+ * the SimHash is split into 5 blocks, and every pair of blocks forms one of its 10 keys;
+ * two SimHashes within 3 bits of each other share at least one key,
+ * so the near-duplicates of a SimHash are found by looking up the rows that share any key in the GIN index;
+ * id_canonical links a near-duplicate to the first copy of the document that was inserted
+ */
+CREATE OR REPLACE FUNCTION simhash_keys(simhash BIGINT)
+RETURNS INTEGER[] LANGUAGE sql IMMUTABLE STRICT PARALLEL SAFE
+AS $$
+    SELECT array_agg((
+        (pair::BIGINT << 26) |
+        ((simhash >> offset_a) & ((1::BIGINT << width_a) - 1)) |
+        (((simhash >> offset_b) & ((1::BIGINT << width_b) - 1)) << width_a)
+        )::INTEGER ORDER BY pair)
+    FROM (VALUES
+        (0, 0, 13, 13, 13),
+        (1, 0, 13, 26, 13),
+        (2, 0, 13, 39, 13),
+        (3, 0, 13, 52, 12),
+        (4, 13, 13, 26, 13),
+        (5, 13, 13, 39, 13),
+        (6, 13, 13, 52, 12),
+        (7, 26, 13, 39, 13),
+        (8, 26, 13, 52, 12),
+        (9, 39, 13, 52, 12)
+    ) AS pairs(pair, offset_a, width_a, offset_b, width_b);
+$$;
+
+do $$
+BEGIN
+    assert( simhash_keys(-1) = ARRAY[67108863, 134217727, 201326591, 234881023, 335544319, 402653183, 436207615, 536870911, 570425343, 637534207] );
+    assert( simhash_keys(281483566841860) = ARRAY[196612, 68157444, 138412036, 201326596, 269484056, 339738648, 402653208, 473956480, 536871040, 603980288] );
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE INDEX metahtml_simhash_keys_idx ON metahtml USING gin (simhash_keys(simhash));
+CREATE INDEX metahtml_id_canonical_idx ON metahtml (id_canonical) WHERE id_canonical IS NOT NULL;
+
 COMMIT;
 
 
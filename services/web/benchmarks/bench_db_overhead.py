@@ -0,0 +1,107 @@
+#!/usr/bin/python3
+'''
+Measures the per-request database overhead of the web app.
+
+The "connect" measurements compare opening a new connection for every request
+(what before_request used to do) with checking a connection out of the web app's pool;
+each request runs a trivial statement so that the connection is actually used.
+
+The "timeseries" and "ngrams" measurements compare running the hot statements of /ngrams as plain SQL,
+which postgres parses and plans on every execution,
+with running them as prepared statements on a pooled connection.
+
+Run from the services/web directory of the web container,
+so that the web app's configuration and pgbouncer are used:
+
+    $ python3 benchmarks/bench_db_overhead.py --repeat 200 --terms 'war peace'
+'''
+import json
+import os
+import statistics
+import sys
+import time
+import sqlalchemy
+from sqlalchemy.sql import text
+
+# the benchmarks import the web app from the parent directory
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+
+def time_requests(engine, repeat, request):
+    '''
+    Returns the number of seconds that each of repeat calls to request(connection) takes,
+    including the time to get the connection from engine and to give it back.
+    '''
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        with engine.connect() as connection:
+            request(connection)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def summarize(times):
+    return {
+        'median_ms': statistics.median(times) * 1000,
+        'p95_ms': sorted(times)[int(len(times)*0.95)] * 1000,
+        'min_ms': min(times) * 1000,
+        }
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--terms', default='war peace', help='space separated lemmas for the /ngrams statements')
+    parser.add_argument('--output', help='file to write the json results to; defaults to stdout')
+    args = parser.parse_args()
+
+    import project
+    from project import timeseries
+    terms = args.terms.split()
+
+    # an engine without a pool opens a new connection for every request
+    unpooled = sqlalchemy.create_engine(
+        project.app.config['DB_URI'],
+        poolclass=sqlalchemy.pool.NullPool,
+        connect_args={'connect_timeout': 10},
+        )
+    pooled = project.engine
+    plain = pooled.execution_options(prepared_statements=False)
+    prepared = pooled.execution_options(prepared_statements=True)
+
+    def select_1(connection):
+        connection.execute(text('SELECT 1')).scalar()
+
+    def get_timeseries(connection):
+        timeseries.get_timeseries(connection, terms)
+
+    def ngrams(connection):
+        project.ngrams_statement.execute(connection, {'ts_query': ' & '.join(terms)}).fetchall()
+
+    benchmarks = {
+        'connect/unpooled': (unpooled, select_1),
+        'connect/pooled': (pooled, select_1),
+        'timeseries/plain': (plain, get_timeseries),
+        'timeseries/prepared': (prepared, get_timeseries),
+        'ngrams/plain': (plain, ngrams),
+        'ngrams/prepared': (prepared, ngrams),
+        }
+
+    results = {
+        'pool_mode': project.app.config['POOL_MODE'],
+        'repeat': args.repeat,
+        'terms': terms,
+        }
+    for name, (engine, request) in benchmarks.items():
+        # the first requests fill the pool and prepare the statements
+        time_requests(engine, 5, request)
+        results[name] = summarize(time_requests(engine, args.repeat, request))
+
+    output = json.dumps(results, indent=4)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
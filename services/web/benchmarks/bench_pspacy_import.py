@@ -0,0 +1,60 @@
+#!/usr/bin/python3
+'''
+Measures how long it takes to import pspacy.
+
+Each measurement runs in a fresh python process so that nothing is already imported or cached.
+The "eager" measurement repeats the work that importing pspacy used to do
+(loading the 'xx' model and building a translation table of all 1.1M code points),
+so the difference between "import" and "eager" is the startup time that is saved
+by every web worker, loader, and postgres backend.
+
+Run from the services/web directory:
+
+    $ python3 benchmarks/bench_pspacy_import.py --repeat 5
+'''
+import json
+import statistics
+import subprocess
+import sys
+
+statements = {
+    'import': 'import pspacy',
+    'eager': \
+        'import pspacy, sys, unicodedata; ' +
+        'pspacy.get_nlp("xx"); ' +
+        'dict.fromkeys(i for i in range(0, sys.maxunicode + 1) if unicodedata.category(chr(i)).startswith(("P", "S", "C")))',
+    'import+lemmatize': 'import pspacy; pspacy.lemmatize("en", "Abraham Lincoln was president of the United States")',
+    }
+
+
+def time_statement(statement):
+    '''
+    Returns the number of seconds that a new python process takes to run statement.
+    '''
+    code = 'import time; start = time.perf_counter(); ' + statement + '; print(time.perf_counter() - start)'
+    output = subprocess.run([sys.executable, '-c', code], check=True, capture_output=True, text=True).stdout
+    return float(output.split()[-1])
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', help='file to write the json results to; defaults to stdout')
+    args = parser.parse_args()
+
+    results = {}
+    for name, statement in statements.items():
+        times = [ time_statement(statement) for i in range(args.repeat) ]
+        results[name] = {
+            'median_seconds': statistics.median(times),
+            'min_seconds': min(times),
+            'times': times,
+            }
+
+    output = json.dumps(results, indent=4)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
@@ -1,16 +1,38 @@
 # imports
+import base64
+import binascii
+import json
 import os
-import time
+import numpy as np
 import sqlalchemy
 import pspacy
 from sqlalchemy.sql import text
-from flask import Flask, jsonify, send_from_directory, render_template, g, request
+from project import timeseries
+from project.autocomplete import TermIndex
+from project.cache import QueryCache
+from project.db import PreparedStatement
+from project.metrics import Metrics
+from project.seriesstore import SeriesStore
+from flask import Flask, Response, abort, jsonify, send_from_directory, render_template, stream_with_context, g, request
 from flask_sqlalchemy import SQLAlchemy
 
 # creates the flask app
 app = Flask(__name__)
 app.config.from_object('project.config.Config')
 
+# the cache is shared by all of the worker processes on this host
+cache = QueryCache(
+    app.config['CACHE_PATH'],
+    max_entries=app.config['CACHE_MAX_ENTRIES'],
+    ttl=app.config['CACHE_TTL'],
+    check_interval=app.config['CACHE_CHECK_INTERVAL'],
+    touch_interval=app.config['CACHE_TOUCH_INTERVAL'],
+    flush_interval=app.config['CACHE_FLUSH_INTERVAL'],
+    )
+
+# the request timings are kept separately by every worker process
+metrics = Metrics(explain_sample_rate=app.config['EXPLAIN_SAMPLE_RATE'])
+
 
 def dict2html(d):
     html='<table>'
@@ -51,6 +73,172 @@ def res2html(res,col_formatter=None,transpose=False,click_headers=False):
     html+='</table>'
     return html
 
+@app.template_global()
+def highlight_snippet(snippet, snippet_lemmas, terms):
+    '''
+    Returns a list of (word, matched) pairs for displaying a search result's snippet,
+    where matched is True if one of the word's lemmas is in terms;
+    the snippet and snippet_lemmas columns are computed by the loaders when they insert a row.
+
+    >>> highlight_snippet('The wars of states.', ' war  state', ['state', 'president'])
+    [('The', False), ('wars', False), ('of', False), ('states.', True)]
+    >>> highlight_snippet(None, None, ['state'])
+    []
+    '''
+    if snippet is None:
+        return []
+    words = snippet.split(' ')
+    if snippet_lemmas is None:
+        lemmas = [''] * len(words)
+    else:
+        lemmas = snippet_lemmas.split(' ')
+    terms = set(terms)
+    return [ (word, any(lemma in terms for lemma in word_lemmas.split('|'))) for word, word_lemmas in zip(words, lemmas) ]
+
+
+def lemmatize_query_cached(lang, query):
+    '''
+    The lemmatization doesn't depend on the database,
+    so it is cached by the normalized query text and never invalidated by the rollups.
+    '''
+    normalized_query = ' '.join(query.lower().split())
+    with metrics.span('lemmatize'):
+        ts_query = cache.get('lemmas:'+lang+':'+normalized_query)
+        if ts_query is None:
+            ts_query = pspacy.lemmatize_query(lang, query)
+            cache.set('lemmas:'+lang+':'+normalized_query, ts_query)
+    return ts_query
+
+
+def stream_template(template_name, **context):
+    '''
+    Like render_template, but the page is sent to the client as it is rendered;
+    this is the pattern from https://flask.palletsprojects.com/en/1.1.x/patterns/streaming/
+
+    NOTE:
+    the Server-Timing header is sent before the page is rendered,
+    so it only contains the spans recorded before streaming starts;
+    the /metrics histograms include the whole request (see Metrics.finish_request)
+    '''
+    app.update_template_context(context)
+    template = app.jinja_env.get_template(template_name)
+    return Response(stream_with_context(template.stream(context)), mimetype='text/html')
+
+
+def encode_cursor(distance, ids):
+    '''
+    >>> decode_cursor(encode_cursor(0.0607927, [12345, 678]))
+    (0.0607927, [12345, 678])
+    '''
+    return base64.urlsafe_b64encode(json.dumps([distance, ids]).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    '''
+    Raises ValueError if the cursor was not created by encode_cursor.
+
+    >>> decode_cursor('not a cursor')
+    Traceback (most recent call last):
+        ...
+    ValueError: invalid cursor
+    '''
+    try:
+        distance, ids = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return float(distance), [ int(id) for id in ids ]
+    except (TypeError, ValueError, UnicodeError, binascii.Error):
+        raise ValueError('invalid cursor')
+
+
+def estimate_count(connection, sql, params):
+    '''
+    Returns the planner's estimate of the number of rows returned by sql;
+    this is much faster than count(*) for queries that match many rows.
+    '''
+    plan = connection.execute(text('EXPLAIN (FORMAT JSON) '+sql), params).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]['Plan']['Plan Rows']
+
+################################################################################
+# the hot statements are prepared once per pooled connection (see project/db.py)
+################################################################################
+
+# only the best values of the displayed keys are sent to the client;
+# jsonb_each reads the jsonb column once, so it is only detoasted once
+metahtml_statement = PreparedStatement(
+    'metahtml',
+    '''
+    SELECT
+        accessed_at,
+        inserted_at,
+        url,
+        title_text AS title,
+        (
+            SELECT jsonb_object_agg(key, value->'best'->'value')
+            FROM jsonb_each(jsonb)
+            WHERE key IN ('author', 'timestamp.published', 'timestamp.modified', 'url.canonical', 'language', 'version', 'content')
+        ) AS fields
+    FROM metahtml
+    WHERE id=:id
+    ''',
+    id='BIGINT',
+    )
+
+ngrams_statement = PreparedStatement(
+    'ngrams',
+    '''
+    SELECT
+        id,
+        title_text AS title,
+        description,
+        snippet,
+        snippet_lemmas
+    FROM metahtml
+    WHERE
+        to_tsquery('simple', :ts_query) @@ content AND
+        type = 'article'
+    OFFSET 0
+    LIMIT 10
+    ''',
+    ts_query='TEXT',
+    )
+
+# the results are ranked by the RUM distance on metahtml_search_tsvector,
+# which weights title lexemes above content lexemes;
+# the ORDER BY contains only the <=> distance so that it is answered by an ordered scan of metahtml_search_rumidx,
+# and the keyset condition replaces OFFSET for deeper pages (see the NOTE in the search route);
+# <=> returns a REAL, so the cursor's distance is compared as a REAL too,
+# otherwise the rounding of the promoted distance would repeat or skip the rows tied with the last result
+search_statement = PreparedStatement(
+    'search',
+    '''
+    SELECT
+        id,
+        title_text AS title,
+        description,
+        snippet,
+        snippet_lemmas,
+        metahtml_search_tsvector(title, content) <=> to_tsquery('simple', :ts_query) AS distance
+    FROM metahtml
+    WHERE
+        metahtml_search_tsvector(title, content) @@ to_tsquery('simple', :ts_query) AND
+        (
+            CAST(:last_distance AS REAL) IS NULL OR
+            metahtml_search_tsvector(title, content) <=> to_tsquery('simple', :ts_query) > CAST(:last_distance AS REAL) OR
+            (
+                metahtml_search_tsvector(title, content) <=> to_tsquery('simple', :ts_query) = CAST(:last_distance AS REAL) AND
+                id <> ALL (CAST(:last_ids AS BIGINT[]))
+            )
+        )
+    ORDER BY metahtml_search_tsvector(title, content) <=> to_tsquery('simple', :ts_query)
+    LIMIT :limit
+    ''',
+    ts_query='TEXT',
+    last_distance='REAL',
+    last_ids='BIGINT[]',
+    limit='BIGINT',
+    )
+
 ################################################################################
 # routes
 ################################################################################
@@ -71,43 +259,52 @@ def metahtml():
             'metahtml',
             )
     else:
-        sql=text(f'''
-        SELECT 
-            accessed_at,
-            inserted_at,
-            url,
-            jsonb
-        FROM metahtml
-        WHERE id=:id
-        ''')
-        res = g.connection.execute(sql,{
+        res = metahtml_statement.execute(get_connection(), {
             'id':id
             }).first()
+        if res is None:
+            abort(404)
 
+        fields = res['fields'] or {}
         jsonb = {}
         for key in ['author','timestamp.published','timestamp.modified','url.canonical','language','version']:
-            try:
-                value = res['jsonb'][key]['best']['value']
-            except (TypeError,KeyError):
-            #except KeyError:
+            value = fields.get(key)
+            if value is None:
                 value = ''
             jsonb[key] = value
         jsonb_html = dict2html(jsonb)
         try:
-            title = res['jsonb']['title']['best']['value']
-            content = res['jsonb']['content']['best']['value']['html']
-        except KeyError:
-            title = None
+            content = fields['content']['html']
+        except (TypeError,KeyError):
             content = None
 
         return render_template(
             'metahtml.html',
-            title = title,
+            title = res['title'],
             content = content,
             jsonb_html = jsonb_html
             )
 
 
+def ngrams_terms(query):
+    '''
+    Returns the pair (ts_query, terms) for the /ngrams, /ngrams/series, and /search routes.
+    '''
+    ts_query = lemmatize_query_cached('en', query)
+    terms = [ term for term in ts_query.split() if term != '&' ]
+    return ts_query, terms
+
+
+def unknown_ngrams_terms(terms):
+    '''
+    A term that is not in the rollups has no time series,
+    and the search results must contain every term,
+    so queries with unknown terms are answered without touching the database.
+    '''
+    term_index.maybe_refresh()
+    return [ term for term in terms if term_index.contains(term) is False ]
+
+
 @app.route('/ngrams')
 def ngrams():
 
@@ -115,128 +312,315 @@ def ngrams():
     if query is None:
         return index()
 
-    ts_query = pspacy.lemmatize_query('en', query)
-
-    terms = [ term for term in ts_query.split() if term != '&' ]
+    ts_query, terms = ngrams_terms(query)
 
     if len(terms)<1:
         return render_template(
             'fullsearch.html',
             )
 
-    sql=text(f'''
-    select  
-        extract(epoch from x.time ) as x,
-        '''+
-        ''',
-        '''.join([f'''
-        coalesce(y{i}/total.total,0) as y{i}
-        ''' for i,term in enumerate(terms) ])
-        +'''
-    from (
-        select generate_series('2000-01-01', '2020-12-31', '1 month'::interval) as time
-    ) as x
-    left outer join (
-        select
-            hostpath as total,
-            timestamp_published as time
-        from metahtml_rollup_langmonth
-        where 
-                language = 'en'
-            and timestamp_published >= '2000-01-01 00:00:00' 
-            and timestamp_published <= '2020-12-31 23:59:59'
-    ) total on total.time=x.time
-    '''
-    +'''
-    '''.join([f'''
-    left outer join (
-        select
-            hostpath as y{i},
-            timestamp_published as time
-        from metahtml_rollup_textlangmonth
-        where 
-            alltext = :term{i}
-            and language = 'en'
-            and timestamp_published >= '2000-01-01 00:00:00' 
-            and timestamp_published <= '2020-12-31 23:59:59'
-    ) y{i} on x.time=y{i}.time
-    ''' for i,term in enumerate(terms) ])
-    +
-    '''
-    order by x asc;
-    ''')
-    res = list(g.connection.execute(sql,{
-        f'term{i}':term
-        for i,term in enumerate(terms)
-        }))
-    x = [ row.x for row in res ]
-    ys = [ [ row[i+1] for row in res ] for i,term in enumerate(terms) ] 
-    colors = ['red','green','blue','black','purple','orange','pink','aqua']
+    unknown_terms = unknown_ngrams_terms(terms)
+    if len(unknown_terms)>0:
+        return render_template(
+            'fullsearch.html',
+            query=query,
+            unknown_terms=unknown_terms,
+            )
 
+    # the search results are cached by the ts_query,
+    # so different queries with the same lemmas share an entry;
+    # on a cache hit, the database is only queried for the rollup generation (at most once every CACHE_CHECK_INTERVAL)
+    def iter_results():
+        cache.check_generation(get_connection)
+        results = cache.get('ngrams:results:en:'+ts_query)
+        if results is None:
+            res = ngrams_statement.execute(get_connection(), {
+                'ts_query':ts_query
+                })
+            results = [ dict(row) for row in res ]
+            cache.set('ngrams:results:en:'+ts_query, results)
+        yield from results
+
+    # the page is streamed, so the search box is sent before the results are queried;
+    # the chart fetches its data from /ngrams/series once the page has loaded
+    return stream_template(
+        'fullsearch.html',
+        query=query,
+        terms=terms,
+        results=iter_results(),
+        )
 
-    sql=text(f'''
-    SELECT 
-        id,
-        jsonb->'title'->'best'->>'value' AS title,
-        jsonb->'description'->'best'->>'value' AS description
-    FROM metahtml
-    WHERE
-        to_tsquery('simple', :ts_query) @@ content AND
-        jsonb->'type'->'best'->>'value' = 'article'
-    OFFSET 0
-    LIMIT 10
-    ''')
-    res=g.connection.execute(sql,{
-        'ts_query':ts_query
+
+@app.route('/ngrams/series')
+def ngrams_series():
+    '''
+    Returns the time series of the terms in the query for the /ngrams chart.
+
+    With format=json, the response is an object with the lists terms, x (unix timestamps), and ys (one list per term).
+    With format=f32, the response is binary:
+    the x values as little endian float64s followed by the ys as little endian float32s, one term after another;
+    the terms are in the X-Series-Terms header as a json list,
+    and the number of x values is in the X-Series-Months header.
+    The f32 format is about a quarter the size of the json format.
+    '''
+    query = request.args.get('query')
+    format = request.args.get('format', 'json')
+    if query is None or format not in ['json', 'f32']:
+        abort(400)
+
+    ts_query, terms = ngrams_terms(query)
+    if len(unknown_ngrams_terms(terms))>0:
+        abort(404)
+
+    # the series store answers without the database;
+    # until its file has been built, the series are computed from the rollups and cached
+    series_store.maybe_refresh()
+    with metrics.span('series_store'):
+        cached = series_store.get(terms)
+    if cached is None:
+        cache.check_generation(get_connection)
+        cached = cache.get('ngrams:series:en:'+ts_query)
+        if cached is None:
+            cached = timeseries.get_timeseries(get_connection(), terms)
+            cache.set('ngrams:series:en:'+ts_query, cached)
+    x, ys = cached
+
+    if format == 'f32':
+        response = Response(
+            np.asarray(x, dtype='<f8').tobytes() + np.asarray(ys, dtype='<f4').tobytes(),
+            mimetype='application/octet-stream',
+            )
+        response.headers['X-Series-Terms'] = json.dumps(terms)
+        response.headers['X-Series-Months'] = str(len(x))
+        return response
+    return jsonify({
+        'terms': terms,
+        'x': x,
+        'ys': ys,
         })
+
+
+def search_page(connection, ts_query, last_distance, last_ids, limit):
+    '''
+    Returns the results after the cursor (last_distance, last_ids) and the cursor of the next page;
+    the next cursor is None on the last page.
+    '''
+    results = list(search_statement.execute(connection, {
+        'ts_query':ts_query,
+        'last_distance':last_distance,
+        'last_ids':last_ids,
+        'limit':limit,
+        }))
+
+    if len(results) == limit:
+        distance = results[-1].distance
+        ids = [ result.id for result in results if result.distance == distance ]
+        if distance == last_distance:
+            ids = last_ids + ids
+        next_cursor = encode_cursor(distance, ids)
+    else:
+        next_cursor = None
+    return results, next_cursor
+
+
+@app.route('/search')
+def search():
+    '''
+    NOTE:
+    RUM can only return rows in <=> order starting from the smallest distance,
+    so the keyset condition is a filter on the ordered index scan and not a seek;
+    a deep page still walks the index entries of the earlier pages, but it does not fetch and sort them.
+    Rows with equal distances come out of the scan in no particular order,
+    so the cursor excludes the ids already shown at the last distance instead of comparing ids;
+    a long run of tied distances makes the cursor grow by one id per result.
+    The plan should be checked with EXPLAIN to show an Index Scan using metahtml_search_rumidx
+    with an Order By on <=> and no Sort node.
+    '''
+
+    query = request.args.get('query')
+    if query is None:
+        return index()
+
+    ts_query, terms = ngrams_terms(query)
+    if len(terms)<1:
+        return render_template(
+            'search.html',
+            query=query,
+            )
+
+    # the cursor contains the distance of the last result on the previous pages,
+    # and the ids of the results already shown at that distance
+    cursor = request.args.get('cursor')
+    if cursor is not None:
+        try:
+            last_distance, last_ids = decode_cursor(cursor)
+        except ValueError:
+            abort(400)
+    else:
+        last_distance, last_ids = None, []
+
+    results, next_cursor = search_page(get_connection(), ts_query, last_distance, last_ids, app.config['SEARCH_RESULTS_PER_PAGE'])
+
     return render_template(
-        'fullsearch.html',
+        'search.html',
         query=query,
-        results=res,
-        x = x,
-        ys = ys,
-        terms = zip(terms,colors) ,
+        terms=terms,
+        results=results,
+        estimated_count=estimate_count(get_connection(), '''
+            SELECT 1 FROM metahtml
+            WHERE metahtml_search_tsvector(title, content) @@ to_tsquery('simple', :ts_query)
+            ''', {'ts_query':ts_query}),
+        next_cursor=next_cursor,
         )
 
 
+@app.route('/autocomplete')
+def autocomplete():
+    '''
+    Returns the lemmas in the rollups that start with the last word of the query,
+    ordered by the number of hostpaths that contain them.
+    '''
+    term_index.maybe_refresh()
+    query = request.args.get('query', '')
+    words = query.lower().split()
+    if len(words)<1 or query[-1].isspace():
+        prefix = ''
+    else:
+        prefix = words[-1]
+    completions = term_index.complete(prefix, app.config['AUTOCOMPLETE_MAX_COMPLETIONS'])
+    return jsonify({
+        'prefix': prefix,
+        'ready': term_index.ready,
+        'completions': [ {'term': term, 'hostpath': hostpath} for term, hostpath in completions ],
+        })
+
+
+@app.route('/autocomplete_stats')
+def autocomplete_stats():
+    '''
+    NOTE:
+    every worker process has its own index,
+    so these stats describe only the worker that handled the request
+    '''
+    stats = term_index.stats()
+    stats['pid'] = os.getpid()
+    return jsonify(stats)
+
+
+@app.route('/metrics')
+def metrics_summary():
+    '''
+    NOTE:
+    the histograms are kept separately in every worker process,
+    so these stats describe only the worker that handled the request
+    '''
+    return jsonify({
+        'pid': os.getpid(),
+        'routes': metrics.summary(),
+        'explain': list(metrics.plans),
+        'series_store': series_store.stats(),
+        })
+
+
+@app.route('/cache_stats')
+def cache_stats():
+    '''
+    NOTE:
+    the hit/miss counters are kept separately by every worker process and summed here;
+    the other workers' counters may lag by up to CACHE_FLUSH_INTERVAL seconds
+    '''
+    return jsonify(cache.stats())
+
+
+@app.route('/pspacy_stats')
+def pspacy_stats():
+    '''
+    NOTE:
+    the models are loaded separately in every worker process,
+    so these stats describe only the worker that handled the request
+    '''
+    stats = pspacy.nlp.stats()
+    stats['pid'] = os.getpid()
+    return jsonify(stats)
+
+
 @app.route("/static/<path:filename>")
 def staticfiles(filename):
     return send_from_directory(app.config["STATIC_FOLDER"], filename)
 
 
 ################################################################################
-# the code below creates a db connection and disconnects for each request;
-# it replaces every occurrence of the string __EXECUTION_TIME__
-# with the actual time to generate the webpage;
-# this could result in some rendering bugs on some webpages
-# see: https://stackoverflow.com/questions/12273889/calculate-execution-time-for-every-page-in-pythons-flask
+# the code below checks a db connection out of the pool the first time that a request needs one,
+# and returns it to the pool at the end of the request;
+# the time spent in each part of the request is sent in the Server-Timing header
+# (see project/metrics.py), and the footer of base.html displays the total
 ################################################################################
 
-engine = sqlalchemy.create_engine(app.config['DB_URI'], connect_args={
-    'connect_timeout': 10,
-    'application_name': 'novichenko/web',
-    })
+# NOTE:
+# the pool keeps its connections to pgbouncer open between requests;
+# no connection is opened at import time,
+# so gunicorn's forked workers never share a connection
+engine = sqlalchemy.create_engine(
+    app.config['DB_URI'],
+    pool_size=app.config['DB_POOL_SIZE'],
+    max_overflow=app.config['DB_MAX_OVERFLOW'],
+    pool_recycle=app.config['DB_POOL_RECYCLE'],
+    execution_options={
+        'prepared_statements': app.config['DB_PREPARED_STATEMENTS'],
+        },
+    connect_args={
+        'connect_timeout': 10,
+        'application_name': 'novichenko/web',
+        },
+    )
+metrics.init_app(app, engine)
+
+# the index loads in a background thread the first time that a request uses it
+term_index = TermIndex(
+    engine,
+    language='en',
+    refresh_interval=app.config['AUTOCOMPLETE_REFRESH_INTERVAL'],
+    )
+
+# the store file is updated in a subprocess after every rollup refresh,
+# and every worker maps the same file
+series_store = SeriesStore(
+    engine,
+    app.config['DB_URI'],
+    app.config['SERIES_STORE_PATH'],
+    language='en',
+    refresh_interval=app.config['SERIES_STORE_REFRESH_INTERVAL'],
+    stat_interval=app.config['SERIES_STORE_STAT_INTERVAL'],
+    )
+
+
+def get_connection():
+    '''
+    Returns the request's db connection, checking one out of the pool on the first call;
+    requests that are answered from memory or from the cache never call this function.
+    '''
+    if 'connection' not in g:
+        with metrics.span('connect'):
+            g.connection = engine.connect()
+    return g.connection
 
 
 @app.before_request
 def before_request():
-    g.start = time.time()
-    g.connection = engine.connect()
+    metrics.start_request()
 
 
 @app.after_request
 def after_request(response):
-    diff = time.time() - g.start
-    diff_str = f'{"%0.3f"%diff} seconds'
-    if ((response.response) and
-        (200 <= response.status_code < 300) and
-        (response.content_type.startswith('text/html'))):
-        response.set_data(response.get_data().replace(
-            b'__EXECUTION_TIME__', bytes(diff_str, 'utf-8')))
-    return response
+    if request.url_rule is None:
+        route = 'unmatched'
+    else:
+        route = request.url_rule.rule
+    return metrics.finish_request(route, response)
 
 
 @app.teardown_request
 def teardown_request(exception):
-    if hasattr(g, 'connection'):
-        g.connection.close()
+    connection = g.pop('connection', None)
+    if connection is not None:
+        connection.close()
@@ -0,0 +1,201 @@
+'''
+An in-memory index of the lemmas in the metahtml_rollup_textlang table,
+used for autocompleting the /ngrams search box and for rejecting query terms that are not in the rollups.
+
+The lemmas are stored in a sorted list with a parallel array of weights (the total hostpath count of the lemma),
+so the lemmas with a given prefix are a contiguous range found by binary search.
+The ranges of short prefixes are large,
+so their top completions are precomputed whenever the index is built.
+
+Each worker process has its own index.
+The index is loaded and refreshed in a background thread, and the requests never wait for the database;
+every refresh only fetches the rows of metahtml_rollup_textlang that changed since the previous refresh,
+and then atomically replaces the index.
+'''
+import array
+import bisect
+import heapq
+import logging
+import threading
+import time
+from sqlalchemy.sql import text
+
+
+class TermSnapshot:
+    '''
+    An immutable index of (term, weight) pairs.
+
+    >>> snapshot = TermSnapshot(['apple', 'apply', 'banana', 'app'], [5, 10, 1, 2])
+    >>> snapshot.complete('app')
+    [('apply', 10.0), ('apple', 5.0), ('app', 2.0)]
+    >>> snapshot.complete('appl', limit=1)
+    [('apply', 10.0)]
+    >>> snapshot.complete('cherry')
+    []
+    >>> 'banana' in snapshot, 'banan' in snapshot
+    (True, False)
+    >>> len(snapshot)
+    4
+    '''
+
+    def __init__(self, terms, weights, max_completions=10, cached_prefix_length=3):
+        order = sorted(range(len(terms)), key=terms.__getitem__)
+        self.terms = [ terms[i] for i in order ]
+        self.weights = array.array('d', [ weights[i] for i in order ])
+        self.max_completions = max_completions
+        self.cached_prefix_length = cached_prefix_length
+
+        # the terms are sorted, so all of the terms with the same short prefix are adjacent
+        self.cached_completions = {}
+        for length in range(1, cached_prefix_length+1):
+            lo = 0
+            while lo < len(self.terms):
+                prefix = self.terms[lo][:length]
+                if len(prefix) < length:
+                    lo += 1
+                    continue
+                hi = self._prefix_end(prefix, lo)
+                self.cached_completions[prefix] = self._top(lo, hi, max_completions)
+                lo = hi
+
+    def __len__(self):
+        return len(self.terms)
+
+    def __contains__(self, term):
+        i = bisect.bisect_left(self.terms, term)
+        return i < len(self.terms) and self.terms[i] == term
+
+    def items(self):
+        return zip(self.terms, self.weights)
+
+    def complete(self, prefix, limit=None):
+        '''
+        Returns the (term, weight) pairs with the largest weights of the terms that start with prefix.
+        '''
+        if limit is None or limit > self.max_completions:
+            limit = self.max_completions
+        if len(prefix) == 0:
+            return []
+        if len(prefix) <= self.cached_prefix_length:
+            return self.cached_completions.get(prefix, [])[:limit]
+        lo = bisect.bisect_left(self.terms, prefix)
+        return self._top(lo, self._prefix_end(prefix, lo), limit)
+
+    def _prefix_end(self, prefix, lo):
+        # every string that starts with prefix sorts before prefix followed by the largest code point
+        return bisect.bisect_left(self.terms, prefix + '\U0010ffff', lo)
+
+    def _top(self, lo, hi, limit):
+        indexes = heapq.nlargest(limit, range(lo, hi), key=self.weights.__getitem__)
+        return [ (self.terms[i], self.weights[i]) for i in indexes ]
+
+
+class TermIndex:
+    '''
+    Keeps a TermSnapshot of one language up to date with the database.
+    Before the first load finishes, the index is not ready:
+    complete returns no completions and contains returns None,
+    so that the web app does not reject terms that it cannot check.
+    '''
+
+    def __init__(self, engine, language='en', refresh_interval=60):
+        self.engine = engine
+        self.language = language
+        self.refresh_interval = refresh_interval
+        self.snapshot = None
+        self.max_id = 0
+        self.last_refresh = 0
+        self.lock = threading.Lock()
+        self.loads = 0
+        self.refreshes = 0
+        self.load_seconds = 0.0
+
+    @property
+    def ready(self):
+        return self.snapshot is not None
+
+    def maybe_refresh(self):
+        '''
+        Starts a background refresh if the index is older than refresh_interval seconds
+        and no other refresh is running; never blocks.
+        '''
+        if time.time() - self.last_refresh < self.refresh_interval:
+            return
+        if not self.lock.acquire(blocking=False):
+            return
+        self.last_refresh = time.time()
+        threading.Thread(target=self._refresh_locked, daemon=True).start()
+
+    def refresh(self):
+        '''
+        Refreshes the index in the current thread.
+        '''
+        with self.lock:
+            self.last_refresh = time.time()
+            self._refresh()
+
+    def _refresh_locked(self):
+        try:
+            self._refresh()
+        finally:
+            self.lock.release()
+
+    def _refresh(self):
+        start = time.time()
+        try:
+            with self.engine.connect() as connection:
+                rows = connection.execute(text('''
+                SELECT alltext, hostpath, max_id
+                FROM metahtml_rollup_textlang
+                WHERE language = :language AND max_id > :max_id
+                '''), {
+                    'language': self.language,
+                    'max_id': self.max_id,
+                    }).fetchall()
+        except Exception as e:
+            logging.error('autocomplete refresh failed: '+str(e))
+            return
+
+        if len(rows) == 0 and self.snapshot is not None:
+            return
+
+        # merge the changed rows into the current terms;
+        # the changed rows replace the old weights of the same terms
+        weights = {} if self.snapshot is None else dict(self.snapshot.items())
+        for alltext, hostpath, max_id in rows:
+            weights[alltext] = hostpath
+            self.max_id = max(self.max_id, max_id)
+        self.snapshot = TermSnapshot(list(weights.keys()), list(weights.values()))
+
+        if self.loads == 0:
+            self.loads += 1
+        else:
+            self.refreshes += 1
+        self.load_seconds = time.time() - start
+        logging.info('autocomplete language='+self.language+' terms='+str(len(self.snapshot))+' changed='+str(len(rows))+' seconds={:0.3f}'.format(self.load_seconds))
+
+    def complete(self, prefix, limit=None):
+        snapshot = self.snapshot
+        if snapshot is None:
+            return []
+        return snapshot.complete(prefix, limit)
+
+    def contains(self, term):
+        '''
+        Returns whether term is in the rollups, or None if the index is not ready.
+        '''
+        snapshot = self.snapshot
+        if snapshot is None:
+            return None
+        return term in snapshot
+
+    def stats(self):
+        return {
+            'language': self.language,
+            'ready': self.ready,
+            'terms': 0 if self.snapshot is None else len(self.snapshot),
+            'max_id': self.max_id,
+            'loads': self.loads,
+            'refreshes': self.refreshes,
+            'last_load_seconds': self.load_seconds,
+            }
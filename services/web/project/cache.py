@@ -0,0 +1,252 @@
+'''
+A cache for the /ngrams page that is shared between all of the web app's worker processes.
+
+The cache is stored in a local SQLite database,
+so every gunicorn worker on the host sees the same entries.
+Entries expire after ttl seconds,
+and the least recently used entries are evicted once there are more than max_entries.
+A hit only writes the entry's accessed_at when it is older than touch_interval seconds,
+so the eviction order is approximate but most hits are read-only.
+
+The hit/miss counters are kept in memory by every process,
+and each process writes its totals to the process_counters table at most once every flush_interval seconds;
+the stats method sums the rows of all processes.
+When a process flushes, the rows of the processes that have exited are added to the counters table and deleted,
+so process_counters only holds a row per live process however often gunicorn restarts its workers.
+This relies on all of the processes that share the file running in the same pid namespace.
+
+Entries whose key starts with a prefix in generational_prefixes depend on the rollup tables;
+they are deleted whenever a new row appears in the rollup_refresh table,
+which happens every time new rows are merged into the rollups (see the refresh_rollups procedure in schema.sql).
+
+The values are stored as json, so they must be json serializable and tuples come back as lists;
+unlike pickle, reading an entry that another user wrote into the file cannot run code.
+The directory of the file is created readable only by the web app's user.
+'''
+import json
+import os
+import sqlite3
+import threading
+import time
+from sqlalchemy.sql import text
+
+
+class QueryCache:
+
+    def __init__(
+            self,
+            path,
+            max_entries=10000,
+            ttl=60*60,
+            check_interval=60,
+            touch_interval=5,
+            flush_interval=10,
+            generational_prefixes=('ngrams:',),
+            ):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.check_interval = check_interval
+        self.touch_interval = touch_interval
+        self.flush_interval = flush_interval
+        self.generational_prefixes = generational_prefixes
+        self.local = threading.local()
+        self.last_check = 0
+        self.lock = threading.Lock()
+        self.counters_pid = None
+
+    def _connection(self):
+        '''
+        Each process and thread gets its own sqlite connection;
+        the pid check ensures that connections are not shared with forked gunicorn workers.
+        '''
+        if getattr(self.local, 'pid', None) != os.getpid():
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), mode=0o700, exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+
+            # the entries of version 0 files are pickles, which are never loaded
+            if connection.execute('PRAGMA user_version').fetchone()[0] < 1:
+                connection.execute('DROP TABLE IF EXISTS cache')
+                connection.execute('PRAGMA user_version=1')
+            connection.execute('''
+            CREATE TABLE IF NOT EXISTS cache (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )''')
+            connection.execute('CREATE INDEX IF NOT EXISTS cache_accessed_at ON cache (accessed_at)')
+            connection.execute('''
+            CREATE TABLE IF NOT EXISTS counters (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            )''')
+            connection.execute('''
+            CREATE TABLE IF NOT EXISTS process_counters (
+                process TEXT NOT NULL,
+                name TEXT NOT NULL,
+                value INTEGER NOT NULL,
+                PRIMARY KEY (process, name)
+            )''')
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return self.local.connection
+
+    def _increment(self, connection, name):
+        '''
+        Increments this process's counter for name,
+        and writes the counters to the database if they have not been written for flush_interval seconds.
+        '''
+        with self.lock:
+            # the counters are started over in forked gunicorn workers;
+            # the start time distinguishes processes that reuse the pid of an earlier process
+            if self.counters_pid != os.getpid():
+                self.counters_pid = os.getpid()
+                self.process = str(os.getpid())+':'+str(time.time())
+                self.counters = { 'hits': 0, 'misses': 0, 'invalidations': 0 }
+                self.last_flush = 0
+            self.counters[name] += 1
+        self._flush(connection)
+
+    def _flush(self, connection, force=False):
+        '''
+        Writes this process's counters to the process_counters table.
+        '''
+        now = time.time()
+        with self.lock:
+            if self.counters_pid != os.getpid():
+                return
+            if not force and now - self.last_flush < self.flush_interval:
+                return
+            self.last_flush = now
+            rows = [ (self.process, name, value) for name, value in self.counters.items() ]
+        connection.executemany('''
+            INSERT INTO process_counters (process, name, value) VALUES (?, ?, ?)
+            ON CONFLICT (process, name) DO UPDATE SET value=max(value, excluded.value)
+            ''', rows)
+        self._fold_exited(connection)
+
+    def _fold_exited(self, connection):
+        '''
+        Adds the counters of the processes that have exited to the counters table and deletes their rows.
+        The transaction is started with BEGIN IMMEDIATE,
+        so two processes never fold the same rows.
+
+        NOTE:
+        a process whose pid has been reused is kept until the new process exits too
+        '''
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            exited = []
+            for process, in connection.execute('SELECT DISTINCT process FROM process_counters'):
+                try:
+                    os.kill(int(process.split(':')[0]), 0)
+                except ProcessLookupError:
+                    exited.append(process)
+                except PermissionError:
+                    pass
+            for process in exited:
+                connection.execute('''
+                    INSERT INTO counters (name, value)
+                    SELECT name, value FROM process_counters WHERE process=?
+                    ON CONFLICT (name) DO UPDATE SET value=value+excluded.value
+                    ''', (process,))
+                connection.execute('DELETE FROM process_counters WHERE process=?', (process,))
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+
+    def get(self, key):
+        '''
+        Returns the value stored for key, or None if there is no unexpired entry.
+        '''
+        connection = self._connection()
+        now = time.time()
+        row = connection.execute(
+            'SELECT value, accessed_at FROM cache WHERE key=? AND created_at>?',
+            (key, now - self.ttl)
+            ).fetchone()
+        if row is None:
+            self._increment(connection, 'misses')
+            return None
+        if now - row[1] > self.touch_interval:
+            connection.execute('UPDATE cache SET accessed_at=? WHERE key=?', (now, key))
+        self._increment(connection, 'hits')
+        return json.loads(row[0])
+
+    def set(self, key, value):
+        '''
+        Stores value for key, then evicts expired entries and the least recently used entries over max_entries.
+        '''
+        connection = self._connection()
+        now = time.time()
+        connection.execute(
+            'INSERT OR REPLACE INTO cache (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)',
+            (key, json.dumps(value), now, now)
+            )
+        connection.execute('DELETE FROM cache WHERE created_at<=?', (now - self.ttl,))
+        connection.execute('''
+        DELETE FROM cache WHERE key IN (
+            SELECT key FROM cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?
+        )''', (self.max_entries,))
+
+    def invalidate(self, prefix=''):
+        '''
+        Deletes every entry whose key starts with prefix.
+        '''
+        connection = self._connection()
+        connection.execute("DELETE FROM cache WHERE substr(key, 1, ?)=?", (len(prefix), prefix))
+        self._increment(connection, 'invalidations')
+
+    def check_generation(self, connect):
+        '''
+        Deletes the generational entries if the rollups have been refreshed since they were cached.
+        The rollup_refresh table is queried at most once every check_interval seconds per process;
+        connect is a function that returns a db connection,
+        and it is only called when the table is queried.
+        '''
+        now = time.time()
+        if now - self.last_check < self.check_interval:
+            return
+        self.last_check = now
+
+        generation = connect().execute(text('''
+        SELECT coalesce(max(id), 0) FROM rollup_refresh;
+        ''')).scalar()
+
+        connection = self._connection()
+        row = connection.execute("SELECT value FROM counters WHERE name='generation'").fetchone()
+        if row is None or row[0] != generation:
+            for prefix in self.generational_prefixes:
+                self.invalidate(prefix)
+            connection.execute('''
+            INSERT INTO counters (name, value) VALUES ('generation', ?)
+            ON CONFLICT (name) DO UPDATE SET value=excluded.value
+            ''', (generation,))
+
+    def stats(self):
+        '''
+        Returns a dict with the counters summed over all processes and the number of entries.
+
+        NOTE:
+        the other processes write their counters at most once every flush_interval seconds,
+        so their most recent hits and misses may be missing
+        '''
+        connection = self._connection()
+        self._flush(connection, force=True)
+        stats = { 'hits': 0, 'misses': 0, 'invalidations': 0, 'generation': 0 }
+        stats.update(connection.execute("SELECT name, value FROM counters WHERE name='generation'").fetchall())
+        stats.update(connection.execute('''
+            SELECT name, sum(value) FROM (
+                SELECT name, value FROM process_counters
+                UNION ALL
+                SELECT name, value FROM counters WHERE name IN ('hits', 'misses', 'invalidations')
+            ) GROUP BY name''').fetchall())
+        stats['processes'] = connection.execute('SELECT count(DISTINCT process) FROM process_counters').fetchone()[0]
+        stats['entries'] = connection.execute('SELECT count(*) FROM cache').fetchone()[0]
+        stats['max_entries'] = self.max_entries
+        stats['ttl'] = self.ttl
+        return stats
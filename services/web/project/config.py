@@ -11,4 +11,43 @@ class Config(object):
     DB_USER = os.environ.get('DB_USER')
     DB_PASSWORD = os.environ.get('DB_PASSWORD')
     DB_NAME = os.environ.get('DB_NAME')
-    DB_URI = f'postgresql://{DB_USER}:{DB_PASSWORD}@db/{DB_NAME}'
+    DB_URI = os.environ.get('DB_URI', f'postgresql://{DB_USER}:{DB_PASSWORD}@db/{DB_NAME}')
+
+    # the connection pool of each worker process;
+    # gunicorn's sync workers need one connection for the request and one for the autocomplete refresh thread
+    DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 2))
+    DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 2))
+    DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 60*60))
+
+    # prepared statements are bound to a postgres session,
+    # so they only work when pgbouncer hands each client connection a single server connection;
+    # the pgbouncer container reads its pool_mode from the same POOL_MODE variable in .env.prod,
+    # and session is pgbouncer's default
+    POOL_MODE = os.environ.get('POOL_MODE', 'session')
+    DB_PREPARED_STATEMENTS = POOL_MODE == 'session'
+
+    # search results
+    SEARCH_RESULTS_PER_PAGE = 10
+
+    # the query cache shared by all of the worker processes;
+    # its directory must only be writable by the web app's user
+    CACHE_PATH = os.environ.get('CACHE_PATH', f"{os.getenv('APP_FOLDER', os.path.dirname(basedir))}/cache/novichenko_cache.sqlite")
+    CACHE_MAX_ENTRIES = int(os.environ.get('CACHE_MAX_ENTRIES', 10000))
+    CACHE_TTL = int(os.environ.get('CACHE_TTL', 60*60))
+    CACHE_CHECK_INTERVAL = int(os.environ.get('CACHE_CHECK_INTERVAL', 60))
+    CACHE_TOUCH_INTERVAL = int(os.environ.get('CACHE_TOUCH_INTERVAL', 5))
+    CACHE_FLUSH_INTERVAL = int(os.environ.get('CACHE_FLUSH_INTERVAL', 10))
+
+    # the in-memory autocomplete index of the lemmas in the rollups
+    AUTOCOMPLETE_REFRESH_INTERVAL = int(os.environ.get('AUTOCOMPLETE_REFRESH_INTERVAL', 60))
+    AUTOCOMPLETE_MAX_COMPLETIONS = 10
+
+    # the memory-mapped time series of every lemma (see seriesfile.py and project/seriesstore.py);
+    # the directory must be shared by all of the worker processes,
+    # and a worker remaps the file at most once every SERIES_STORE_STAT_INTERVAL seconds after it has been updated
+    SERIES_STORE_PATH = os.environ.get('SERIES_STORE_PATH', '/tmp/novichenko_series')
+    SERIES_STORE_REFRESH_INTERVAL = int(os.environ.get('SERIES_STORE_REFRESH_INTERVAL', 60))
+    SERIES_STORE_STAT_INTERVAL = int(os.environ.get('SERIES_STORE_STAT_INTERVAL', 1))
+
+    # the fraction of SELECT statements that are re-run with EXPLAIN (ANALYZE, BUFFERS) for /metrics
+    EXPLAIN_SAMPLE_RATE = float(os.environ.get('EXPLAIN_SAMPLE_RATE', 0))
@@ -0,0 +1,67 @@
+'''
+Server-side prepared statements for the web app's hot queries.
+
+The web app connects to postgres through pgbouncer.
+A prepared statement lives in a single postgres session,
+so prepared statements can only be used when pgbouncer is in session pooling mode
+(or when the web app connects to postgres directly);
+in transaction pooling mode, consecutive transactions may run on different server connections.
+Whether prepared statements are used is stored in the engine's "prepared_statements" execution option;
+when it is False, PreparedStatement.execute runs the plain parameterized SQL instead.
+
+Every pooled DBAPI connection remembers the names of the statements that it has prepared,
+so each statement is prepared once per connection and is then reused by every later request.
+'''
+import re
+from sqlalchemy.sql import text
+
+
+class PreparedStatement:
+    '''
+    A SQL statement with named parameters that is prepared on first use.
+
+    >>> statement = PreparedStatement(
+    ...     'metahtml_url',
+    ...     "SELECT url::text FROM metahtml WHERE id = :id AND url LIKE :pattern || '%'",
+    ...     id='BIGINT',
+    ...     pattern='TEXT',
+    ...     )
+    >>> statement.prepare_sql
+    "PREPARE metahtml_url (BIGINT, TEXT) AS SELECT url::text FROM metahtml WHERE id = $1 AND url LIKE $2 || '%'"
+    >>> statement.execute_sql
+    'EXECUTE metahtml_url (:id, :pattern)'
+
+    Every parameter must have a type.
+
+    >>> PreparedStatement('metahtml_url', 'SELECT url FROM metahtml WHERE id = :id')
+    Traceback (most recent call last):
+        ...
+    ValueError: parameter :id of metahtml_url has no type
+    '''
+
+    def __init__(self, name, sql, **types):
+        self.name = name
+        self.sql = sql
+        self.types = types
+        names = list(types.keys())
+
+        def positional(match):
+            if match.group(1) not in types:
+                raise ValueError(f'parameter :{match.group(1)} of {name} has no type')
+            return '$' + str(names.index(match.group(1)) + 1)
+
+        # the lookbehind skips postgres casts like url::text
+        self.prepare_sql = f'PREPARE {name} ({", ".join(types.values())}) AS ' + re.sub(r'(?<![:\w]):(\w+)', positional, sql)
+        self.execute_sql = f'EXECUTE {name} (' + ', '.join(':'+key for key in names) + ')'
+
+    def execute(self, connection, params):
+        if not connection.get_execution_options().get('prepared_statements', False):
+            return connection.execute(text(self.sql), params)
+
+        # the info dict belongs to the DBAPI connection, so it survives being returned to the pool;
+        # when the pool opens a new DBAPI connection, it starts with an empty set
+        prepared = connection.connection.info.setdefault('prepared_statements', set())
+        if self.name not in prepared:
+            connection.execute(text(self.prepare_sql))
+            prepared.add(self.name)
+        return connection.execute(text(self.execute_sql), params)
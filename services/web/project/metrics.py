@@ -0,0 +1,266 @@
+'''
+Request timing for the web app.
+
+Every request records a list of spans (connection checkout, lemmatization, each SQL statement, template rendering);
+the spans are returned to the browser in the Server-Timing header,
+and their durations are added to per-route histograms that the /metrics page summarizes.
+The headers of a streamed response are sent before its body is generated,
+so its Server-Timing header only contains the spans recorded before streaming starts;
+the histograms get the spans and total of a streamed response when the response is closed.
+
+The histograms have a fixed number of logarithmic buckets,
+so their memory usage does not grow with the number of requests,
+and the percentiles that they report are within about 5% of the true values.
+Each worker process has its own histograms.
+
+A fraction of the SELECT and EXECUTE statements (EXPLAIN_SAMPLE_RATE) is re-run with EXPLAIN (ANALYZE, BUFFERS);
+the plans of the most recent samples are kept for the /metrics page.
+'''
+import collections
+import contextlib
+import json
+import logging
+import math
+import random
+import re
+import threading
+import time
+import jinja2
+from flask import g, has_request_context
+from sqlalchemy import event
+
+
+class Histogram:
+    '''
+    A histogram of durations in seconds with logarithmically spaced buckets.
+
+    >>> histogram = Histogram()
+    >>> for i in range(1, 101):
+    ...     histogram.add(i/1000)
+    >>> histogram.count, round(histogram.max, 3)
+    (100, 0.1)
+    >>> [ round(histogram.percentile(p), 3) for p in [50, 95, 99] ]
+    [0.051, 0.091, 0.1]
+
+    The durations outside of [min_value, max_value] are clamped to the first and last buckets,
+    and the percentiles in the last bucket are reported as the maximum.
+
+    >>> histogram.add(1000)
+    >>> histogram.percentile(100)
+    1000
+    '''
+
+    def __init__(self, min_value=0.0001, max_value=100, growth=1.1):
+        self.min_value = min_value
+        self.growth = growth
+        self.log_growth = math.log(growth)
+        self.buckets = [0] * (self._bucket(max_value) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def _bucket(self, value):
+        if value <= self.min_value:
+            return 0
+        return math.ceil(math.log(value / self.min_value) / self.log_growth)
+
+    def add(self, value):
+        self.buckets[min(self._bucket(value), len(self.buckets)-1)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def percentile(self, p):
+        '''
+        Returns the geometric midpoint of the bucket that contains the p-th percentile,
+        or None if the histogram is empty.
+        '''
+        if self.count == 0:
+            return None
+        rank = p / 100 * self.count
+        total = 0
+        for i, count in enumerate(self.buckets):
+            total += count
+            if total >= rank and count > 0:
+                break
+        if i == 0:
+            return min(self.min_value, self.max)
+        if i == len(self.buckets)-1:
+            return self.max
+        return min(self.min_value * self.growth ** (i - 0.5), self.max)
+
+    def summary(self):
+        def ms(value):
+            return None if value is None else round(value*1000, 3)
+        return {
+            'count': self.count,
+            'mean_ms': ms(self.sum / self.count if self.count else None),
+            'p50_ms': ms(self.percentile(50)),
+            'p95_ms': ms(self.percentile(95)),
+            'p99_ms': ms(self.percentile(99)),
+            'max_ms': ms(self.max),
+            }
+
+
+class Metrics:
+
+    def __init__(self, explain_sample_rate=0.0, max_plans=20, max_header_spans=20):
+        self.explain_sample_rate = explain_sample_rate
+        self.max_header_spans = max_header_spans
+        self.histograms = collections.defaultdict(lambda: collections.defaultdict(Histogram))
+        self.plans = collections.deque(maxlen=max_plans)
+        self.lock = threading.Lock()
+
+    def init_app(self, app, engine):
+        '''
+        Times the templates rendered by app and the statements executed by engine.
+        The statements are only timed when they run inside of a request,
+        so the background threads of the web app are not instrumented.
+        '''
+        metrics = self
+
+        class TimedTemplate(jinja2.Template):
+            def render(self, *args, **kwargs):
+                with metrics.span('render', self.name):
+                    return super().render(*args, **kwargs)
+
+            # stream calls generate, and the span includes the time that the client takes to receive the page
+            def generate(self, *args, **kwargs):
+                with metrics.span('render', self.name):
+                    yield from super().generate(*args, **kwargs)
+
+        app.jinja_env.template_class = TimedTemplate
+
+        @event.listens_for(engine, 'before_cursor_execute')
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            conn.info.setdefault('query_start_time', []).append(time.perf_counter())
+
+        @event.listens_for(engine, 'after_cursor_execute')
+        def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            start = conn.info['query_start_time'].pop()
+            if not has_request_context() or not hasattr(g, 'spans'):
+                return
+            g.spans.append(('sql', time.perf_counter() - start, describe_statement(statement)))
+            if self.explain_sample_rate > 0 and random.random() < self.explain_sample_rate:
+                self.explain(conn, statement, parameters)
+
+    def start_request(self):
+        g.request_start = time.perf_counter()
+        g.spans = []
+
+    @contextlib.contextmanager
+    def span(self, name, description=None):
+        '''
+        Records the time spent inside of the with block as a span of the current request.
+        Does nothing outside of a request.
+        '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if has_request_context() and hasattr(g, 'spans'):
+                g.spans.append((name, time.perf_counter() - start, description))
+
+    def finish_request(self, route, response):
+        '''
+        Adds the request's spans to the histograms of route and sets the Server-Timing header of response.
+        The header lists every span individually (up to max_header_spans),
+        but the histograms only track the total time per span name.
+
+        The body of a streamed response is generated after this function returns,
+        so the header of a streamed response only contains the spans recorded so far,
+        and its total is the time until the headers are sent;
+        the spans are added to the histograms when the response is closed,
+        so that they include the spans recorded while streaming.
+        '''
+        if not hasattr(g, 'spans'):
+            return response
+        spans = g.spans
+        start = g.request_start
+        total = time.perf_counter() - start
+
+        if response.is_streamed:
+            response.call_on_close(lambda: self.add_spans(route, spans, time.perf_counter() - start))
+        else:
+            self.add_spans(route, spans, total)
+
+        entries = []
+        for name, duration, description in spans[:self.max_header_spans]:
+            entry = f'{name};dur={duration*1000:0.3f}'
+            if description:
+                entry += f';desc="{description}"'
+            entries.append(entry)
+        entries.append(f'total;dur={total*1000:0.3f}')
+        response.headers['Server-Timing'] = ', '.join(entries)
+        return response
+
+    def add_spans(self, route, spans, total):
+        '''
+        Adds the total time of each span name and the total time of the request to the histograms of route.
+        '''
+        totals = collections.OrderedDict()
+        for name, duration, description in spans:
+            totals[name] = totals.get(name, 0.0) + duration
+        with self.lock:
+            histograms = self.histograms[route]
+            histograms['total'].add(total)
+            for name, duration in totals.items():
+                histograms[name].add(duration)
+
+    def explain(self, conn, statement, parameters):
+        '''
+        Re-runs a SELECT statement (or the EXECUTE of a prepared SELECT) with EXPLAIN (ANALYZE, BUFFERS) and saves the plan.
+        The statement runs on a separate cursor inside of a savepoint,
+        so a failure does not affect the results or the transaction of the request.
+        '''
+        if not statement.lstrip().upper().startswith(('SELECT', 'EXECUTE')):
+            return
+        cursor = conn.connection.cursor()
+        try:
+            cursor.execute('SAVEPOINT explain_sample')
+            try:
+                cursor.execute('EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + statement, parameters)
+                plan = cursor.fetchone()[0]
+                cursor.execute('RELEASE SAVEPOINT explain_sample')
+            except Exception:
+                cursor.execute('ROLLBACK TO SAVEPOINT explain_sample')
+                raise
+        except Exception as e:
+            logging.warning('explain sample failed: '+str(e))
+            return
+        finally:
+            cursor.close()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        self.plans.append({
+            'time': time.time(),
+            'statement': describe_statement(statement, 200),
+            'execution_ms': plan[0].get('Execution Time'),
+            'plan': plan,
+            })
+
+    def summary(self):
+        with self.lock:
+            return {
+                route: { name: histogram.summary() for name, histogram in sorted(histograms.items()) }
+                for route, histograms in sorted(self.histograms.items())
+                }
+
+
+def describe_statement(statement, length=40):
+    '''
+    Returns a short single line description of a SQL statement
+    that is safe to include in a quoted Server-Timing description.
+
+    >>> describe_statement(\'\'\'
+    ...     SELECT "id", title
+    ...     FROM metahtml
+    ... \'\'\')
+    'SELECT id, title FROM metahtml'
+    >>> describe_statement('SELECT ' + 'x, '*100)
+    'SELECT x, x, x, x, x, x, x, x, x, x,...'
+    '''
+    description = ' '.join(re.sub(r'[^ -~]', ' ', re.sub(r'["\\]', '', statement)).split())
+    if len(description) > length:
+        description = description[:length-3].rstrip() + '...'
+    return description
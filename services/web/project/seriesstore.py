@@ -0,0 +1,129 @@
+'''
+Keeps the memory-mapped /ngrams time series of seriesfile.py up to date in the web app.
+
+SeriesStore.maybe_refresh starts a background thread that compares the file's generation with the database;
+when the rollups have been refreshed since the file was built,
+the thread updates the file in a subprocess (python3 -m seriesfile),
+and a lock file ensures that only one worker on the host updates it at a time.
+The subprocess only imports seriesfile.py, numpy, and sqlalchemy, not the web app,
+and it only reads the lemmas that changed since the previous file was built.
+'''
+import fcntl
+import logging
+import os
+import subprocess
+import sys
+import threading
+import time
+from sqlalchemy.sql import text
+from seriesfile import SeriesFile
+
+
+class SeriesStore:
+    '''
+    Keeps the store file of one language mapped and up to date.
+    get returns None whenever the file does not exist yet,
+    and the web app then falls back to timeseries.get_timeseries.
+    '''
+
+    def __init__(self, engine, db_uri, directory, language='en', refresh_interval=60, stat_interval=1):
+        self.engine = engine
+        self.db_uri = db_uri
+        self.directory = directory
+        self.language = language
+        self.path = os.path.join(directory, language + '.series')
+        self.refresh_interval = refresh_interval
+        self.stat_interval = stat_interval
+        self.file = None
+        self.last_stat = 0
+        self.last_refresh = 0
+        self.refresh_lock = threading.Lock()
+        self.builds = 0
+        self.build_seconds = 0.0
+
+    def current(self):
+        '''
+        Returns the SeriesFile, remapping it if the file has been replaced since it was mapped.
+        The file is checked at most once every stat_interval seconds.
+        '''
+        now = time.time()
+        if now - self.last_stat >= self.stat_interval:
+            self.last_stat = now
+            try:
+                stat = os.stat(self.path)
+                if self.file is None or (stat.st_ino, stat.st_mtime_ns) != (self.file.stat.st_ino, self.file.stat.st_mtime_ns):
+                    self.file = SeriesFile(self.path)
+            except FileNotFoundError:
+                self.file = None
+            except ValueError as e:
+                logging.error('series store: '+str(e))
+                self.file = None
+        return self.file
+
+    def get(self, terms):
+        series = self.current()
+        if series is None:
+            return None
+        return series.get(terms)
+
+    def maybe_refresh(self):
+        '''
+        Starts a background thread that rebuilds the file if the rollups have been refreshed since it was built;
+        the check runs at most once every refresh_interval seconds and never blocks.
+        '''
+        if time.time() - self.last_refresh < self.refresh_interval:
+            return
+        if not self.refresh_lock.acquire(blocking=False):
+            return
+        self.last_refresh = time.time()
+        threading.Thread(target=self._refresh_locked, daemon=True).start()
+
+    def _refresh_locked(self):
+        try:
+            self._refresh()
+        except Exception as e:
+            logging.error('series store refresh failed: '+str(e))
+        finally:
+            self.refresh_lock.release()
+
+    def _refresh(self):
+        with self.engine.connect() as connection:
+            generation = connection.execute(text('''
+            SELECT coalesce(max(id), 0) FROM rollup_refresh;
+            ''')).scalar()
+        series = self.current()
+        if series is not None and series.generation >= generation:
+            return
+
+        # the lock file is shared by every process on the host;
+        # a worker that does not get the lock picks up the other worker's file when it is renamed into place
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.path + '.lock', 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+            start = time.time()
+            # the build runs in a separate process so that it does not hold this worker's GIL;
+            # the url is passed in the environment so that the password does not show up in ps
+            subprocess.run(
+                [sys.executable, '-m', 'seriesfile', '--directory', self.directory, '--language', self.language],
+                cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                env=dict(os.environ, DB_URI=self.db_uri),
+                check=True,
+                )
+            self.build_seconds = time.time() - start
+            self.builds += 1
+        self.last_stat = 0
+
+    def stats(self):
+        series = self.current()
+        return {
+            'language': self.language,
+            'path': self.path,
+            'ready': series is not None,
+            'terms': 0 if series is None else len(series),
+            'generation': None if series is None else series.generation,
+            'builds': self.builds,
+            'last_build_seconds': self.build_seconds,
+            }
@@ -0,0 +1,35 @@
+// fills the <datalist id=autocomplete> of the search box with completions of the last word from /autocomplete
+(function() {
+    let input = document.querySelector("input[list=autocomplete]");
+    let datalist = document.getElementById("autocomplete");
+    if (input === null || datalist === null) {
+        return;
+    }
+
+    let timer = null;
+    let controller = null;
+    input.addEventListener("input", function() {
+        clearTimeout(timer);
+        timer = setTimeout(function() {
+            if (controller !== null) {
+                controller.abort();
+            }
+            controller = new AbortController();
+            let query = input.value;
+            fetch("/autocomplete?query=" + encodeURIComponent(query), {signal: controller.signal})
+                .then(function(response) { return response.json(); })
+                .then(function(json) {
+                    // the browser matches the options against the whole input,
+                    // so each option replaces only the last word of the query
+                    let head = query.slice(0, query.length - json.prefix.length);
+                    datalist.innerHTML = "";
+                    for (let completion of json.completions) {
+                        let option = document.createElement("option");
+                        option.value = head + completion.term;
+                        datalist.appendChild(option);
+                    }
+                })
+                .catch(function() {});
+        }, 100);
+    });
+})();
@@ -0,0 +1,40 @@
+// draws the /ngrams chart into element from the binary series returned by /ngrams/series?format=f32;
+// the response body is the float64 x values followed by one block of float32 values per term
+function plotSeries(element, url) {
+    let colors = ["red", "green", "blue", "black", "purple", "orange", "pink", "aqua"];
+    fetch(url)
+        .then(function(response) {
+            if (!response.ok) {
+                throw new Error(url + " returned " + response.status);
+            }
+            return response.arrayBuffer().then(function(buffer) { return [response.headers, buffer]; });
+        })
+        .then(function([headers, buffer]) {
+            let terms = JSON.parse(headers.get("X-Series-Terms"));
+            let months = parseInt(headers.get("X-Series-Months"));
+            let data = [new Float64Array(buffer, 0, months)];
+            let series = [{}];
+            terms.forEach(function(term, i) {
+                data.push(new Float32Array(buffer, 8*months + 4*months*i, months));
+                series.push({
+                    show: true,
+                    spanGaps: false,
+                    label: term,
+                    stroke: colors[i % colors.length],
+                    width: 1,
+                });
+            });
+            let opts = {
+                id: "chart1",
+                class: "my-chart",
+                width: 800,
+                height: 400,
+                series: series,
+            };
+            new uPlot(opts, data, element);
+        })
+        .catch(function(error) {
+            element.textContent = "the chart could not be loaded";
+            console.error(error);
+        });
+}
@@ -0,0 +1,83 @@
+'''
+Functions for computing the time series displayed on the /ngrams page.
+
+All of the terms are fetched from the rollup tables in a single statement,
+and the missing months are filled in with numpy instead of a generate_series join in postgres;
+this way, the cost of a query barely depends on the number of terms.
+'''
+import numpy as np
+from project.db import PreparedStatement
+from seriesfile import month_range, month_start
+
+
+# the rows with a NULL alltext are the monthly totals
+timeseries_statement = PreparedStatement(
+    'timeseries',
+    '''
+    SELECT
+        alltext,
+        timestamp_published,
+        hostpath
+    FROM metahtml_rollup_textlangmonth
+    WHERE
+        language = :language AND
+        alltext = ANY(:terms) AND
+        timestamp_published >= :start AND
+        timestamp_published < :end
+    UNION ALL
+    SELECT
+        NULL,
+        timestamp_published,
+        hostpath
+    FROM metahtml_rollup_langmonth
+    WHERE
+        language = :language AND
+        timestamp_published >= :start AND
+        timestamp_published < :end
+    ''',
+    language='TEXT',
+    terms='TEXT[]',
+    start='TIMESTAMPTZ',
+    end='TIMESTAMPTZ',
+    )
+
+
+def get_timeseries(connection, terms, language='en', start=(2000, 1), end=(2020, 12)):
+    '''
+    Returns the pair (x, ys).
+    x is a list of the unix timestamps of the first day of every month between start and end.
+    ys contains one list for each term,
+    and each entry is the fraction of the month's hostpaths that contain the term
+    (or 0 if no hostpaths were published that month).
+
+    The month timestamps are computed in UTC, which is the timezone of the database.
+    '''
+    months = month_range(start, end)
+    month_index = { month: i for i, month in enumerate(months) }
+    x = [ month_start(year, month).timestamp() for year, month in months ]
+
+    # a term may be repeated in the query, and each repetition gets its own series
+    term_indexes = {}
+    for i, term in enumerate(terms):
+        term_indexes.setdefault(term, []).append(i)
+
+    res = timeseries_statement.execute(connection, {
+        'language': language,
+        'terms': list(term_indexes.keys()),
+        'start': month_start(*start),
+        'end': month_start(end[0], end[1]+1),
+        })
+
+    totals = np.zeros(len(months))
+    counts = np.zeros((len(terms), len(months)))
+    for alltext, timestamp_published, hostpath in res:
+        i = month_index.get((timestamp_published.year, timestamp_published.month))
+        if i is None or hostpath is None:
+            continue
+        if alltext is None:
+            totals[i] = hostpath
+        else:
+            counts[term_indexes[alltext], i] = hostpath
+
+    ys = np.divide(counts, totals, out=np.zeros_like(counts), where=totals > 0)
+    return x, ys.tolist()
@@ -1,6 +1,15 @@
-import pkgutil
+import bisect
+import collections
+import functools
+import gc
 import importlib
 import inspect
+import itertools
+import os
+import pkgutil
+import threading
+import time
+import unicodedata
 import spacy
 
 # initialize logging
@@ -12,31 +21,50 @@ logging.basicConfig(
     )
 logger = logging.getLogger(__name__)
 
-# calculate the valid languages for the installed spacy version
-valid_langs = []
-for _, lang_iso, is_lang in pkgutil.iter_modules(spacy.lang.__path__):
-    if is_lang:
-        valid_langs.append(lang_iso)
-logger.info("valid_langs=" + str(valid_langs))
+# NOTE:
+# this module gets imported by every web worker, loader, and postgres backend,
+# and so nothing expensive should happen at import time;
+# the valid languages, the language classes, the spacy models,
+# and the table of special characters are all computed lazily the first time they are needed
 
-# the korean list of stop words isn't big enough,
-# so we add some more stop words here
-import spacy.lang.ko
-for stopword in ['이거', '이것', '는', '은', '가', '이', '을', '를', '기', '에']:
-    spacy.lang.ko.stop_words.STOP_WORDS.add(stopword)
 
+@functools.lru_cache(maxsize=None)
+def get_valid_langs():
+    '''
+    Returns the valid languages for the installed spacy version.
+    '''
+    valid_langs = []
+    for _, lang_iso, is_lang in pkgutil.iter_modules(spacy.lang.__path__):
+        if is_lang:
+            valid_langs.append(lang_iso)
+    logger.info("valid_langs=" + str(valid_langs))
+    return valid_langs
 
-# this function loads a spacy language model
-# it is used for lazily loading languages as they are needed
+
+def __getattr__(name):
+    '''
+    Provides the module attribute valid_langs without computing it at import time.
+    '''
+    if name == 'valid_langs':
+        return get_valid_langs()
+    raise AttributeError('module ' + repr(__name__) + ' has no attribute ' + repr(name))
+
+
+# this function finds the class of a spacy language model;
 # FIXME:
 # I'm pretty sure there should be an easier way to load a language model from the iso code,
 # but I couldn't figure out a native way to do this.
-def load_lang(lang_iso):
-
-    logger.info('initializing ' + lang_iso)
+@functools.lru_cache(maxsize=None)
+def get_lang_class(lang_iso):
     module_name = 'spacy.lang.' + lang_iso
     lang_module = importlib.import_module(module_name)
 
+    # the korean list of stop words isn't big enough,
+    # so we add some more stop words here
+    if lang_iso == 'ko':
+        for stopword in ['이거', '이것', '는', '은', '가', '이', '을', '를', '기', '에']:
+            lang_module.stop_words.STOP_WORDS.add(stopword)
+
     # Each module has a class within it responsible for NLP,
     # but it also has many other classes.
     # Our goal is to filter through these other classes to find the NLP class.
@@ -61,7 +89,15 @@ def load_lang(lang_iso):
     #  ('ChineseDefaults', <class 'spacy.lang.zh.ChineseDefaults'>),
     #  ('ChineseTokenizer', <class 'spacy.lang.zh.ChineseTokenizer'>)]
     shortest_name_length = min([len(name) for name, obj in filtered_classes])
-    nlp_constructor = list(filter(lambda x: len(x[0]) == shortest_name_length, filtered_classes))[0][1]
+    return list(filter(lambda x: len(x[0]) == shortest_name_length, filtered_classes))[0][1]
+
+
+# this function loads a spacy language model
+# it is used for lazily loading languages as they are needed
+def load_lang(lang_iso):
+
+    logger.info('initializing ' + lang_iso)
+    nlp_constructor = get_lang_class(lang_iso)
 
     # once we have the nlp_constructor,
     # we want to create the model with non-lemmatization related components disabled
@@ -75,24 +111,157 @@ def load_all_langs(langs=None):
     When debugging and testing, however, it can be useful to force the immediate loading of all languages.
     '''
     if langs is None:
-        langs = valid_langs
+        langs = get_valid_langs()
 
     for lang in langs:
-        nlp[lang] = load_lang(lang)
+        nlp.get(lang)
 
 
-# the nlp dictionary will hold the loaded spacy models,
-# and entry of None indicates that the model still needs to be loaded
-from collections import defaultdict
-nlp = defaultdict(lambda: None)
-nlp['xx'] = load_lang('xx')
+def current_rss():
+    '''
+    Returns the resident memory of the current process in bytes,
+    or 0 if it cannot be measured on this platform.
+    '''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+class ModelPool:
+    '''
+    Holds the loaded spacy models.
+
+    Models are loaded lazily the first time they are requested.
+    The memory used by each model is approximated by the growth of the process's resident memory while it loads.
+    When the total exceeds memory_budget bytes,
+    the least recently used models are evicted until the total is within the budget again;
+    the languages in pinned are never evicted.
+    A memory_budget of None means that models are never evicted.
+
+    Languages that spacy does not support use the multilingual model ('xx'),
+    and they do not count against the budget a second time.
+    '''
+    def __init__(self, memory_budget=None, pinned=('en', 'xx')):
+        self.memory_budget = memory_budget
+        self.pinned = set(pinned)
+        self.models = collections.OrderedDict()
+        self.memory = {}
+        self.aliases = {}
+        self.lock = threading.RLock()
+        self.loads = 0
+        self.load_seconds = 0.0
+        self.evictions = 0
+        self.evict_seconds = 0.0
+
+    def get(self, lang):
+        '''
+        Returns the model for lang, loading it first if needed.
+        '''
+        with self.lock:
+            lang = self.aliases.get(lang, lang)
+            if lang in self.models:
+                self.models.move_to_end(lang)
+                return self.models[lang]
+
+            if lang not in get_valid_langs():
+                logger.warn('lang="' + lang + '" not in valid_langs, using lang="xx"')
+                self.aliases[lang] = 'xx'
+                return self.get('xx')
+
+            start_rss = current_rss()
+            start = time.perf_counter()
+            model = load_lang(lang)
+            self.load_seconds += time.perf_counter() - start
+            self.loads += 1
+            self.models[lang] = model
+            self.memory[lang] = max(current_rss() - start_rss, 0)
+            self.evict(keep=lang)
+            return model
+
+    def evict(self, keep=None):
+        '''
+        Evicts least recently used models until the memory used is within the budget.
+        The language keep is never evicted.
+        '''
+        if self.memory_budget is None:
+            return
+        with self.lock:
+            start = time.perf_counter()
+            evicted = False
+            for lang in list(self.models.keys()):
+                if sum(self.memory.values()) <= self.memory_budget:
+                    break
+                if lang in self.pinned or lang == keep:
+                    continue
+                logger.info('evicting ' + lang + ' memory=' + str(self.memory[lang]))
+                del self.models[lang]
+                del self.memory[lang]
+                self.evictions += 1
+                evicted = True
+            if evicted:
+                gc.collect()
+                self.evict_seconds += time.perf_counter() - start
+
+    def stats(self):
+        '''
+        Returns a dict describing the loaded models and the load and eviction counts and timings.
+        '''
+        with self.lock:
+            return {
+                'loaded': list(self.models.keys()),
+                'memory': dict(self.memory),
+                'memory_total': sum(self.memory.values()),
+                'memory_budget': self.memory_budget,
+                'pinned': sorted(self.pinned),
+                'loads': self.loads,
+                'load_seconds': self.load_seconds,
+                'evictions': self.evictions,
+                'evict_seconds': self.evict_seconds,
+                }
+
+    def __getitem__(self, lang):
+        '''
+        Returns the model for lang if it is loaded, and None otherwise.
+        '''
+        with self.lock:
+            return self.models.get(self.aliases.get(lang, lang))
+
+
+# the nlp pool holds the loaded spacy models;
+# the memory budget (in megabytes) and the pinned languages can be set with environment variables
+nlp = ModelPool(
+    memory_budget=int(os.environ['PSPACY_MEMORY_BUDGET_MB'])*1024*1024 if os.environ.get('PSPACY_MEMORY_BUDGET_MB') else None,
+    pinned=os.environ.get('PSPACY_PINNED_LANGS', 'en,xx').split(','),
+    )
+
+
+class SpecialCharsTable(dict):
+    '''
+    A translation table for str.translate that deletes Unicode special characters
+    (the punctuation, symbol, and other categories).
+
+    Building a table of every code point takes about a second,
+    so instead each code point is looked up the first time it is translated,
+    and the result is remembered;
+    after warming up, this is as fast as a precomputed table.
+
+    >>> 'Hello, world! 😀'.translate(SpecialCharsTable())
+    'Hello world '
+    '''
+    def __missing__(self, i):
+        if unicodedata.category(chr(i)).startswith(('P', 'S', 'C')):
+            value = None
+        else:
+            value = i
+        self[i] = value
+        return value
+
 
-# create a table of Unicode special characters for filtering
 # this variable is used within the lemmatize function,
-# but we precompute it outside the function for efficiency
-import unicodedata
-import sys
-unicode_CPS = dict.fromkeys(i for i in range(0, sys.maxunicode + 1) if unicodedata.category(chr(i)).startswith(('P', 'S', 'C')))
+# and it is shared so that every call benefits from the remembered code points
+unicode_CPS = SpecialCharsTable()
 
 
 def lemmatize_query(
@@ -145,24 +314,15 @@ def lemmatize(
     if lang is None or text is None:
         return None
 
-    # if the language is not yet loaded, then load it
-    # if the language is not supported, then use spacy's multilingual model ('xx')
-    if nlp[lang] is None:
-        if lang in valid_langs:
-            nlp[lang] = load_lang(lang)
-        else:
-            logger.warn('lang="' + lang + '" not in valid_langs, using lang="xx"')
-            nlp[lang] = nlp['xx']
-
-    # process the text according to input flags
-    if lower_case:
-        text = text.lower()
-
-    if remove_special_chars:
-        text = text.translate(unicode_CPS)
+    model = get_nlp(lang)
+    text = preprocess_text(
+        text,
+        lower_case=lower_case,
+        remove_special_chars=remove_special_chars,
+        )
 
     try:
-        doc = nlp[lang](text)
+        doc = model(text)
     except ValueError as e:
         # FIXME:
         # How should we handle parsing errors?
@@ -177,6 +337,221 @@ def lemmatize(
         logger.error(str(e) + ' ; lang=' + lang + ', text=' + text)
         return None
 
+    return format_doc(
+        lang,
+        doc,
+        lower_case=lower_case,
+        remove_stop_words=remove_stop_words,
+        add_positions=add_positions,
+        )
+
+
+def lemmatize_many(
+        pairs,
+        batch_size=1000,
+        n_process=1,
+        lower_case=True,
+        remove_special_chars=True,
+        remove_stop_words=True,
+        add_positions=True,
+        ):
+    '''
+    A batched version of the lemmatize function.
+
+    The input is an iterable of (lang, text) pairs,
+    and the output is a generator that yields the same values
+    that calling lemmatize on each pair would return, in the same order.
+
+    The input is consumed in chunks of batch_size pairs.
+    Within each chunk, the texts are grouped by language,
+    and each group is passed through spacy's nlp.pipe function;
+    this is much faster than calling the model once per text.
+    The n_process argument is passed to nlp.pipe;
+    because spacy starts new processes on every call to nlp.pipe,
+    n_process>1 is only worthwhile for large values of batch_size.
+
+    >>> list(lemmatize_many([('en', 'Abraham Lincoln was president of the United States'), (None, 'test'), ('xx', None), ('xx', 'Abraham Lincoln')]))
+    ['abraham:1 lincoln:2 president:4 unite:7 state:8', None, None, 'abraham:1 lincoln:2']
+    >>> list(lemmatize_many([('en', 'the United States'), ('xx', 'the United States')], add_positions=False))
+    ['unite state', 'the unite states']
+    '''
+    pairs = iter(pairs)
+    while True:
+        chunk = list(itertools.islice(pairs, batch_size))
+        if len(chunk) == 0:
+            break
+
+        # group the indexes of the chunk by language;
+        # pairs containing a None get no group, and so their result stays None
+        results = [None] * len(chunk)
+        groups = collections.defaultdict(list)
+        for i, (lang, text) in enumerate(chunk):
+            if lang is not None and text is not None:
+                groups[lang].append(i)
+
+        for lang, indexes in groups.items():
+            model = get_nlp(lang)
+            texts = [
+                preprocess_text(
+                    chunk[i][1],
+                    lower_case=lower_case,
+                    remove_special_chars=remove_special_chars,
+                    )
+                for i in indexes
+                ]
+            try:
+                docs = list(model.pipe(texts, batch_size=batch_size, n_process=n_process))
+
+            # a parsing error in a single text aborts the whole pipe;
+            # we fall back to lemmatizing the group one text at a time
+            # so that only the offending texts get a result of None
+            except ValueError:
+                for i in indexes:
+                    results[i] = lemmatize(
+                        lang,
+                        chunk[i][1],
+                        lower_case=lower_case,
+                        remove_special_chars=remove_special_chars,
+                        remove_stop_words=remove_stop_words,
+                        add_positions=add_positions,
+                        )
+                continue
+
+            for i, doc in zip(indexes, docs):
+                results[i] = format_doc(
+                    lang,
+                    doc,
+                    lower_case=lower_case,
+                    remove_stop_words=remove_stop_words,
+                    add_positions=add_positions,
+                    )
+
+        yield from results
+
+
+def lemmatize_words_many(
+        pairs,
+        batch_size=1000,
+        lower_case=True,
+        remove_special_chars=True,
+        remove_stop_words=True,
+        ):
+    '''
+    Lemmatizes texts that have already been split into words,
+    keeping track of which word each lemma came from.
+
+    The input is an iterable of (lang, words) pairs, where words is a list of strings,
+    and the output is a generator that yields one list per pair
+    with an entry for each word;
+    the entry is the lemmas of the word's tokens joined by '|',
+    or '' if the word has no lemmas (for example, a stop word).
+    Pairs containing a None yield None.
+    The words are lemmatized together, so each lemma depends on the context of the whole text,
+    and the lemmas are the same that lemmatize would produce for ' '.join(words).
+
+    >>> list(lemmatize_words_many([('en', ['Abraham', 'Lincoln', 'was', 'president', 'of', 'the', 'United', 'States.']), (None, ['test'])]))
+    [['abraham', 'lincoln', '', 'president', '', '', 'unite', 'state'], None]
+    '''
+    pairs = iter(pairs)
+    while True:
+        chunk = list(itertools.islice(pairs, batch_size))
+        if len(chunk) == 0:
+            break
+
+        results = [None] * len(chunk)
+        groups = collections.defaultdict(list)
+        for i, (lang, words) in enumerate(chunk):
+            if lang is not None and words is not None:
+                groups[lang].append(i)
+
+        for lang, indexes in groups.items():
+            model = get_nlp(lang)
+
+            # the words are preprocessed one at a time and then joined by single spaces,
+            # so that the character offset of every token tells us which word it came from
+            texts = []
+            starts = []
+            for i in indexes:
+                processed = [
+                    preprocess_text(word, lower_case=lower_case, remove_special_chars=remove_special_chars)
+                    for word in chunk[i][1]
+                    ]
+                word_starts = []
+                offset = 0
+                for word in processed:
+                    word_starts.append(offset)
+                    offset += len(word) + 1
+                texts.append(' '.join(processed))
+                starts.append(word_starts)
+
+            try:
+                docs = list(model.pipe(texts, batch_size=batch_size))
+
+            # a parsing error in a single text aborts the whole pipe;
+            # we fall back to parsing the group one text at a time
+            # so that only the offending texts get a result of None
+            except ValueError:
+                docs = []
+                for text in texts:
+                    try:
+                        docs.append(model(text))
+                    except ValueError as e:
+                        logger.error(str(e) + ' ; lang=' + lang)
+                        docs.append(None)
+
+            for i, doc, word_starts in zip(indexes, docs, starts):
+                if doc is None:
+                    continue
+                lemmas = [ [] for word in word_starts ]
+                for token in doc:
+                    if token.is_space or (remove_stop_words and token.is_stop):
+                        continue
+                    lemma = token.lemma_
+                    # see the note in format_doc
+                    if lower_case and lang in ['ja', 'hr']:
+                        lemma = lemma.lower()
+                    lemmas[bisect.bisect_right(word_starts, token.idx) - 1].append(lemma)
+                results[i] = [ '|'.join(word_lemmas) for word_lemmas in lemmas ]
+
+        yield from results
+
+
+def get_nlp(lang):
+    '''
+    Returns the spacy model for lang, loading it first if needed.
+    If the language is not supported, then spacy's multilingual model ('xx') is used instead.
+    '''
+    return nlp.get(lang)
+
+
+def preprocess_text(
+        text,
+        lower_case=True,
+        remove_special_chars=True,
+        ):
+    '''
+    Processes the text according to the input flags before it is passed to spacy.
+    '''
+    if lower_case:
+        text = text.lower()
+
+    if remove_special_chars:
+        text = text.translate(unicode_CPS)
+
+    return text
+
+
+def format_doc(
+        lang,
+        doc,
+        lower_case=True,
+        remove_stop_words=True,
+        add_positions=True,
+        ):
+    '''
+    Converts a spacy doc into the string of lemmas returned by the lemmatize function.
+    '''
+
     def format_token(token, i):
         if add_positions:
             if token.lemma_ == ' ':
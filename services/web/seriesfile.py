@@ -0,0 +1,342 @@
+'''
+The file format and the compaction job of the memory-mapped /ngrams time series (see project/seriesstore.py).
+
+This module is outside of the project package and only depends on numpy and sqlalchemy,
+so the web app can run the compaction job in a subprocess (python3 -m seriesfile)
+without building a second copy of the flask app.
+
+The compaction job (build) reads metahtml_rollup_textlangmonth and metahtml_rollup_langmonth
+and writes one file per language that contains the monthly hostpath count of every lemma and the monthly totals;
+dividing them gives the same values that timeseries.get_timeseries computes from the database.
+Every gunicorn worker maps the file read-only,
+so the workers share a single copy of it in the page cache,
+and a lookup is a binary search over the sorted lemmas followed by a copy of one row per term.
+
+The file layout (all numbers are little endian):
+
+    header      64 bytes; see HEADER
+    totals      float32[months]; the hostpath count of each month
+    counts      float32[terms][months]; the hostpath count of each lemma in each month, in lemma order
+    offsets     uint64[terms+1]; starting at the next multiple of 8 bytes;
+                the utf-8 bytes of lemma i are text[offsets[i]:offsets[i+1]]
+    text        the utf-8 bytes of the lemmas, sorted bytewise
+
+The header records the rollup_refresh id (the generation) that the file was built from.
+A new file is written next to the old one and renamed over it,
+so readers either see the old file or the new file and never a partial one;
+readers that still have the old file mapped keep using it until they notice the rename.
+
+The counts are stored instead of the frequencies so that a rebuild only reads the lemmas that changed:
+the rows of metahtml_rollup_textlang record the refresh that last changed each lemma,
+and the counts of every other lemma are copied from the previous file.
+'''
+import datetime
+import itertools
+import logging
+import mmap
+import os
+import struct
+import numpy as np
+from sqlalchemy.sql import text
+
+
+# magic, version, months, terms, generation, start year, start month
+HEADER = struct.Struct('<8sIIQqII')
+HEADER_SIZE = 64
+MAGIC = b'NVSERIES'
+VERSION = 2
+
+
+def month_range(start, end):
+    '''
+    Returns a list of (year, month) tuples for every month between start and end (inclusive).
+
+    >>> month_range((2000, 11), (2001, 2))
+    [(2000, 11), (2000, 12), (2001, 1), (2001, 2)]
+    '''
+    return [
+        (i // 12, i % 12 + 1)
+        for i in range(start[0]*12 + start[1]-1, end[0]*12 + end[1])
+        ]
+
+
+def month_start(year, month):
+    '''
+    Returns the first moment of the month in UTC, which is the timezone of the database;
+    months past 12 roll over into the next year.
+
+    >>> month_start(2000, 13)
+    datetime.datetime(2001, 1, 1, 0, 0, tzinfo=datetime.timezone.utc)
+    '''
+    return datetime.datetime(year + (month-1) // 12, (month-1) % 12 + 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def align8(n):
+    return (n + 7) // 8 * 8
+
+
+def write_store(path, items, totals, start, generation):
+    '''
+    Writes a store file to path.
+    items is an iterable of (lemma, counts) pairs sorted by the utf-8 bytes of lemma,
+    and each counts vector has one entry for each month in totals.
+    The file is written under a temporary name and then renamed to path.
+
+    >>> import tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'en.series')
+    >>> write_store(path, [('b', [1, 1]), ('a', [2, 0])], totals=[2, 4], start=(2000, 1), generation=7)
+    Traceback (most recent call last):
+        ...
+    ValueError: the lemmas are not sorted: 'a' comes after 'b'
+    '''
+    tmp_path = path + '.' + str(os.getpid()) + '.tmp'
+    months = len(totals)
+    offsets = [0]
+    texts = []
+    previous = None
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(b'\0' * HEADER_SIZE)
+            f.write(np.asarray(totals, dtype='<f4').tobytes())
+            for lemma, counts in items:
+                encoded = lemma.encode('utf-8')
+                if previous is not None and encoded <= previous:
+                    raise ValueError(f'the lemmas are not sorted: {lemma!r} comes after {previous.decode("utf-8")!r}')
+                previous = encoded
+                f.write(np.asarray(counts, dtype='<f4').tobytes())
+                texts.append(encoded)
+                offsets.append(offsets[-1] + len(encoded))
+            f.write(b'\0' * (align8(f.tell()) - f.tell()))
+            f.write(np.asarray(offsets, dtype='<u8').tobytes())
+            f.write(b''.join(texts))
+            f.seek(0)
+            f.write(HEADER.pack(MAGIC, VERSION, months, len(texts), generation, start[0], start[1]))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class SeriesFile:
+    '''
+    A read-only view of a store file.
+
+    >>> import tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'en.series')
+    >>> write_store(path, [('peace', [1, 1]), ('war', [2, 0]), ('é', [0, 0.5])], totals=[2, 4], start=(2000, 12), generation=7)
+    >>> series = SeriesFile(path)
+    >>> len(series), series.generation
+    (3, 7)
+    >>> series.find('war'), series.find('é'), series.find('wa') is None
+    (1, 2, True)
+    >>> x, ys = series.get(['war', 'unknown', 'peace', 'war'])
+    >>> [ datetime.datetime.utcfromtimestamp(value).strftime('%Y-%m') for value in x ]
+    ['2000-12', '2001-01']
+    >>> ys
+    [[1.0, 0.0], [0.0, 0.0], [0.5, 0.25], [1.0, 0.0]]
+    '''
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.stat = os.fstat(f.fileno())
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.months, self.terms, self.generation, start_year, start_month = HEADER.unpack_from(self.mmap, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f'{path} is not a version {VERSION} series store')
+        self.start = (start_year, start_month)
+
+        # the arrays are views of the mapped file, so nothing is copied into the process
+        self.totals = np.frombuffer(self.mmap, dtype='<f4', count=self.months, offset=HEADER_SIZE)
+        counts_start = HEADER_SIZE + 4*self.months
+        self.counts = np.frombuffer(self.mmap, dtype='<f4', count=self.terms*self.months, offset=counts_start).reshape(self.terms, self.months)
+        offsets_start = align8(counts_start + 4*self.terms*self.months)
+        self.offsets = np.frombuffer(self.mmap, dtype='<u8', count=self.terms+1, offset=offsets_start)
+        self.text_start = offsets_start + 8*(self.terms+1)
+        self.x = [ month_start(start_year, start_month+i).timestamp() for i in range(self.months) ]
+
+    def __len__(self):
+        return self.terms
+
+    def lemma(self, i):
+        return self.mmap[self.text_start + int(self.offsets[i]) : self.text_start + int(self.offsets[i+1])]
+
+    def items(self):
+        '''
+        Yields the (lemma, counts) pairs of the file in lemma order.
+        '''
+        for i in range(self.terms):
+            yield self.lemma(i).decode('utf-8'), self.counts[i]
+
+    def find(self, lemma):
+        '''
+        Returns the row of lemma, or None if the store does not contain it.
+        '''
+        encoded = lemma.encode('utf-8')
+        lo = 0
+        hi = self.terms
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.lemma(mid) < encoded:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.terms and self.lemma(lo) == encoded:
+            return lo
+        return None
+
+    def get(self, terms):
+        '''
+        Returns the pair (x, ys) in the same format as timeseries.get_timeseries;
+        the series of the terms that are not in the store are all 0.
+        '''
+        ys = []
+        for term in terms:
+            i = self.find(term)
+            if i is None:
+                ys.append([0.0] * self.months)
+            else:
+                ys.append(np.divide(self.counts[i], self.totals, out=np.zeros(self.months, dtype='<f4'), where=self.totals > 0).tolist())
+        return self.x, ys
+
+
+def merge_items(previous, changed):
+    '''
+    Yields the (lemma, counts) pairs of previous, with the pairs of changed replacing or adding to them;
+    both inputs and the output are sorted by the utf-8 bytes of the lemmas.
+
+    >>> [ lemma for lemma, counts in merge_items(iter([('a', 1), ('c', 1), ('d', 1)]), iter([('b', 2), ('c', 2), ('e', 2)])) ]
+    ['a', 'b', 'c', 'd', 'e']
+    >>> dict(merge_items(iter([('a', 1), ('c', 1)]), iter([('c', 2)])))
+    {'a': 1, 'c': 2}
+    '''
+    old = next(previous, None)
+    new = next(changed, None)
+    while old is not None or new is not None:
+        if new is None or (old is not None and old[0].encode('utf-8') < new[0].encode('utf-8')):
+            yield old
+            old = next(previous, None)
+        else:
+            if old is not None and old[0] == new[0]:
+                old = next(previous, None)
+            yield new
+            new = next(changed, None)
+
+
+def build(connection, path, language='en', start=(2000, 1), end=(2020, 12), previous=None):
+    '''
+    Writes the store file of language to path from the rollup tables,
+    and returns the generation of the rollups that the file contains.
+
+    If previous is a SeriesFile with the same months,
+    then only the lemmas that changed since previous.generation are read from the rollups,
+    and the counts of the other lemmas are copied from previous.
+
+    The rollups are read in a single repeatable read transaction,
+    so the totals, the lemmas, and the generation are consistent with each other.
+    '''
+    months = month_range(start, end)
+    month_index = { month: i for i, month in enumerate(months) }
+    params = {
+        'language': language,
+        'start': month_start(*start),
+        'end': month_start(end[0], end[1]+1),
+        }
+
+    connection = connection.execution_options(isolation_level='REPEATABLE READ')
+    with connection.begin():
+        generation = connection.execute(text('''
+        SELECT coalesce(max(id), 0) FROM rollup_refresh;
+        ''')).scalar()
+
+        # the rollup_refresh rows before incremental_rollups.sql have no max_id,
+        # and a file built from them is rebuilt from scratch
+        since = None
+        if previous is not None and previous.start == start and previous.months == len(months):
+            since = connection.execute(text('''
+            SELECT max_id FROM rollup_refresh WHERE id = :generation AND max_id > 0;
+            '''), {'generation': previous.generation}).scalar()
+
+        totals = np.zeros(len(months))
+        res = connection.execute(text('''
+        SELECT timestamp_published, hostpath
+        FROM metahtml_rollup_langmonth
+        WHERE
+            language = :language AND
+            timestamp_published >= :start AND
+            timestamp_published < :end
+        '''), params)
+        for timestamp_published, hostpath in res:
+            i = month_index.get((timestamp_published.year, timestamp_published.month))
+            if i is not None and hostpath is not None:
+                totals[i] = hostpath
+
+        # the C collation sorts the lemmas by their utf-8 bytes, which is the order of the lemmas in the file;
+        # the rows are streamed with a server side cursor, so the whole rollup is never in memory
+        if since is None:
+            res = connection.execution_options(stream_results=True).execute(text('''
+            SELECT alltext, timestamp_published, hostpath
+            FROM metahtml_rollup_textlangmonth
+            WHERE
+                language = :language AND
+                timestamp_published >= :start AND
+                timestamp_published < :end
+            ORDER BY alltext COLLATE "C"
+            '''), params)
+        else:
+            res = connection.execution_options(stream_results=True).execute(text('''
+            SELECT m.alltext, m.timestamp_published, m.hostpath
+            FROM metahtml_rollup_textlang t
+            JOIN metahtml_rollup_textlangmonth m ON m.language = t.language AND m.alltext = t.alltext
+            WHERE
+                t.language = :language AND
+                t.max_id > :since AND
+                m.timestamp_published >= :start AND
+                m.timestamp_published < :end
+            ORDER BY m.alltext COLLATE "C"
+            '''), dict(params, since=since))
+
+        def items():
+            for alltext, rows in itertools.groupby(res, key=lambda row: row[0]):
+                counts = np.zeros(len(months))
+                for alltext, timestamp_published, hostpath in rows:
+                    i = month_index.get((timestamp_published.year, timestamp_published.month))
+                    if i is not None and hostpath is not None:
+                        counts[i] = hostpath
+                yield alltext, counts
+
+        if since is None:
+            write_store(path, items(), totals, start, generation)
+        else:
+            write_store(path, merge_items(previous.items(), items()), totals, start, generation)
+    return generation
+
+
+if __name__ == '__main__':
+    import argparse
+    import sqlalchemy
+    import time
+    parser = argparse.ArgumentParser(description='build the series store file of a language from the rollups')
+    parser.add_argument('--db', default=os.environ.get('DB_URI'))
+    parser.add_argument('--directory', required=True)
+    parser.add_argument('--language', default='en')
+    parser.add_argument('--full', action='store_true', help='rebuild the file from scratch instead of updating the existing file')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    engine = sqlalchemy.create_engine(args.db, connect_args={
+        'application_name': 'novichenko/seriesfile',
+        })
+    os.makedirs(args.directory, exist_ok=True)
+    path = os.path.join(args.directory, args.language + '.series')
+    previous = None
+    if not args.full:
+        try:
+            previous = SeriesFile(path)
+        except (FileNotFoundError, ValueError):
+            pass
+    start = time.time()
+    with engine.connect() as connection:
+        generation = build(connection, path, language=args.language, previous=previous)
+    logging.info('series store language='+args.language+' generation='+str(generation)+' incremental='+str(previous is not None)+' seconds={:0.3f}'.format(time.time() - start))
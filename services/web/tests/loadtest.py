@@ -0,0 +1,329 @@
+#!/usr/bin/python3
+'''
+An asyncio load generator for the web app.
+
+The load generator replays a weighted mix of requests (the workload) for a fixed duration,
+and reports the throughput, latency percentiles, status codes and error rate of every route.
+The requests are sent either over http to a running server (for example through nginx and pgbouncer in docker-compose),
+or in-process to the flask app through its test client, which needs neither docker nor a network.
+
+With --rate 0, every one of the --concurrency workers sends its next request as soon as its previous request finishes.
+With --rate > 0, requests are scheduled at that total rate no matter how slowly the server responds,
+and each latency is measured from the time that its request was scheduled,
+so that a slow server cannot hide its queueing delay by slowing down the load generator.
+
+A workload is a json list of routes:
+
+    [
+        {"path": "/ngrams", "weight": 5, "params": {"query": ["war", "president election"]}},
+        {"path": "/autocomplete", "weight": 3, "params": {"query": ["pre", "the uni"]}},
+        {"path": "/", "weight": 1}
+    ]
+
+Each request picks a route with probability proportional to its weight,
+and every parameter gets a random value from its list.
+
+Run from the services/web directory:
+
+    $ python3 tests/loadtest.py --url http://localhost:5000 --concurrency 100 --duration 30
+    $ python3 tests/loadtest.py --in_process --concurrency 8 --duration 10 --workload workload.json
+'''
+import asyncio
+import collections
+import concurrent.futures
+import json
+import random
+import time
+import urllib.parse
+
+
+default_workload = [
+    {'path': '/ngrams', 'weight': 5, 'params': {'query': ['war', 'peace', 'president election', 'covid vaccine', 'climate change', 'stock market crash']}},
+    {'path': '/ngrams/series', 'weight': 5, 'params': {'query': ['war', 'peace', 'president election', 'covid vaccine', 'climate change', 'stock market crash'], 'format': ['f32']}},
+    {'path': '/search', 'weight': 2, 'params': {'query': ['war', 'president', 'election fraud', 'vaccine']}},
+    {'path': '/autocomplete', 'weight': 3, 'params': {'query': ['p', 'pre', 'presid', 'war and pe', 'cli']}},
+    {'path': '/', 'weight': 1},
+    ]
+
+
+def percentile(values, p):
+    '''
+    Returns the nearest-rank p-th percentile of a sorted list.
+
+    >>> percentile([1, 2, 3, 4, 5, 6, 7, 8, 9, 10], 50)
+    5
+    >>> percentile([1, 2, 3, 4, 5, 6, 7, 8, 9, 10], 99)
+    10
+    >>> percentile([], 50) is None
+    True
+    '''
+    if len(values) == 0:
+        return None
+    rank = max(1, -(-len(values) * p // 100))
+    return values[int(rank) - 1]
+
+
+class Workload:
+    '''
+    Picks random requests from a weighted list of routes.
+
+    >>> workload = Workload([{'path': '/ngrams', 'weight': 1, 'params': {'query': ['war and peace']}}], seed=0)
+    >>> workload.next()
+    ('/ngrams', '/ngrams?query=war+and+peace')
+    '''
+
+    def __init__(self, routes, seed=0):
+        self.routes = routes
+        self.weights = [ route.get('weight', 1) for route in routes ]
+        self.random = random.Random(seed)
+
+    def next(self):
+        '''
+        Returns the pair (path, url), where url is path followed by the query string.
+        '''
+        route = self.random.choices(self.routes, self.weights)[0]
+        params = { name: self.random.choice(values) for name, values in route.get('params', {}).items() }
+        url = route['path']
+        if len(params) > 0:
+            url += '?' + urllib.parse.urlencode(params)
+        return route['path'], url
+
+
+class HTTPConnection:
+    '''
+    A minimal keep-alive http/1.1 client that only sends GET requests;
+    it reads bodies with a Content-Length, chunked bodies, and bodies that end when the server closes the connection.
+    '''
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+
+    async def get(self, url):
+        '''
+        Sends the request, reads the whole response, and returns the status code.
+        '''
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            self.writer.write(f'GET {url} HTTP/1.1\r\nHost: {self.host}\r\nConnection: keep-alive\r\n\r\n'.encode('latin-1'))
+            await self.writer.drain()
+
+            status_line = await self.reader.readline()
+            if not status_line:
+                raise ConnectionError('connection closed by the server')
+            version, status = status_line.decode('latin-1').split()[:2]
+            headers = {}
+            while True:
+                line = await self.reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                key, _, value = line.decode('latin-1').partition(':')
+                headers[key.strip().lower()] = value.strip().lower()
+
+            keep_alive = version == 'HTTP/1.1' and headers.get('connection') != 'close'
+            if 'content-length' in headers:
+                await self.reader.readexactly(int(headers['content-length']))
+            elif headers.get('transfer-encoding') == 'chunked':
+                while True:
+                    size = int((await self.reader.readline()).split(b';')[0], 16)
+                    # every chunk (and the final empty chunk) is followed by a CRLF
+                    await self.reader.readexactly(size + 2)
+                    if size == 0:
+                        break
+            else:
+                await self.reader.read()
+                keep_alive = False
+            if not keep_alive:
+                self.close()
+            return int(status)
+        except Exception:
+            self.close()
+            raise
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = None
+        self.writer = None
+
+
+class HTTPTarget:
+    '''
+    Sends the requests over http; each worker has its own keep-alive connection.
+    '''
+
+    def __init__(self, base_url):
+        parsed = urllib.parse.urlsplit(base_url)
+        self.host = parsed.hostname
+        self.port = parsed.port or 80
+        self.prefix = parsed.path.rstrip('/')
+
+    def connection(self):
+        http = HTTPConnection(self.host, self.port)
+        async def get(url):
+            return await http.get(self.prefix + url)
+        get.close = http.close
+        return get
+
+
+class FlaskTarget:
+    '''
+    Sends the requests to a flask app in the current process with its test client.
+    The test client is synchronous, so the requests run in a thread pool with one thread per worker.
+    '''
+
+    def __init__(self, app, concurrency):
+        self.client = app.test_client()
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
+
+    def request(self, url):
+        response = self.client.get(url)
+        # streamed responses are only generated when their body is read
+        response.get_data()
+        return response.status_code
+
+    def connection(self):
+        async def get(url):
+            return await asyncio.get_running_loop().run_in_executor(self.pool, self.request, url)
+        get.close = lambda: None
+        return get
+
+
+async def run(target, routes, concurrency=10, duration=10, rate=0, seed=0, timeout=30):
+    '''
+    Runs the load test and returns a dict of the results.
+    '''
+    workload = Workload(routes, seed=seed)
+    latencies = collections.defaultdict(list)
+    statuses = collections.defaultdict(collections.Counter)
+    start = time.perf_counter()
+    end = start + duration
+
+    # in open loop mode, the scheduler puts the scheduled start time of every request in the queue
+    queue = asyncio.Queue(maxsize=concurrency) if rate > 0 else None
+
+    async def scheduler():
+        i = 0
+        while True:
+            scheduled = start + i / rate
+            if scheduled >= end:
+                break
+            await asyncio.sleep(max(0, scheduled - time.perf_counter()))
+            await queue.put(scheduled)
+            i += 1
+        for j in range(concurrency):
+            await queue.put(None)
+
+    async def worker():
+        get = target.connection()
+        try:
+            while True:
+                if queue is None:
+                    scheduled = time.perf_counter()
+                    if scheduled >= end:
+                        break
+                else:
+                    scheduled = await queue.get()
+                    if scheduled is None:
+                        break
+                path, url = workload.next()
+                try:
+                    status = str(await asyncio.wait_for(get(url), timeout))
+                except asyncio.TimeoutError:
+                    get.close()
+                    status = 'timeout'
+                except Exception as e:
+                    get.close()
+                    status = type(e).__name__
+                latencies[path].append(time.perf_counter() - scheduled)
+                statuses[path][status] += 1
+        finally:
+            get.close()
+
+    tasks = [ worker() for i in range(concurrency) ]
+    if queue is not None:
+        tasks.append(scheduler())
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - start
+
+    results = {
+        'parameters': {
+            'concurrency': concurrency,
+            'duration': duration,
+            'rate': rate,
+            'seed': seed,
+            },
+        'elapsed_seconds': elapsed,
+        'routes': {},
+        }
+    for path in sorted(latencies):
+        values = sorted(latencies[path])
+        # the responses that are not 2xx, 3xx or 4xx count as errors
+        errors = sum(count for status, count in statuses[path].items() if not (status.isdigit() and int(status) < 500))
+        results['routes'][path] = {
+            'requests': len(values),
+            'requests_per_second': len(values) / elapsed,
+            'errors': errors,
+            'error_rate': errors / len(values),
+            'statuses': dict(statuses[path]),
+            'mean_ms': sum(values) / len(values) * 1000,
+            'p50_ms': percentile(values, 50) * 1000,
+            'p95_ms': percentile(values, 95) * 1000,
+            'p99_ms': percentile(values, 99) * 1000,
+            'max_ms': values[-1] * 1000,
+            }
+    total = sum(route['requests'] for route in results['routes'].values())
+    results['requests'] = total
+    results['requests_per_second'] = total / elapsed
+    results['error_rate'] = sum(route['errors'] for route in results['routes'].values()) / max(total, 1)
+    return results
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://localhost:5000', help='base url of the server')
+    parser.add_argument('--in_process', action='store_true', help='send the requests to the flask app in this process instead of to --url')
+    parser.add_argument('--workload', help='json file with the weighted routes; defaults to a mix of /ngrams, /ngrams/series, /search, /autocomplete and /')
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--duration', type=float, default=10, help='seconds')
+    parser.add_argument('--rate', type=float, default=0, help='requests per second; 0 sends requests as fast as the workers can')
+    parser.add_argument('--timeout', type=float, default=30, help='seconds before a request counts as an error')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='file to write the json results to; defaults to stdout')
+    args = parser.parse_args()
+
+    routes = default_workload
+    if args.workload:
+        with open(args.workload) as f:
+            routes = json.load(f)
+
+    if args.in_process:
+        import os
+        import sys
+        sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+        import project
+        target = FlaskTarget(project.app, args.concurrency)
+    else:
+        target = HTTPTarget(args.url)
+
+    results = asyncio.run(run(
+        target,
+        routes,
+        concurrency=args.concurrency,
+        duration=args.duration,
+        rate=args.rate,
+        seed=args.seed,
+        timeout=args.timeout,
+        ))
+    results['target'] = 'in_process' if args.in_process else args.url
+
+    output = json.dumps(results, indent=4)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
@@ -0,0 +1,90 @@
+import asyncio
+import http.server
+import threading
+import pytest
+import loadtest
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    '''
+    Responds with a Content-Length body, a chunked body, or a server error, depending on the path.
+    '''
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.path.startswith('/chunked'):
+            self.send_response(200)
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for chunk in [b'hello ', b'world']:
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+            self.wfile.write(b'0\r\n\r\n')
+        else:
+            status = 500 if self.path.startswith('/fail') else 200
+            body = b'x' * 1000
+            self.send_response(status)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class HTTP10Handler(Handler):
+    protocol_version = 'HTTP/1.0'
+
+
+@pytest.fixture(params=[Handler, HTTP10Handler])
+def server_url(request):
+    server = http.server.ThreadingHTTPServer(('localhost', 0), request.param)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://localhost:{server.server_port}'
+    server.shutdown()
+    server.server_close()
+
+
+routes = [
+    {'path': '/ok', 'weight': 2, 'params': {'query': ['a', 'b c']}},
+    {'path': '/chunked', 'weight': 1},
+    {'path': '/fail', 'weight': 1},
+    ]
+
+
+def test_http_closed_loop(server_url):
+    results = asyncio.run(loadtest.run(loadtest.HTTPTarget(server_url), routes, concurrency=4, duration=0.5))
+    assert set(results['routes'].keys()) == {'/ok', '/chunked', '/fail'}
+    assert results['routes']['/ok']['statuses'] == {'200': results['routes']['/ok']['requests']}
+    assert results['routes']['/chunked']['errors'] == 0
+    assert results['routes']['/fail']['error_rate'] == 1.0
+    for route in results['routes'].values():
+        assert route['requests'] > 0
+        assert route['p50_ms'] <= route['p95_ms'] <= route['p99_ms'] <= route['max_ms']
+
+
+def test_http_open_loop(server_url):
+    results = asyncio.run(loadtest.run(loadtest.HTTPTarget(server_url), routes, concurrency=4, duration=0.5, rate=40))
+    assert results['requests'] == 20
+
+
+def test_connection_errors():
+    # nothing listens on port 9 (discard) on the test machines
+    results = asyncio.run(loadtest.run(loadtest.HTTPTarget('http://localhost:9'), routes, concurrency=2, duration=0.2, rate=20))
+    assert results['requests'] == 4
+    assert results['error_rate'] == 1.0
+
+
+def test_in_process():
+    '''
+    These routes never touch the database, so this test also runs without postgres.
+    '''
+    project = pytest.importorskip('project')
+    in_process_routes = [
+        {'path': '/', 'weight': 1},
+        {'path': '/autocomplete', 'weight': 2, 'params': {'query': ['pre', 'war and pe']}},
+        {'path': '/metrics', 'weight': 1},
+        ]
+    results = asyncio.run(loadtest.run(loadtest.FlaskTarget(project.app, 4), in_process_routes, concurrency=4, duration=0.5))
+    assert set(results['routes'].keys()) == {'/', '/autocomplete', '/metrics'}
+    assert results['error_rate'] == 0
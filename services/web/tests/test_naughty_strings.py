@@ -13,7 +13,10 @@ host = 'localhost:5000'
 routes = [
     ('/',       []),
     ('/ngrams', ['query']),
+    ('/ngrams/series', ['query', 'format']),
     ('/search', ['query']),
+    ('/autocomplete', ['query']),
+    ('/metrics', []),
     ]
 
 # load the naughty_strings;
@@ -0,0 +1,52 @@
+import pytest
+import sqlalchemy
+
+
+@pytest.fixture
+def connection():
+    '''
+    A connection to the app's database where metahtml is a temporary table that is dropped after the test;
+    the test is skipped when the app or postgres are not available.
+    '''
+    project = pytest.importorskip('project')
+    try:
+        connection = project.engine.connect()
+    except sqlalchemy.exc.OperationalError:
+        pytest.skip('postgres is not available')
+    transaction = connection.begin()
+    connection.execute('''
+    CREATE TEMPORARY TABLE metahtml (
+        id BIGINT PRIMARY KEY,
+        title tsvector,
+        content tsvector,
+        title_text TEXT,
+        description TEXT,
+        snippet TEXT,
+        snippet_lemmas TEXT
+    ) ON COMMIT DROP
+    ''')
+    yield project, connection
+    transaction.rollback()
+    connection.close()
+
+
+def test_search_page_ties(connection):
+    project, connection = connection
+
+    # rows 2 through 6 have the same distance, so every page boundary below falls inside of the tie
+    texts = ['war war war', 'war and peace', 'war and peace', 'war and peace', 'war and peace', 'war and peace', 'the war of the worlds and other stories']
+    for id, text in enumerate(texts, 1):
+        connection.execute(sqlalchemy.text('''
+        INSERT INTO metahtml (id, title, content) VALUES (:id, to_tsvector('simple', :text), to_tsvector('simple', :text))
+        '''), {'id': id, 'text': text})
+
+    for limit in [2, 3, 4]:
+        ids = []
+        last_distance, last_ids = None, []
+        while True:
+            results, next_cursor = project.search_page(connection, 'war', last_distance, last_ids, limit)
+            ids.extend(result.id for result in results)
+            if next_cursor is None:
+                break
+            last_distance, last_ids = project.decode_cursor(next_cursor)
+        assert sorted(ids) == list(range(1, len(texts)+1))